@@ -0,0 +1,221 @@
+"""
+End-to-end fiscalization benchmarks against the local stub device.
+
+Run on a test site with ERPNext test records only: for the duration of the run
+Fiscal Device Settings points at the stub, and every scenario creates and
+submits Sales Invoices.
+
+    bench --site <test-site> execute aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.bench_fiscalization.run
+    bench --site <test-site> execute aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.bench_fiscalization.run --kwargs "{'invoices': 200, 'latency': 0.3}"
+
+Results are printed and saved as JSON under the site's private/benchmarks folder
+so runs can be compared.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import now_datetime
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.stub_device import StubDevice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_client import clear_clients
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.fiscal_queue import process_fiscal_batch, run_dispatcher
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings, invalidate_fiscal_settings
+
+SUBMIT_MODES = ("Synchronous", "Budgeted", "Queued")
+MAX_IN_FLIGHT = (1, 2, 4)
+
+# Settings fields a run overrides and restores afterwards
+SETTINGS_FIELDS = (
+    "enable_device",
+    "device_ip",
+    "port",
+    "fiscalize_invoices_on_submit",
+    "fiscalize_pos_invoices",
+    "submit_mode",
+    "submit_latency_budget",
+    "max_in_flight",
+    "circuit_failure_threshold",
+    "circuit_cooldown",
+)
+
+def run(invoices=50, latency=0.2, jitter=0.05, max_in_flight=MAX_IN_FLIGHT, output=None):
+    """Run every scenario and save the results as JSON, returns the results"""
+    results = {
+        "started": str(now_datetime()),
+        "site": frappe.local.site,
+        "config": {"invoices": invoices, "latency": latency, "jitter": jitter, "max_in_flight": list(max_in_flight)},
+        "scenarios": {},
+    }
+
+    with StubDevice(latency=latency, jitter=jitter, serial=True, seed=0) as device, use_device(device):
+        results["scenarios"]["submit_latency"] = bench_submit_latency(invoices)
+        results["scenarios"]["queue_drain"] = {
+            "serial_device": bench_queue_drain(device, invoices, max_in_flight),
+        }
+        # A device that signs in parallel shows what the dispatcher itself can do
+        device.serial = False
+        results["scenarios"]["queue_drain"]["concurrent_device"] = bench_queue_drain(device, invoices, max_in_flight)
+        device.serial = True
+        results["scenarios"]["outage"] = bench_outage(device, invoices)
+        results["device"] = device.get_stats()
+
+    results["finished"] = str(now_datetime())
+    path = save_results(results, output)
+    print(json.dumps(results["scenarios"], indent=1))
+    print(f"Saved to {path}")
+    return results
+
+@contextmanager
+def use_device(device):
+    """Point Fiscal Device Settings at the stub and restore the previous values afterwards"""
+    original = frappe.db.get_singles_dict("Fiscal Device Settings")
+    try:
+        set_settings(
+            enable_device=1,
+            device_ip="127.0.0.1",
+            port=device.port,
+            fiscalize_invoices_on_submit=0,
+            max_in_flight=1,
+            circuit_failure_threshold=3,
+            circuit_cooldown=2
+        )
+        yield
+    finally:
+        set_settings(**{fieldname: original.get(fieldname) for fieldname in SETTINGS_FIELDS})
+        clear_clients()
+
+def set_settings(**values):
+    for fieldname, value in values.items():
+        frappe.db.set_single_value("Fiscal Device Settings", fieldname, value)
+    frappe.db.commit()
+    invalidate_fiscal_settings()
+
+def bench_submit_latency(count):
+    """Wall time of Sales Invoice submit in each submit mode, one cashier at a time"""
+    results = {}
+    for mode in SUBMIT_MODES:
+        set_settings(fiscalize_invoices_on_submit=1, submit_mode=mode)
+        timings = []
+        for _i in range(count):
+            invoice = make_invoice()
+            started = time.perf_counter()
+            invoice.submit()
+            frappe.db.commit()
+            timings.append((time.perf_counter() - started) * 1000)
+        results[mode] = summarize(timings)
+
+    set_settings(fiscalize_invoices_on_submit=0)
+    # Leave nothing behind for the next scenario
+    drain()
+    return results
+
+def bench_queue_drain(device, count, max_in_flight=MAX_IN_FLIGHT):
+    """Invoices per second the dispatcher signs with each in-flight limit"""
+    results = {}
+    for limit in max_in_flight:
+        set_settings(max_in_flight=limit)
+        queue_invoices(count)
+        signed_before = device.get_stats()["signed"]
+
+        started = time.perf_counter()
+        drain()
+        elapsed = time.perf_counter() - started
+
+        signed = device.get_stats()["signed"] - signed_before
+        results[f"max_in_flight_{limit}"] = {
+            "signed": signed,
+            "seconds": round(elapsed, 3),
+            "per_second": round(signed / elapsed, 2) if elapsed else None,
+        }
+
+    set_settings(max_in_flight=1)
+    return results
+
+def bench_outage(device, count):
+    """How fast the circuit opens during an outage, and how fast the backlog drains after it"""
+    queued = queue_invoices(count)
+    breaker = get_fiscal_settings().get_circuit_breaker()
+    breaker.record_success()
+
+    device.outage = True
+    started = time.perf_counter()
+    batches = 0
+    while not breaker.is_open() and batches < 10:
+        process_fiscal_batch(limit=5)
+        batches += 1
+    time_to_open = time.perf_counter() - started
+    attempts = device.get_stats()["dropped"]
+
+    device.outage = False
+    # Wait out the cool-down so the half-open probe can close the circuit
+    time.sleep(get_fiscal_settings().circuit_cooldown)
+
+    started = time.perf_counter()
+    drain()
+    recovery = time.perf_counter() - started
+
+    return {
+        "seconds_to_open_circuit": round(time_to_open, 3),
+        "requests_during_outage": attempts,
+        # Rows handed back while the circuit is open keep their retries
+        "retries_used": frappe.db.count("Fiscal Queue", {"name": ["in", queued], "retry_count": [">", 0]}),
+        "recovery_seconds": round(recovery, 3),
+        "still_queued": frappe.db.count("Fiscal Queue", {"status": "Queued"}),
+    }
+
+def make_invoice():
+    from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+
+    return create_sales_invoice(qty=1, rate=100, do_not_submit=True)
+
+def queue_invoices(count):
+    """Submit invoices without fiscalizing them and queue them directly, no dispatcher job is started"""
+    queued = []
+    for _i in range(count):
+        invoice = make_invoice()
+        invoice.submit()
+        queued.append(frappe.get_doc({
+            "doctype": "Fiscal Queue",
+            "invoice": invoice.name,
+            "status": "Queued",
+            "retry_count": 0
+        }).insert(ignore_permissions=True).name)
+    frappe.db.commit()
+    return queued
+
+def drain(timeout=600):
+    """Run dispatcher slices in this process until the queue is empty"""
+    deadline = time.monotonic() + timeout
+    while frappe.db.count("Fiscal Queue", {"status": "Queued"}) and time.monotonic() < deadline:
+        run_dispatcher()
+        # A background dispatcher may hold the lock, its rows count as drained all the same
+        time.sleep(0.05)
+
+def summarize(timings):
+    timings = sorted(timings)
+    if not timings:
+        return {}
+
+    def pick(quantile):
+        return round(timings[min(int(len(timings) * quantile), len(timings) - 1)], 2)
+
+    return {
+        "count": len(timings),
+        "avg_ms": round(sum(timings) / len(timings), 2),
+        "p50_ms": pick(0.5),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": round(timings[-1], 2),
+    }
+
+def save_results(results, output=None):
+    path = output or frappe.get_site_path(
+        "private", "benchmarks", f"fiscalization-{now_datetime().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=1)
+    return path
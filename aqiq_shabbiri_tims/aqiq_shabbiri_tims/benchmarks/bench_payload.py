@@ -0,0 +1,75 @@
+"""
+Micro-benchmark for the item line builder used by format_invoice_data.
+
+    bench --site <site> execute aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.bench_payload.run
+"""
+import random
+import timeit
+
+import frappe
+from frappe.utils import flt
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.payload import build_items_list, columns_from_items
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.vat import resolve_vat
+
+SIZES = (10, 1_000, 10_000)
+
+def legacy_items_list(items):
+    """The per-item formatting format_invoice_data used before build_items_list"""
+    items_list = []
+    for item in items:
+        hscode = item.get('custom_hs_code', '')
+        unit_price = "{:.2f}".format(flt(item.amount / item.qty if item.qty else 0, 2))
+        quantity = "{:.2f}".format(flt(item.qty, 2))
+        total_amount = "{:.2f}".format(flt(item.amount, 2))
+        item_string = f" {hscode}{item.item_name} {quantity} {unit_price} {total_amount}"
+        if len(item_string) > 512:
+            item_string = item_string[:512]
+        items_list.append(item_string)
+    return items_list
+
+def make_items(count, seed=0):
+    """
+    Wholesale-like lines: a catalogue of a few hundred items, each at its own unit price,
+    sold in mostly distinct quantities, some of them weighed, so few amounts repeat
+    """
+    rng = random.Random(seed)
+    prices = {f"BENCH-{i:04d}": round(rng.uniform(1, 5000), 2) for i in range(300)}
+    items = []
+    for _i in range(count):
+        code = rng.choice(list(prices))
+        qty = rng.randint(1, 500) if rng.random() < 0.8 else round(rng.uniform(0.1, 50), 3)
+        items.append(frappe._dict(
+            item_code=code, item_name=f"Item {code}", qty=qty, amount=round(qty * prices[code], 2),
+            item_tax_template=None, custom_hs_code=""
+        ))
+    return items
+
+def run(repeat=5):
+    """Print legacy vs batched timings at each size and check the output is identical"""
+    results = []
+    for size in SIZES:
+        items = make_items(size)
+        # HS codes and VAT rates are one lookup per invoice, measured separately from formatting
+        hs_codes = {}
+        vat = resolve_vat([item.item_tax_template for item in items])
+
+        # Both sides start from the item rows, so splitting them into columns is timed too
+        def batched_items_list():
+            return build_items_list(columns_from_items(items), hs_codes, vat)
+
+        assert batched_items_list() == legacy_items_list(items)
+
+        number = max(1, 10_000 // size)
+        legacy = min(timeit.repeat(lambda: legacy_items_list(items), number=number, repeat=repeat)) / number
+        batched = min(timeit.repeat(batched_items_list, number=number, repeat=repeat)) / number
+        results.append({
+            "lines": size,
+            "legacy_ms": round(legacy * 1000, 3),
+            "batched_ms": round(batched * 1000, 3),
+            "speedup": round(legacy / batched, 2) if batched else None
+        })
+
+    for row in results:
+        print("{lines:>6} lines  legacy {legacy_ms:>9.3f} ms  batched {batched_ms:>9.3f} ms  x{speedup}".format(**row))
+    return results
@@ -0,0 +1,168 @@
+"""
+Local stand-in for a fiscal control unit, for benchmarks and tests.
+
+Implements POST /api/sign?invoice+1 and /api/sign?invoice+2 with configurable
+latency, error rate and serial processing, and can simulate an outage by
+dropping connections without answering.
+
+    python -m aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.stub_device --port 4444 --latency 0.3 --serial
+"""
+import argparse
+import itertools
+import json
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SERIAL_NUMBER = "STUB0000000001"
+
+
+class StubDevice:
+    """
+    Stub control unit served from a background thread.
+    Args:
+        port (int): Port to listen on, 0 picks a free one
+        latency (float): Seconds spent signing each invoice
+        jitter (float): Up to this many extra seconds, drawn uniformly per request
+        error_rate (float): Share of requests rejected with a `description`, like a real device
+        serial (bool): Sign one request at a time, as a control unit does
+    """
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0, serial=True, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.serial = serial
+        self.outage = False
+        self.signed = 0
+        self.rejected = 0
+        self.dropped = 0
+
+        self._random = random.Random(seed)
+        self._sequence = itertools.count(1)
+        self._sign_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-fiscal-device", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {"signed": self.signed, "rejected": self.rejected, "dropped": self.dropped}
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def sign(self, endpoint, payload):
+        """(status, body) for a signing request"""
+        if self.serial:
+            with self._sign_lock:
+                return self._sign(endpoint, payload)
+        return self._sign(endpoint, payload)
+
+    def _sign(self, endpoint, payload):
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        if endpoint not in ("invoice+1", "invoice+2"):
+            return 404, {"description": f"Unknown endpoint {endpoint}"}
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            self._count("rejected")
+            return 400, {"description": "Stub device rejected the invoice"}
+
+        number = next(self._sequence)
+        self._count("signed")
+        return 200, {
+            "cu_serial_number": SERIAL_NUMBER,
+            "cu_invoice_number": f"{SERIAL_NUMBER}{number:010d}",
+            "verify_url": f"https://itax.kra.go.ke/KRA-Portal/invoiceChk.htm?invoiceNo={SERIAL_NUMBER}{number:010d}",
+            "invoice_number": payload.get("invoice_number"),
+            "description": "Invoice signed",
+        }
+
+
+def _make_handler(device):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            if device.outage:
+                # Like an unplugged device: the request gets no answer at all
+                device._count("dropped")
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+
+            path, _, endpoint = self.path.partition("?")
+            if path != "/api/sign":
+                status, response = 404, {"description": f"Unknown path {path}"}
+            else:
+                try:
+                    status, response = device.sign(endpoint, json.loads(body or b"{}"))
+                except ValueError:
+                    status, response = 400, {"description": "Invalid JSON"}
+
+            data = json.dumps(response).encode()
+            try:
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up waiting, as it does on a read timeout
+                self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=4444)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per signature")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--concurrent", action="store_true", help="Sign requests in parallel instead of one at a time")
+    args = parser.parse_args()
+
+    device = StubDevice(args.port, args.latency, args.jitter, args.error_rate, serial=not args.concurrent)
+    print(f"Stub fiscal device listening on 127.0.0.1:{device.port}")
+    try:
+        device._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.fiscal_queue import enqueue_fiscalization
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings
+
+def on_submit(doc, method):
+    """
+    Queue the ticket for signing, the till never waits on the device.
+    The dispatcher drains tickets in batches to the device routed for their POS Profile.
+    """
+    if doc.get("custom_is_fiscalized") or doc.is_return:
+        return
+
+    fiscal_settings = get_fiscal_settings()
+    if not fiscal_settings.enable_device or not fiscal_settings.fiscalize_pos_invoices:
+        return
+
+    enqueue_fiscalization(doc.name, invoice_type="POS Invoice")
@@ -1,7 +1,22 @@
 import frappe
 from frappe import _
-import json
-from datetime import datetime
+from frappe.utils import flt
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.doctype.fiscal_queue.fiscal_queue import ACTIVE_STATUSES
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_pool import route_invoice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.fiscal_queue import (
+    _fail,
+    _requeue,
+    claim_invoice,
+    enqueue_fiscalization,
+    start_dispatcher
+)
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.invoice_loader import load_invoice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.journal import journal_invoice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.replay import get_cached_payload
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.write_back import write_fiscal_result
 
 def validate_fiscal_fields(doc):
     """Validate fiscal fields before submission"""
@@ -11,42 +26,44 @@ def validate_fiscal_fields(doc):
 def on_submit(doc, method):
     """Directly fiscalize invoice on submit if enabled"""
     if not doc.custom_is_fiscalized and not doc.is_return:
-        fiscal_settings = frappe.get_doc("Fiscal Device Settings")
+        fiscal_settings = get_fiscal_settings()
         if not fiscal_settings.enable_device or not fiscal_settings.fiscalize_invoices_on_submit:
             return
+        if doc.is_consolidated and fiscal_settings.fiscalize_pos_invoices:
+            # Consolidates POS Invoices that were signed one by one at the till
+            return
+
+        submit_mode = fiscal_settings.submit_mode or "Synchronous"
+        if submit_mode == "Queued":
+            enqueue_fiscalization(doc.name)
+            return
+        if submit_mode == "Budgeted":
+            fiscalize_within_budget(doc, fiscal_settings)
+            return
+        if submit_mode == "Store and Forward":
+            journal_invoice(doc)
+            return
 
-        # Create Fiscal Queue entry
-        queue_doc = frappe.get_doc({
-            "doctype": "Fiscal Queue",
-            "invoice": doc.name,
-            "status": "Queued",
-            "retry_count": 0
-        })
-        queue_doc.insert(ignore_permissions=True)
+        queue_doc, claimed = claim_invoice(doc.name, "Processing")
+        if not claimed:
+            # Another attempt owns the invoice, its result lands on the invoice when it finishes
+            frappe.msgprint(_("Invoice is already being fiscalized"), alert=True)
+            return
 
         try:
+            device = route_invoice(doc)
+
             # Format invoice data
-            invoice_data = fiscal_settings.format_invoice_data(
+            invoice_data = get_cached_payload(doc, device, lambda: device.format_invoice_data(
                 doc, doc.items,
                 is_inclusive=(doc.get("taxes") or [{}])[0].get("included_in_print_rate", True)
-            )
-
-            # Log the payload
-            frappe.logger().debug(f"Fiscalization Payload: {json.dumps(invoice_data, indent=2)}")
+            ))
 
             # Sign invoice
-            response = fiscal_settings.sign_invoice(invoice_data)
-
-            # Update fiscal details with custom fields
-            doc.db_set('custom_fiscal_invoice_number', response.get('cu_invoice_number'))
-            doc.db_set('custom_fiscal_verification_url', response.get('verify_url'))
-            doc.db_set('custom_is_fiscalized', 1)
+            response = device.sign_invoice(invoice_data)
 
-            # Update Fiscal Queue with success
-            queue_doc.status = "Completed"
-            queue_doc.response = json.dumps(response, indent=2)
-            queue_doc.completion_time = datetime.now()
-            queue_doc.save(ignore_permissions=True)
+            # Update fiscal details and the Fiscal Queue with success
+            write_fiscal_result(doc.name, queue_doc.name, response, doc=doc)
 
         except Exception as e:
             error_msg = str(e)
@@ -63,11 +80,40 @@ def on_submit(doc, method):
             
             frappe.throw(_("Failed to fiscalize invoice: {0}").format(error_msg))
 
+def fiscalize_within_budget(doc, fiscal_settings):
+    """Try the device once within the submit latency budget, queue the invoice if that fails"""
+    budget = flt(fiscal_settings.submit_latency_budget) or 2
+
+    queue_doc, claimed = claim_invoice(doc.name, "Processing")
+    if not claimed:
+        return
+
+    try:
+        device = route_invoice(doc)
+        invoice_data = get_cached_payload(doc, device, lambda: device.format_invoice_data(
+            doc, doc.items,
+            is_inclusive=(doc.get("taxes") or [{}])[0].get("included_in_print_rate", True)
+        ))
+        response = device.sign_invoice(invoice_data, retries=1, timeout=budget)
+    except Exception as e:
+        # Keep the device error out of the cashier's submit dialog, the queue will retry it
+        frappe.clear_last_message()
+        frappe.logger().info(f"Fiscalization of {doc.name} deferred to queue: {str(e)}")
+        # The claimed row becomes the queued attempt
+        _requeue(queue_doc.name, commit=False)
+        start_dispatcher()
+        frappe.msgprint(_("Fiscal device did not respond in time. Invoice queued for fiscalization."), alert=True)
+        return
+
+    write_fiscal_result(doc.name, queue_doc.name, response, doc=doc)
+
 @frappe.whitelist()
 def fiscalize_submitted_invoice(invoice_name):
     """Fiscalize a submitted invoice"""
     try:
-        invoice = frappe.get_doc("Sales Invoice", invoice_name)
+        invoice = load_invoice(invoice_name)
+        if not invoice:
+            frappe.throw(_("Invoice {0} not found").format(invoice_name))
 
         if invoice.docstatus != 1:
             frappe.throw(_("Invoice must be submitted to fiscalize"))
@@ -75,39 +121,31 @@ def fiscalize_submitted_invoice(invoice_name):
         if invoice.custom_is_fiscalized:
             frappe.throw(_("Invoice is already fiscalized"))
 
-        # Create Fiscal Queue entry
-        queue_doc = frappe.get_doc({
-            "doctype": "Fiscal Queue",
-            "invoice": invoice_name,
-            "status": "Queued",
-            "retry_count": 0
-        })
-        queue_doc.insert(ignore_permissions=True)
-
-        fiscal_settings = frappe.get_doc("Fiscal Device Settings")
+        fiscal_settings = get_fiscal_settings()
         if not fiscal_settings.enable_device:
             frappe.throw(_("Fiscal Device is not enabled in settings"))
 
+        queue_doc, claimed = claim_invoice(invoice_name, "Processing")
+        if not claimed:
+            # A double click, a submit or the dispatcher got there first: report that attempt,
+            # the form polls get_fiscalization_status until it finishes
+            return get_fiscalization_status(invoice_name)
+        # Make the claim visible to every other entry point before talking to the device
+        frappe.db.commit()
+
         try:
+            device = route_invoice(invoice)
+
             # Format invoice data
-            invoice_data = fiscal_settings.format_invoice_data(
-                invoice, invoice.items,
-                is_inclusive=(invoice.get("taxes") or [{}])[0].get("included_in_print_rate", True)
-            )
+            invoice_data = get_cached_payload(invoice, device, lambda: device.format_invoice_data(
+                invoice, invoice.items, is_inclusive=invoice.is_inclusive
+            ))
 
             # Sign invoice
-            response = fiscal_settings.sign_invoice(invoice_data)
-
-            # Update invoice fiscal details
-            invoice.db_set('custom_fiscal_invoice_number', response.get('cu_invoice_number'))
-            invoice.db_set('custom_fiscal_verification_url', response.get('verify_url'))
-            invoice.db_set('custom_is_fiscalized', 1)
+            response = device.sign_invoice(invoice_data)
 
-            # Update Fiscal Queue with success
-            queue_doc.status = "Completed"
-            queue_doc.response = json.dumps(response, indent=2)
-            queue_doc.completion_time = datetime.now()
-            queue_doc.save(ignore_permissions=True)
+            # Update invoice fiscal details and the Fiscal Queue with success
+            write_fiscal_result(invoice_name, queue_doc.name, response)
 
             return {
                 'success': True,
@@ -117,16 +155,15 @@ def fiscalize_submitted_invoice(invoice_name):
 
         except Exception as e:
             error_msg = str(e)
+            frappe.db.rollback()
             frappe.log_error(
                 title=_("Failed to Fiscalize Invoice"),
                 message=error_msg
             )
             
-            # Update Fiscal Queue with error
-            queue_doc.status = "Failed"
-            queue_doc.error = error_msg
-            queue_doc.retry_count += 1
-            queue_doc.save(ignore_permissions=True)
+            # The claim is already committed, fail it with the queue's backoff so it is retried
+            # unless the device rejected the invoice, and keep it from staying Processing after the throw
+            _fail(queue_doc.name, invoice_name, queue_doc.retry_count, e)
             
             frappe.throw(_("Failed to fiscalize invoice: {0}").format(error_msg))
 
@@ -135,4 +172,38 @@ def fiscalize_submitted_invoice(invoice_name):
             title=_("Failed to Fiscalize Invoice"),
             message=str(e)
         )
-        frappe.throw(_("Failed to fiscalize invoice: {0}").format(str(e))) 
\ No newline at end of file
+        frappe.throw(_("Failed to fiscalize invoice: {0}").format(str(e)))
+
+@frappe.whitelist()
+def get_fiscalization_status(invoice_name):
+    """
+    Where the invoice's fiscalization stands right now, polled by the form while an attempt runs.
+    Returns success once the invoice is fiscalized and `pending` while an attempt is Queued or
+    Processing, and throws the last error once the attempt has failed.
+    """
+    frappe.has_permission("Sales Invoice", "read", invoice_name, throw=True)
+
+    active = frappe.db.get_value(
+        "Fiscal Queue",
+        {"invoice_type": "Sales Invoice", "invoice": invoice_name, "status": ["in", ACTIVE_STATUSES]},
+        ["name", "status"],
+        as_dict=True
+    )
+    if active:
+        return {
+            'success': False,
+            'pending': True,
+            'status': active.status,
+            'message': _('Invoice is already being fiscalized')
+        }
+
+    if not frappe.db.get_value("Sales Invoice", invoice_name, "custom_is_fiscalized"):
+        error = frappe.db.get_value(
+            "Fiscal Queue", {"invoice_type": "Sales Invoice", "invoice": invoice_name}, "error", order_by="creation desc"
+        )
+        frappe.throw(_("Failed to fiscalize invoice: {0}").format(error or _("unknown error")))
+
+    return {
+        'success': True,
+        'message': _('Invoice fiscalized successfully')
+    }
@@ -0,0 +1,19 @@
+// Copyright (c) 2026, Ronoh and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("Fiscal Device", {
+	refresh(frm) {
+		if (frm.is_new()) return;
+
+		frappe.call({
+			method: "aqiq_shabbiri_tims.aqiq_shabbiri_tims.doctype.fiscal_device.fiscal_device.get_device_status",
+			args: { device: frm.doc.name },
+			callback(r) {
+				if (!r.message) return;
+				frm.dashboard.set_headline(
+					`<div class="indicator ${r.message.color}">${r.message.status}: ${r.message.message}</div>`
+				);
+			},
+		});
+	},
+});
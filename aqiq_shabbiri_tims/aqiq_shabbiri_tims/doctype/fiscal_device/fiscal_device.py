@@ -0,0 +1,52 @@
+# Copyright (c) 2026, Ronoh and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import cint
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings, invalidate_fiscal_settings
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.signer import FiscalSigner
+
+
+class FiscalDevice(FiscalSigner, Document):
+	def validate(self):
+		self.validate_routing_rules()
+		self.validate_failover_group()
+
+	def validate_routing_rules(self):
+		for rule in self.routing_rules:
+			if not (rule.company or rule.branch or rule.pos_profile):
+				frappe.throw(_("Row {0}: set a Company, Branch or POS Profile for the routing rule").format(rule.idx))
+
+	def validate_failover_group(self):
+		"""Payloads carry the Control Unit PIN, so failover only works between devices sharing it"""
+		if not self.failover_group:
+			return
+
+		siblings = frappe.get_all(
+			"Fiscal Device",
+			filters={"failover_group": self.failover_group, "name": ["!=", self.name]},
+			fields=["name", "control_unit_pin"]
+		)
+		for sibling in siblings:
+			if sibling.control_unit_pin != self.control_unit_pin:
+				frappe.throw(_("Fiscal Device {0} in failover group {1} uses a different Control Unit PIN").format(
+					sibling.name, self.failover_group
+				))
+
+	def on_update(self):
+		frappe.db.after_commit.add(invalidate_fiscal_settings)
+
+	def on_trash(self):
+		frappe.db.after_commit.add(invalidate_fiscal_settings)
+
+	def is_enabled(self, settings=None):
+		# Enable Device in Fiscal Device Settings switches the whole pool
+		return bool(cint(self.enabled)) and (settings or get_fiscal_settings()).is_enabled()
+
+
+@frappe.whitelist()
+def get_device_status(device):
+	return frappe.get_doc("Fiscal Device", device).get_connection_status()
@@ -0,0 +1,54 @@
+# Copyright (c) 2026, Ronoh and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.bench_fiscalization import set_settings
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_pool import get_failover_device, match_device
+
+
+def make_device(name, rules=(), failover_group=None, port=4444):
+	device = frappe.get_doc({
+		"doctype": "Fiscal Device",
+		"device_name": name,
+		"enabled": 1,
+		"device_ip": "127.0.0.1",
+		"port": port,
+		"control_unit_pin": "P000000000A",
+		"failover_group": failover_group,
+		"routing_rules": [dict(rule) for rule in rules],
+	})
+	device.freeze()
+	return device
+
+
+class TestFiscalDevice(FrappeTestCase):
+	def test_most_specific_rule_wins(self):
+		company = make_device("_Test Company Device", [{"company": "_Test Company"}])
+		till = make_device("_Test Till Device", [{"company": "_Test Company", "pos_profile": "_Test Till"}])
+		devices = (company, till)
+
+		invoice = frappe._dict(company="_Test Company", pos_profile="_Test Till")
+		self.assertIs(match_device(invoice, devices), till)
+		self.assertIs(match_device(frappe._dict(company="_Test Company"), devices), company)
+		self.assertIsNone(match_device(frappe._dict(company="_Test Company 1"), devices))
+
+	def test_failover_to_sibling_in_group(self):
+		primary = make_device("_Test Primary", failover_group="_test", port=4441)
+		sibling = make_device("_Test Sibling", failover_group="_test", port=4442)
+		other = make_device("_Test Other", failover_group="_other", port=4443)
+		devices = (primary, sibling, other)
+
+		# Enable Device in the settings switches the whole pool
+		enabled = frappe.db.get_single_value("Fiscal Device Settings", "enable_device")
+		set_settings(enable_device=1)
+		self.addCleanup(set_settings, enable_device=enabled)
+
+		breaker = primary.get_circuit_breaker()
+		self.addCleanup(breaker.record_success)
+		for _i in range(breaker.failure_threshold):
+			breaker.record_failure()
+
+		self.assertIs(get_failover_device(primary, devices), sibling)
+		self.assertIsNone(get_failover_device(other, devices))
@@ -7,9 +7,86 @@ frappe.ui.form.on('Fiscal Device Settings', {
         frm.add_custom_button(__('Test Connection'), function() {
             test_device_connection(frm);
         }, __('Device Operations'));
+
+        if (frm.doc.debug_mode) {
+            frm.add_custom_button(__('View Traces'), function() {
+                show_traces();
+            }, __('Device Operations'));
+        }
+
+        show_queue_summary(frm);
     }
 });
 
+function show_queue_summary(frm) {
+    frappe.call({
+        method: 'aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.queue_stats.get_queue_summary',
+        callback: function(r) {
+            const summary = r.message;
+            if (!summary) return;
+
+            const counts = summary.counts;
+            const backlog = counts.Queued + counts.Processing;
+            // Behind by more than five minutes is worth a look, more than thirty is an incident
+            const color = summary.lag_seconds > 1800 ? 'red' : (summary.lag_seconds > 300 ? 'orange' : 'green');
+            frm.dashboard.add_indicator(
+                __('Fiscal Queue: {0} pending, oldest waiting {1}', [backlog, format_lag(summary.lag_seconds)]),
+                backlog ? color : 'green'
+            );
+            if (counts.Failed) {
+                frm.dashboard.add_indicator(__('{0} failed', [counts.Failed]), 'red');
+            }
+        }
+    });
+}
+
+function format_lag(seconds) {
+    if (seconds < 60) return __('{0}s', [Math.round(seconds)]);
+    if (seconds < 3600) return __('{0}m', [Math.round(seconds / 60)]);
+    return __('{0}h', [Math.round(seconds / 3600)]);
+}
+
+function show_traces() {
+    frappe.call({
+        method: 'aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.trace.get_traces',
+        args: { limit: 50 },
+        callback: function(r) {
+            const traces = r.message || [];
+            const rows = traces.map(trace => `
+                <details style="margin-bottom: 8px;">
+                    <summary>
+                        <span class="indicator ${trace.error ? 'red' : 'green'}">
+                            ${frappe.utils.escape_html(trace.invoice_number || '')}
+                        </span>
+                        ${frappe.utils.escape_html(trace.device)} &middot; ${trace.started_at}
+                        &middot; ${trace.duration_ms} ms &middot; ${trace.attempts.length} ${__('attempt(s)')}
+                    </summary>
+                    <pre style="white-space: pre-wrap;">${frappe.utils.escape_html(JSON.stringify(trace, null, 2))}</pre>
+                </details>
+            `).join('');
+
+            const dialog = new frappe.ui.Dialog({
+                title: __('Fiscal Device Traces'),
+                size: 'extra-large',
+                fields: [{ fieldtype: 'HTML', fieldname: 'traces' }],
+                primary_action_label: __('Clear'),
+                primary_action: function() {
+                    frappe.call({
+                        method: 'aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.trace.clear_traces',
+                        callback: function() {
+                            dialog.hide();
+                        }
+                    });
+                }
+            });
+            dialog.fields_dict.traces.$wrapper.html(
+                rows || `<p class="text-muted">${__('No traces recorded yet')}</p>`
+            );
+            dialog.show();
+        }
+    });
+}
+
 function test_device_connection(frm) {
     // Validate required fields
     if (!frm.doc.device_ip || !frm.doc.port) {
@@ -4,13 +4,26 @@
 import frappe
 from frappe.model.document import Document
 import requests
-from requests.exceptions import RequestException
 import json
-import datetime
 
 from frappe import _
-from frappe.utils import flt
-class FiscalDeviceSettings(Document):
+from frappe.utils import cint
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_client import FiscalDeviceClient
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings, invalidate_fiscal_settings
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.signer import FiscalSigner
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.timeouts import CallBudget
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.vat import clear_vat_index, resolve_vat
+
+# Seconds the Test Connection button waits for the device
+TEST_CONNECTION_DEADLINE = 10
+
+class FiscalDeviceSettings(FiscalSigner, Document):
+    def on_update(self):
+        # Other workers must not reload the old values under the new version
+        frappe.db.after_commit.add(invalidate_fiscal_settings)
+        frappe.db.after_commit.add(clear_vat_index)
+
     def get_dashboard_data(self):
         return {
             'fieldname': 'fiscal_device',
@@ -24,28 +37,6 @@ class FiscalDeviceSettings(Document):
             ]
         }
 
-    def get_connection_status(self):
-        if not self.device_ip or not self.port:
-            return {
-                'status': 'Not Configured',
-                'color': 'red',
-                'message': _('Device IP and Port not configured')
-            }
-        
-        result = test_connection(self.device_ip, self.port)
-        if result.get('success'):
-            return {
-                'status': 'Connected',
-                'color': 'green',
-                'message': _('Device is connected and ready')
-            }
-        else:
-            return {
-                'status': 'Disconnected',
-                'color': 'red',
-                'message': result.get('error', _('Connection failed'))
-            }
-
     def get_api_headers(self):
         """Get the required headers for API calls"""
         return {
@@ -61,137 +52,20 @@ class FiscalDeviceSettings(Document):
         else:
             frappe.throw(_(message))
 
-    def sign_invoice(self, invoice_data, is_inclusive=True, retries=3):
-        """
-        Sign an invoice with the fiscal device
-        Args:
-            invoice_data (dict): Invoice data to be signed
-            is_inclusive (bool): Whether prices are VAT inclusive
-            retries (int): Number of retry attempts
-        """
-        if not self.enable_device:
-            frappe.throw(_("Fiscal Device is not enabled"))
-
-        if not self.device_ip or not self.port:
-            frappe.throw(_("Device IP and Port must be configured"))
-
-        endpoint = "invoice+1" if is_inclusive else "invoice+2"
-        url = f"http://{self.device_ip}:{self.port}/api/sign?{endpoint}"
-
-        for attempt in range(retries):
-            try:
-                response = requests.post(
-                    url=url,
-                    headers=self.get_api_headers(),
-                    json=invoice_data,
-                    timeout=30
-                )
-
-                frappe.logger().debug(f"Fiscal Device Response Status: {response.status_code}")
-                frappe.logger().debug(f"Fiscal Device Response Text: {response.text}")
-
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    error_message = response.json().get('description', response.text)
-                    frappe.logger().error(f"Fiscal Device Error: {error_message}")
-                    if attempt < retries - 1:
-                        frappe.logger().info(f"Retrying fiscalization (attempt {attempt + 2}/{retries})")
-                        continue
-                    else:
-                        frappe.throw(
-                            _("Failed to sign invoice after {0} attempts. Last error: {1}").format(retries, error_message)
-                        )
-
-            except requests.exceptions.RequestException as e:
-                frappe.logger().error(f"Fiscal Device Request Error: {str(e)}")
-                if attempt < retries - 1:
-                    frappe.logger().info(f"Retrying fiscalization (attempt {attempt + 2}/{retries})")
-                    continue
-                else:
-                    frappe.throw(_("Failed to connect to fiscal device after {0} attempts.").format(retries))
-            except Exception as e:
-                frappe.logger().error(f"Unexpected Error: {str(e)}")
-                frappe.throw(_("Unexpected error during fiscalization: {0}").format(str(e)))
-
-    def format_invoice_data(self, invoice, items, is_inclusive=True):
-        """
-        Format invoice data for fiscal device
-        Args:
-            invoice: Sales Invoice document
-            items: List of invoice items
-            is_inclusive: Whether prices are VAT inclusive
-        """
-        # Convert posting_date to datetime if it's a string
-        if isinstance(invoice.posting_date, str):
-            invoice_date = datetime.strptime(invoice.posting_date, "%Y-%m-%d").strftime("%d_%m_%Y")
-        else:
-            invoice_date = invoice.posting_date.strftime("%d_%m_%Y")
-
-        # Calculate totals with exactly 2 decimal places
-        grand_total = "{:.2f}".format(flt(invoice.grand_total, 2))
-        net_total = "{:.2f}".format(flt(invoice.net_total, 2))
-        tax_total = "{:.2f}".format(flt(invoice.total_taxes_and_charges, 2))
-        discount_total = "{:.2f}".format(flt(invoice.discount_amount, 2))
-
-        # Format items list according to documentation
-        items_list = []
-        for item in items:
-            # Get HS code, default to empty if not available
-            hscode = item.get('custom_hs_code', '')
-            
-            # Calculate unit price (unitNetto)
-            unit_price = "{:.2f}".format(flt(item.amount / item.qty if item.qty else 0, 2))
-            
-            # Format quantity and total amount with exactly 2 decimal places
-            quantity = "{:.2f}".format(flt(item.qty, 2))
-            total_amount = "{:.2f}".format(flt(item.amount, 2))
-            
-            # Format item string according to documentation
-            # Note the space at the start and max length of 512 symbols
-            item_string = f" {hscode}{item.item_name} {quantity} {unit_price} {total_amount}"
-            if len(item_string) > 512:
-                item_string = item_string[:512]
-            items_list.append(item_string)
-
-        # Construct payload according to documentation
-        payload = {
-            "invoice_date": invoice_date,
-            "invoice_number": invoice.name,
-            "invoice_pin": self.control_unit_pin,
-            "customer_pin": invoice.tax_id or "",
-            "customer_exid": invoice.custom_tax_exemption_id or "",
-            "grand_total": grand_total,
-            "net_subtotal": net_total if is_inclusive else "",  # Only for inclusive VAT
-            "tax_total": tax_total,
-            "net_discount_total": discount_total,
-            "sel_currency": invoice.currency,
-            "rel_doc_number": invoice.return_against or "",
-            "items_list": items_list
-        }
-
-        return payload
-
     def get_vat_rate(self, item):
         """Fetch VAT rate from item tax template"""
-        tax_rate = 16  # Default to 16% if not found
-        if item.item_tax_template:
-            tax_template = frappe.get_doc("Item Tax Template", item.item_tax_template)
-            for tax in tax_template.taxes:
-                if tax.tax_type == "VAT - SHKL":
-                    tax_rate = tax.tax_rate
-                    break
-        return tax_rate
+        return self.get_vat_rates([item])[0][0]
+
+    def get_vat_rates(self, items):
+        """(rate, fiscal_code) for all items of an invoice in one lookup"""
+        return resolve_vat([item.get("item_tax_template") for item in items])
 
 @frappe.whitelist()
 def test_connection(device_ip, port):
     """Test connection to fiscal device with proper payload format"""
     try:
         # Get settings doc for configuration values
-        settings = frappe.get_doc("Fiscal Device Settings")
-        
-        # Construct test URL with the correct endpoint for inclusive VAT
-        url = f"http://{device_ip}:{port}/api/sign?invoice+1"
+        settings = get_fiscal_settings()
         
         # Create test payload using values from settings
         test_payload = {
@@ -211,23 +85,19 @@ def test_connection(device_ip, port):
             ]
         }
         
-        # Get headers from settings
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': settings.bearer_token
-        }
-        
+        # A throwaway client, the form's unsaved IP and port must not replace the pooled production client
+        client = FiscalDeviceClient(device_ip, port, settings.bearer_token)
+
         if settings.debug_mode:
-            frappe.logger().debug(f"Test Connection URL: {url}")
+            frappe.logger().debug(f"Test Connection URL: {client.base_url}/api/sign?invoice+1")
             frappe.logger().debug(f"Test Payload: {json.dumps(test_payload, indent=2)}")
         
-        # Make the API request
-        response = requests.post(
-            url=url,
-            headers=headers,
-            json=test_payload,
-            timeout=10
-        )
+        # Make the API request with the correct endpoint for inclusive VAT, within the device's usual latency
+        timeouts = CallBudget(f"{device_ip}:{cint(port)}", deadline=TEST_CONNECTION_DEADLINE).next_attempt()
+        try:
+            response = client.sign(test_payload, is_inclusive=True, **timeouts)
+        finally:
+            client.close()
         
         if settings.debug_mode:
             frappe.logger().debug(f"Response Status: {response.status_code}")
@@ -1,9 +1,362 @@
 # Copyright (c) 2024, Ronoh and Contributors
 # See license.txt
 
-# import frappe
+import asyncio
+import json
+import time
+from datetime import timedelta
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.bench_fiscalization import make_invoice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.bench_payload import legacy_items_list, make_items
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.stub_device import StubDevice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.async_client import (
+	AsyncDeviceClient,
+	MAX_BODY_SIZE,
+	DeviceTransportError,
+	_read_response,
+	sign_invoice_async,
+)
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.circuit_breaker import CircuitBreaker
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_client import (
+	CONNECT_TIMEOUT,
+	DeviceRejectedError,
+	clear_clients,
+	get_client,
+)
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_health import HEARTBEAT_KEY
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.invoice_loader import load_invoice, load_invoices
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.metrics import (
+	get_histograms,
+	observe_all,
+	percentile,
+	prometheus_metrics,
+	reset_metrics,
+)
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.payload import build_items_list, columns_from_items
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.replay import (
+	_exists,
+	_key,
+	get_cached_payload,
+	get_replayed_response,
+	payload_digest,
+	record_request,
+	record_response,
+)
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings, invalidate_fiscal_settings
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.signer import SignAttempts
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.timeouts import (
+	MAX_CONNECT_TIMEOUT,
+	MIN_CONNECT_TIMEOUT,
+	MIN_READ_TIMEOUT,
+	CallBudget,
+	get_connect_timeout,
+	get_read_timeout,
+	record_latency
+)
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.trace import clear_traces, finish_trace, get_traces
+
 
 class TestFiscalDeviceSettings(FrappeTestCase):
-	pass
+	def tearDown(self):
+		clear_clients()
+
+	def test_client_is_pooled_per_endpoint(self):
+		client = get_client("127.0.0.1", 4444, "token", key="Fiscal Device Settings")
+		self.assertIs(client, get_client("127.0.0.1", "4444", "token", key="Fiscal Device Settings"))
+
+	def test_client_rebuilt_on_settings_change(self):
+		client = get_client("127.0.0.1", 4444, "token", key="Fiscal Device Settings")
+		rebuilt = get_client("127.0.0.1", 4444, "new token", key="Fiscal Device Settings")
+		self.assertIsNot(client, rebuilt)
+		self.assertEqual(rebuilt.session.headers["Authorization"], "new token")
+		self.assertIsNot(rebuilt, get_client("127.0.0.2", 4444, "new token", key="Fiscal Device Settings"))
+
+	def test_client_pool_covers_max_in_flight(self):
+		client = get_client("127.0.0.1", 4444, "token", key="_test_pool", max_in_flight=10)
+		self.assertEqual(client.session.get_adapter("http://127.0.0.1:4444")._pool_maxsize, 10)
+		# Raising the limit rebuilds the client, so no request waits on a pool sized for fewer
+		self.assertIsNot(client, get_client("127.0.0.1", 4444, "token", key="_test_pool", max_in_flight=12))
+
+	def test_circuit_breaker_opens_and_probes(self):
+		breaker = CircuitBreaker("_test_device", failure_threshold=2, cooldown=1)
+		breaker.record_success()
+
+		breaker.record_failure()
+		self.assertTrue(breaker.allow_request())
+		breaker.record_failure()
+		self.assertEqual(breaker.get_state(), "Open")
+		self.assertFalse(breaker.allow_request())
+
+		time.sleep(1.1)
+		self.assertEqual(breaker.get_state(), "Half-Open")
+		self.assertTrue(breaker.allow_request())
+		# Only one probe per cool-down
+		self.assertFalse(breaker.allow_request())
+
+		breaker.record_success()
+		self.assertEqual(breaker.get_state(), "Closed")
+
+	def test_settings_snapshot_is_shared_and_invalidated(self):
+		snapshot = get_fiscal_settings()
+		self.assertIs(snapshot, get_fiscal_settings())
+		with self.assertRaises(AttributeError):
+			snapshot.port = 1
+
+		invalidate_fiscal_settings()
+		self.assertIsNot(snapshot, get_fiscal_settings())
+
+	def test_batched_items_match_legacy_format(self):
+		items = make_items(500)
+		items[0].update(qty=0, amount=0)
+		items[1].update(item_name="X" * 600)
+		columns = columns_from_items(items)
+		self.assertEqual(build_items_list(columns), legacy_items_list(items))
+
+		# Items at the default VAT rate never carry an HS code, even when their Item has one
+		hs_codes = {item.item_code: "0000.00.00" for item in items}
+		self.assertEqual(build_items_list(columns, hs_codes=hs_codes), legacy_items_list(items))
+
+	def test_items_off_the_default_rate_carry_hs_codes(self):
+		columns = columns_from_items(make_items(2))
+		lines = build_items_list(columns, hs_codes={columns.item_code[1]: "0401.20.00"}, vat=[(16, "A"), (0, "C")])
+		self.assertEqual(lines[0], legacy_items_list(make_items(2))[0])
+		self.assertTrue(lines[1].startswith(f" 0401.20.00{columns.item_name[1]} "))
+
+	def test_lean_invoice_formats_like_full_document(self):
+		invoice = make_invoice()
+		first = invoice.items[0]
+		invoice.append("items", {
+			"item_code": first.item_code,
+			"qty": 2,
+			"rate": 50,
+			"uom": first.uom,
+			"conversion_factor": 1,
+			"income_account": first.income_account,
+			"expense_account": first.expense_account,
+			"cost_center": first.cost_center,
+			"warehouse": first.warehouse,
+		})
+		invoice.save()
+
+		# Duplicates are loaded once, missing invoices are left out
+		records = load_invoices([invoice.name, "_T-SINV-MISSING", invoice.name, None])
+		self.assertEqual(list(records), [invoice.name])
+		self.assertIsNone(load_invoice("_T-SINV-MISSING"))
+		self.assertEqual(load_invoices([]), {})
+
+		record = records[invoice.name]
+		self.assertEqual(record.items.qty, [item.qty for item in invoice.items])
+		# No tax rows, the same default as the full document
+		self.assertTrue(record.is_inclusive)
+
+		settings = get_fiscal_settings()
+		self.assertEqual(
+			settings.format_invoice_data(record, record.items, is_inclusive=record.is_inclusive),
+			settings.format_invoice_data(invoice, invoice.items),
+		)
+
+	def test_replay_store_matches_exact_payload(self):
+		payload = {"invoice_number": "_T-REPLAY-1", "items_list": [" ITEM 1.00 1.00 1.00"]}
+		record_response(payload, payload_digest(payload), {"cu_invoice_number": "CU-1"})
+		self.assertEqual(get_replayed_response(payload, payload_digest(payload)), {"cu_invoice_number": "CU-1"})
+
+		changed = dict(payload, grand_total="2.00")
+		self.assertIsNone(get_replayed_response(changed, payload_digest(changed)))
+
+		# A payload sent without a recorded response is noticed
+		record_request(changed, payload_digest(changed))
+		self.assertTrue(_exists(_key("_T-REPLAY-1", f"request|{payload_digest(changed)}")))
+
+	def test_cached_payload_follows_device(self):
+		invoice = frappe._dict(name="_T-REPLAY-2", modified="2024-01-01 10:00:00.000000")
+		device = frappe._dict(name="_Test Device", control_unit_pin="P000000001A")
+		payload = get_cached_payload(invoice, device, lambda: {"invoice_pin": device.control_unit_pin})
+		self.assertEqual(get_cached_payload(invoice, device, lambda: {}), payload)
+
+		# Rerouted to a device with another PIN, the payload is formatted again
+		other = frappe._dict(name="_Test Device 2", control_unit_pin="P000000002A")
+		self.assertEqual(
+			get_cached_payload(invoice, other, lambda: {"invoice_pin": other.control_unit_pin}),
+			{"invoice_pin": "P000000002A"},
+		)
+
+	def test_cached_payload_follows_invoice_changes(self):
+		invoice = frappe._dict(name="_T-REPLAY-3", modified="2024-01-01 10:00:00.000000")
+		device = frappe._dict(name="_Test Device", control_unit_pin="P000000001A")
+		get_cached_payload(invoice, device, lambda: {"grand_total": "100.00"})
+
+		# A rolled back submit leaves the entry behind, the edited invoice is formatted again
+		edited = frappe._dict(invoice, modified="2024-01-01 10:05:00.000000")
+		self.assertEqual(get_cached_payload(edited, device, lambda: {"grand_total": "80.00"}), {"grand_total": "80.00"})
+
+	def test_stage_histogram_percentiles(self):
+		reset_metrics()
+		observe_all("format", list(range(1, 101)), device="_Test Device")
+
+		histogram = get_histograms()[("format", "_Test Device")]
+		self.assertEqual(histogram["count"], 100)
+		self.assertEqual(percentile(histogram, 0.5), 50)
+		self.assertEqual(percentile(histogram, 0.95), 95)
+
+		exposition = prometheus_metrics().get_data(as_text=True)
+		self.assertIn('fiscal_stage_duration_milliseconds_count{stage="format",device="_Test Device"} 100', exposition)
+
+	def test_client_against_stub_device(self):
+		with StubDevice() as device:
+			client = get_client("127.0.0.1", device.port, "token", key="_test_stub")
+			response = client.sign({"invoice_number": "_T-STUB-1"})
+			self.assertEqual(response.status_code, 200)
+			self.assertEqual(response.json()["invoice_number"], "_T-STUB-1")
+
+			device.error_rate = 1
+			response = client.sign({"invoice_number": "_T-STUB-2"}, is_inclusive=False)
+			self.assertEqual(response.status_code, 400)
+			self.assertIn("description", response.json())
+			self.assertEqual(device.get_stats(), {"signed": 1, "rejected": 1, "dropped": 0})
+
+	def test_async_client_overlaps_requests(self):
+		async def sign_all(client, count):
+			try:
+				return await asyncio.gather(*(client.sign({"invoice_number": f"_T-ASYNC-{i}"}) for i in range(count)))
+			finally:
+				await client.close()
+
+		with StubDevice(latency=0.1, serial=False) as device:
+			started = time.perf_counter()
+			responses = asyncio.run(sign_all(AsyncDeviceClient("127.0.0.1", device.port, "token", max_in_flight=4), 8))
+			elapsed = time.perf_counter() - started
+
+			self.assertEqual([response.status_code for response in responses], [200] * 8)
+			# Two rounds of four, not eight requests one after another
+			self.assertLess(elapsed, 0.6)
+
+			device.latency = 1
+			client = AsyncDeviceClient("127.0.0.1", device.port, "token")
+			with self.assertRaises(asyncio.TimeoutError):
+				asyncio.run(client.sign({"invoice_number": "_T-ASYNC-SLOW"}, read_timeout=0.2))
+			# A timed out connection is never reused
+			self.assertEqual(client._idle, [])
+
+	def test_traces_kept_in_ring_buffer(self):
+		clear_traces()
+		# Unsampled calls carry no trace
+		finish_trace(None, response={})
+		self.assertEqual(get_traces(), [])
+
+		trace = {"device": "_Test Device", "invoice_number": "_T-TRACE-1", "attempts": [], "_started": time.perf_counter()}
+		finish_trace(trace, response={"cu_invoice_number": "CU-1"})
+
+		traces = get_traces(limit=1)
+		self.assertEqual(traces[0]["invoice_number"], "_T-TRACE-1")
+		self.assertEqual(traces[0]["response"], {"cu_invoice_number": "CU-1"})
+		self.assertNotIn("_started", traces[0])
+
+	def test_timeouts_follow_device_latency(self):
+		estimate = None
+		for ms in (200, 220, 180, 210):
+			estimate = record_latency("_test_latency:1", ms, estimate)
+		self.assertEqual(estimate["samples"], 4)
+		self.assertAlmostEqual(estimate["srtt"], 200, delta=20)
+		# A fast device is still given the floor, a jittery one gets more
+		self.assertEqual(get_read_timeout(estimate), MIN_READ_TIMEOUT)
+		self.assertGreater(get_read_timeout({"srtt": 4000, "rttvar": 1000, "samples": 10}), MIN_READ_TIMEOUT)
+
+		budget = CallBudget("_test_latency:1", deadline=2)
+		timeouts = budget.next_attempt()
+		self.assertLessEqual(timeouts["connect_timeout"] + timeouts["read_timeout"], 2)
+
+		# No attempt is started once the deadline cannot hold one
+		budget.deadline = time.monotonic()
+		self.assertIsNone(budget.next_attempt())
+		self.assertEqual(budget.attempts, 1)
+
+	def test_connect_timeout_follows_heartbeat(self):
+		def heartbeat(latency_ms, reachable=True):
+			frappe.cache().set_value(
+				f"{HEARTBEAT_KEY}|_test_connect:1", {"reachable": reachable, "latency_ms": latency_ms}, expires_in_sec=60
+			)
+			return get_connect_timeout("_test_connect:1")
+
+		self.addCleanup(frappe.cache().delete_value, f"{HEARTBEAT_KEY}|_test_connect:1")
+		# Twenty times the heartbeat's connect time, within 1-3 s
+		self.assertEqual(heartbeat(100), 2)
+		self.assertEqual(heartbeat(2), MIN_CONNECT_TIMEOUT)
+		self.assertEqual(heartbeat(500), MAX_CONNECT_TIMEOUT)
+		# Without a heartbeat that reached the device there is nothing to go by
+		self.assertEqual(heartbeat(100, reachable=False), CONNECT_TIMEOUT)
+
+	def test_read_timeout_backs_off_on_timeout(self):
+		estimate = None
+		for ms in (200, 220, 180, 210):
+			estimate = record_latency("_test_backoff:1", ms, estimate)
+
+		budget = CallBudget("_test_backoff:1", deadline=60)
+		timeouts = budget.next_attempt()
+		self.assertEqual(timeouts["read_timeout"], MIN_READ_TIMEOUT)
+
+		# The device slowed down: the next attempt waits twice as long
+		budget.back_off(timeouts)
+		self.assertEqual(budget.next_attempt()["read_timeout"], 2 * MIN_READ_TIMEOUT)
+		# and later calls, such as the half-open probe, start above the floor
+		self.assertGreater(CallBudget("_test_backoff:1").read_timeout, MIN_READ_TIMEOUT)
+
+	def test_async_response_parsing(self):
+		async def read(data):
+			reader = asyncio.StreamReader()
+			reader.feed_data(data)
+			reader.feed_eof()
+			return await _read_response(reader)
+
+		status, headers, body = asyncio.run(read(
+			b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+			b"5\r\n{\"a\":\r\n3;ext=1\r\n 1}\r\n0\r\n\r\n"
+		))
+		self.assertEqual((status, body), (200, b'{"a": 1}'))
+		self.assertEqual(headers["transfer-encoding"], "chunked")
+
+		# No length: the body runs to the end of the connection, which is then not reused
+		status, headers, body = asyncio.run(read(b"HTTP/1.0 400 Bad Request\r\n\r\n{}"))
+		self.assertEqual((status, body, headers["connection"]), (400, b"{}", "close"))
+
+		# A device that drops the connection mid-response is a transport error, never a short body
+		with self.assertRaises(asyncio.IncompleteReadError):
+			asyncio.run(read(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n{\"a\""))
+		with self.assertRaises(asyncio.IncompleteReadError):
+			asyncio.run(read(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\na\r\n{\"a\""))
+		with self.assertRaises(DeviceTransportError):
+			asyncio.run(read(b""))
+		with self.assertRaises(DeviceTransportError):
+			asyncio.run(read(b"garbage\r\n\r\n"))
+
+		# Bodies are never read past the cap, whatever the device announces
+		too_long = MAX_BODY_SIZE + 1
+		with self.assertRaises(DeviceTransportError):
+			asyncio.run(read(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n{}" % too_long))
+		with self.assertRaises(DeviceTransportError):
+			asyncio.run(read(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n%x\r\n" % too_long))
+		with self.assertRaises(DeviceTransportError):
+			asyncio.run(read(b"HTTP/1.0 200 OK\r\n\r\n" + b"x" * too_long))
+
+	def test_async_sign_needs_configured_device(self):
+		device = frappe._dict(name="_Test Device", device_ip="", port=0, is_enabled=lambda: True)
+		with self.assertRaises(frappe.ValidationError):
+			asyncio.run(sign_invoice_async(None, device, {"invoice_number": "_T-ASYNC-1"}))
+
+	def test_sign_attempts_classify_answers(self):
+		device = frappe._dict(name="_Test Device", get_device_key=lambda: "_test_attempts:1")
+		breaker = CircuitBreaker("_test_attempts", failure_threshold=5)
+		breaker.record_success()
+		payload = {"invoice_number": "_T-ATTEMPTS-1"}
+
+		def answer(status, body):
+			return frappe._dict(status_code=status, elapsed=timedelta(milliseconds=50), text=body, json=lambda: json.loads(body))
+
+		attempts = SignAttempts(device, payload, payload_digest(payload), 3, 10, breaker=breaker)
+		# An error page without a description may pass next time, a device rejection never will
+		self.assertIsNone(attempts.answer(answer(502, "<html>Bad Gateway</html>")))
+		with self.assertRaises(DeviceRejectedError):
+			attempts.answer(answer(400, '{"description": "Invalid PIN"}'))
+		self.assertEqual(attempts.answer(answer(200, '{"cu_invoice_number": "CU-1"}')), {"cu_invoice_number": "CU-1"})
@@ -0,0 +1,18 @@
+# Copyright (c) 2026, Ronoh and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+
+
+class FiscalJournal(Document):
+	def validate(self):
+		# Append-only, the forwarder records outcomes with direct updates
+		if not self.is_new():
+			frappe.throw(_("Fiscal Journal entries cannot be edited"))
+
+
+def on_doctype_update():
+	# Forwarder: Pending entries in journal order
+	frappe.db.add_index("Fiscal Journal", ["status", "name"])
@@ -0,0 +1,90 @@
+# Copyright (c) 2026, Ronoh and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.bench_fiscalization import use_device
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.stub_device import StubDevice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.journal import Forwarder
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings
+
+
+class TestFiscalJournal(FrappeTestCase):
+	"""The forwarder rolls back and commits, so entries are committed and deleted afterwards"""
+
+	def setUp(self):
+		self.addCleanup(frappe.db.commit)
+
+	def make_entry(self, invoice, device="_Test Missing Device", payload=None):
+		queue = frappe.get_doc({"doctype": "Fiscal Queue", "invoice": invoice, "status": "Processing"})
+		queue.flags.ignore_links = True
+		queue.insert()
+
+		entry = frappe.get_doc({
+			"doctype": "Fiscal Journal",
+			"invoice": invoice,
+			"queue": queue.name,
+			"device": device,
+			"payload": payload or '{"invoice_number":"%s"}' % invoice,
+		})
+		entry.flags.ignore_links = True
+		entry.insert()
+		frappe.db.commit()
+
+		self.addCleanup(frappe.db.delete, "Fiscal Queue", {"name": queue.name})
+		self.addCleanup(frappe.db.delete, "Fiscal Journal", {"name": entry.name})
+		return entry
+
+	def test_entries_are_append_only(self):
+		entry = self.make_entry("_T-SINV-FJ-1")
+		self.assertEqual(entry.status, "Pending")
+
+		entry.device = "_Test Other Device"
+		with self.assertRaises(frappe.ValidationError):
+			entry.save()
+
+	def test_entries_wait_for_unavailable_device(self):
+		first = self.make_entry("_T-SINV-FJ-2", device="Fiscal Device Settings")
+		second = self.make_entry("_T-SINV-FJ-3", device="Fiscal Device Settings")
+		self.assertGreater(second.name, first.name)
+
+		with StubDevice() as device, use_device(device):
+			breaker = get_fiscal_settings().get_circuit_breaker()
+			for _i in range(breaker.failure_threshold):
+				breaker.record_failure()
+			self.addCleanup(breaker.record_success)
+
+			state = Forwarder(chunk_size=1, echo=lambda message: None).forward(token="_test")
+
+		self.assertGreaterEqual(state["waiting"], 2)
+		self.assertEqual(state["forwarded"], 0)
+		self.assertEqual(device.get_stats()["signed"], 0)
+		for entry in (first, second):
+			self.assertEqual(frappe.db.get_value("Fiscal Journal", entry.name, "status"), "Pending")
+			self.assertEqual(frappe.db.get_value("Fiscal Queue", entry.queue, "status"), "Processing")
+
+	def test_entries_of_removed_device_go_back_to_queue(self):
+		entry = self.make_entry("_T-SINV-FJ-4")
+
+		state = Forwarder(echo=lambda message: None).forward(token="_test")
+
+		self.assertGreaterEqual(state["failed"], 1)
+		self.assertEqual(frappe.db.get_value("Fiscal Journal", entry.name, "status"), "Failed")
+		queue = frappe.db.get_value("Fiscal Queue", entry.queue, ["status", "error", "next_retry_at"], as_dict=True)
+		self.assertEqual(queue.status, "Failed")
+		self.assertIn("_Test Missing Device", queue.error)
+		# Retried through the queue, which routes the invoice to an enabled device
+		self.assertTrue(queue.next_retry_at)
+
+	def test_entries_failing_for_other_reasons_go_back_to_queue(self):
+		# Not a device outage, waiting for the device would never settle it
+		entry = self.make_entry("_T-SINV-FJ-5", device="Fiscal Device Settings", payload="not json")
+
+		state = Forwarder(echo=lambda message: None).forward(token="_test")
+
+		self.assertGreaterEqual(state["failed"], 1)
+		self.assertEqual(frappe.db.get_value("Fiscal Journal", entry.name, "status"), "Failed")
+		queue = frappe.db.get_value("Fiscal Queue", entry.queue, ["status", "next_retry_at"], as_dict=True)
+		self.assertEqual(queue.status, "Failed")
+		self.assertTrue(queue.next_retry_at)
@@ -1,9 +1,56 @@
 # Copyright (c) 2024, Ronoh and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.queue_stats import track
+
+# Statuses that count as an open fiscalization attempt, at most one per invoice
+ACTIVE_STATUSES = ("Queued", "Processing")
+
 
 class FiscalQueue(Document):
-	pass
+	def on_update(self):
+		# Covers inserts and form saves, bulk status updates call track() themselves
+		before = self.get_doc_before_save()
+		track(self.name, before.status if before else None, self.status, {self.name: self.creation})
+
+	def on_trash(self):
+		track(self.name, self.status, None)
+
+
+def on_doctype_update():
+	# enqueue_fiscalization: active row lookup by invoice
+	frappe.db.add_index("Fiscal Queue", ["invoice", "status"])
+	# process_failed_queue: failures whose retry is due
+	frappe.db.add_index("Fiscal Queue", ["status", "next_retry_at"])
+	# Dispatcher claims: oldest Queued rows first
+	frappe.db.add_index("Fiscal Queue", ["status", "creation"])
+	# Archival: Completed rows by age
+	frappe.db.add_index("Fiscal Queue", ["status", "completion_time"])
+	add_active_invoice_key()
+
+
+def add_active_invoice_key():
+	"""
+	Enforce at most one active row per invoice. `active_invoice` is a generated column
+	holding the invoice while the row is Queued or Processing and NULL otherwise, so the
+	unique key ignores finished rows and also covers bulk SQL status updates.
+	The key includes `invoice_type`, invoices of different doctypes may share a name.
+	"""
+	if frappe.db.db_type != "mariadb":
+		return
+
+	if not frappe.db.has_column("Fiscal Queue", "active_invoice"):
+		statuses = ", ".join(frappe.db.escape(status) for status in ACTIVE_STATUSES)
+		frappe.db.sql_ddl(f"""
+			alter table `tabFiscal Queue`
+			add column `active_invoice` varchar(140)
+			as (if(`status` in ({statuses}), `invoice`, null)) persistent
+		""")
+		frappe.clear_cache(doctype="Fiscal Queue")
+
+	frappe.db.add_unique(
+		"Fiscal Queue", ["invoice_type", "active_invoice"], constraint_name="unique_active_invoice_type"
+	)
@@ -1,9 +1,403 @@
 # Copyright (c) 2024, Ronoh and Contributors
 # See license.txt
 
-# import frappe
+import json
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, add_to_date, get_datetime, now_datetime
+
+from erpnext.accounts.doctype.pos_invoice.test_pos_invoice import create_pos_invoice
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.bench_fiscalization import make_invoice, set_settings, use_device
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.benchmarks.stub_device import StubDevice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.custom import pos_invoice, sales_invoice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils import fiscal_queue
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.backfill import Backfill
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.fiscal_queue import (
+	RETRY_BASE_DELAY,
+	RETRY_MAX_DELAY,
+	_fail,
+	claim_invoice,
+	claim_queued_rows,
+	get_next_retry_at,
+	process_failed_queue,
+	process_fiscal_batch,
+	run_dispatcher,
+)
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.queue_stats import get_queue_stats, reconcile_queue_stats
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.write_back import write_fiscal_results
+
+
+def make_queue_row(invoice, status="Queued", invoice_type="Sales Invoice"):
+	"""Fiscal Queue row for an invoice that does not exist"""
+	row = frappe.get_doc({"doctype": "Fiscal Queue", "invoice_type": invoice_type, "invoice": invoice, "status": status})
+	row.flags.ignore_links = True
+	return row.insert()
 
 
 class TestFiscalQueue(FrappeTestCase):
-	pass
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		# Enough finished rows that a table scan is clearly worse than the indexes
+		now = now_datetime()
+		frappe.db.bulk_insert(
+			"Fiscal Queue",
+			["name", "invoice", "status", "retry_count", "creation", "modified"],
+			[
+				(f"_T-FQ-{i}", f"_T-SINV-{i}", "Completed", 0, now, add_to_date(now, days=-(i % 30)))
+				for i in range(500)
+			],
+		)
+
+	def explain(self, query, values=None):
+		return frappe.db.sql(f"explain {query}", values, as_dict=True)[0]
+
+	def leading_indexes(self, index):
+		"""Every index that starts with the same column as `index`, any of them can answer its lookups"""
+		indexes = frappe.db.sql("show index from `tabFiscal Queue`", as_dict=True)
+		column = next(row.Column_name for row in indexes if row.Key_name == index and row.Seq_in_index == 1)
+		return {row.Key_name for row in indexes if row.Column_name == column and row.Seq_in_index == 1}
+
+	def assertPlanImproved(self, query, index, values=None):
+		competing = self.leading_indexes(index)
+		others = competing - {index}
+		# Baseline without any index on the leading column, then with only the index under test
+		before = self.explain(query.format(hint=_ignore(competing)), values)
+		after = self.explain(query.format(hint=_ignore(others) if others else ""), values)
+		self.assertEqual(before.type, "ALL")
+		self.assertEqual(after.key, index)
+		self.assertLess(after.rows, before.rows)
+
+	def test_active_row_lookup_plan(self):
+		self.assertPlanImproved(
+			"""select name from `tabFiscal Queue` {hint}
+			where invoice = %s and status in ('Queued', 'Processing')""",
+			"invoice_status_index",
+			("_T-SINV-7",),
+		)
+
+	def test_due_retry_scan_plan(self):
+		self.assertPlanImproved(
+			"""select name from `tabFiscal Queue` {hint}
+			where status = 'Failed' and next_retry_at <= %s""",
+			"status_next_retry_at_index",
+			(now_datetime(),),
+		)
+
+	def test_one_active_row_per_invoice(self):
+		make_queue_row("_T-SINV-1", "Queued")
+		with self.assertRaises(frappe.UniqueValidationError):
+			make_queue_row("_T-SINV-1", "Processing")
+
+		# Finished rows never block a new attempt
+		make_queue_row("_T-SINV-2", "Failed")
+		make_queue_row("_T-SINV-2", "Queued")
+
+		# A POS Invoice may share its name with a Sales Invoice
+		make_queue_row("_T-SINV-1", "Queued", invoice_type="POS Invoice")
+
+	def test_claim_attaches_to_active_attempt(self):
+		# claim_invoice inserts the row itself, so it needs an invoice that exists
+		invoice = make_invoice().name
+		row, claimed = claim_invoice(invoice, "Processing")
+		self.assertTrue(claimed)
+
+		# A second entry point attaches instead of opening another row
+		self.assertEqual(claim_invoice(invoice), (row.name, False))
+		self.assertEqual(frappe.db.count("Fiscal Queue", {"invoice": invoice}), 1)
+
+		# Once the attempt has finished a new one can start
+		row.db_set("status", "Failed")
+		self.assertTrue(claim_invoice(invoice)[1])
+
+	def test_write_back_completes_many_rows(self):
+		rows = [make_queue_row(f"_T-SINV-WB-{i}", "Processing") for i in range(3)]
+		write_fiscal_results(
+			[(row.invoice, row.name, {"cu_invoice_number": f"CU-{i}", "verify_url": "u"}) for i, row in enumerate(rows)]
+		)
+
+		for i, row in enumerate(rows):
+			row.reload()
+			self.assertEqual(row.status, "Completed")
+			self.assertEqual(row.response, f'{{"cu_invoice_number":"CU-{i}","verify_url":"u"}}')
+			self.assertTrue(row.completion_time)
+
+	def test_retry_backoff_doubles_with_jitter(self):
+		for retry_count, delay in ((0, RETRY_BASE_DELAY), (1, RETRY_BASE_DELAY * 2), (2, RETRY_BASE_DELAY * 4), (20, RETRY_MAX_DELAY)):
+			before = now_datetime()
+			seconds = (get_next_retry_at(retry_count) - before).total_seconds()
+			# Equal jitter: somewhere in the second half of the delay
+			self.assertGreaterEqual(seconds, delay / 2)
+			self.assertLessEqual(seconds, delay + 1)
+
+	def test_backfill_resumes_from_checkpoint(self):
+		backfill = Backfill(from_date="2024-01-01", company="_Test Company", name="_test_backfill")
+		backfill.load_checkpoint(restart=True)
+		backfill.state.update(last_posting_date="2024-01-02", last_name="_T-SINV-0002", completed=2)
+		backfill.save_checkpoint()
+
+		resumed = Backfill(from_date="2024-01-01", company="_Test Company", name="_test_backfill")
+		self.assertEqual(resumed.load_checkpoint()["last_name"], "_T-SINV-0002")
+		conditions, values = resumed.get_conditions()
+		self.assertIn("name > %(last_name)s", conditions)
+		self.assertEqual(values["last_posting_date"], "2024-01-02")
+
+		with self.assertRaises(frappe.ValidationError):
+			Backfill(from_date="2024-02-01", name="_test_backfill").load_checkpoint()
+
+	def test_queue_counters_follow_transitions(self):
+		counts, _oldest = reconcile_queue_stats()
+		frappe.db.after_commit.reset()
+
+		queued = make_queue_row("_T-SINV-QS-1", "Queued")
+		processing = make_queue_row("_T-SINV-QS-2", "Processing")
+		_fail(processing.name, processing.invoice, 0, Exception("device error"), commit=False)
+		# Normally run by the commit, which a test never makes
+		frappe.db.after_commit.run()
+
+		after, oldest = get_queue_stats()
+		self.assertEqual(after["Queued"], counts["Queued"] + 1)
+		self.assertEqual(after["Processing"], counts["Processing"])
+		self.assertEqual(after["Failed"], counts["Failed"] + 1)
+		self.assertLessEqual(oldest.timestamp(), get_datetime(queued.creation).timestamp() + 0.001)
+
+		# Reconcile agrees with the incremental counters
+		self.assertEqual(reconcile_queue_stats()[0], after)
+
+
+
+class TestFiscalQueueDispatcher(FrappeTestCase):
+	"""Claims commit, so these tests leave nothing behind in the committed tables"""
+
+	def setUp(self):
+		self.addCleanup(frappe.db.commit)
+
+	def make_rows(self, prefix, count):
+		"""Queued rows older than any other on the site, oldest first, for invoices that do not exist"""
+		created = add_days(now_datetime(), -20000)
+		names = [f"{prefix}-{i}" for i in range(count)]
+		frappe.db.bulk_insert(
+			"Fiscal Queue",
+			["name", "invoice_type", "invoice", "status", "retry_count", "creation", "modified"],
+			[
+				(name, "Sales Invoice", f"{name}-SINV", "Queued", 0, add_to_date(created, seconds=i), add_to_date(created, seconds=i))
+				for i, name in enumerate(names)
+			],
+		)
+		self.addCleanup(frappe.db.delete, "Fiscal Queue", {"name": ["in", names]})
+		return names
+
+	def test_claims_oldest_rows_first(self):
+		names = self.make_rows("_T-FQD-FIFO", 3)
+
+		self.assertEqual([row.name for row in claim_queued_rows(2)], names[:2])
+		self.assertEqual(
+			[frappe.db.get_value("Fiscal Queue", name, "status") for name in names],
+			["Processing", "Processing", "Queued"],
+		)
+		# Claimed rows are not handed out twice
+		self.assertEqual([row.name for row in claim_queued_rows(1)], names[2:])
+
+	def test_batch_hands_rows_back_while_circuit_open(self):
+		names = self.make_rows("_T-FQD-OPEN", 2)
+
+		with StubDevice() as device, use_device(device):
+			breaker = get_fiscal_settings().get_circuit_breaker()
+			for _i in range(breaker.failure_threshold):
+				breaker.record_failure()
+			try:
+				stats = process_fiscal_batch(limit=2)
+			finally:
+				breaker.record_success()
+
+		self.assertEqual((stats.claimed, stats.skipped), (2, 2))
+		self.assertEqual(device.get_stats()["signed"], 0)
+		for name in names:
+			# Handed back without using up a retry
+			self.assertEqual(frappe.db.get_value("Fiscal Queue", name, ["status", "retry_count"]), ("Queued", 0))
+
+	def make_failed_rows(self, prefix, invoices, days_due):
+		"""Failed rows whose retry fell due `days_due` days ago, negative for retries still ahead"""
+		names = [f"{prefix}-{i}" for i in range(len(invoices))]
+		now = now_datetime()
+		frappe.db.bulk_insert(
+			"Fiscal Queue",
+			["name", "invoice_type", "invoice", "status", "retry_count", "next_retry_at", "creation", "modified"],
+			[
+				(name, "Sales Invoice", invoice, "Failed", 1, add_to_date(now, days=-days, seconds=i), now, now)
+				for i, (name, invoice, days) in enumerate(zip(names, invoices, days_due))
+			],
+		)
+		self.addCleanup(frappe.db.delete, "Fiscal Queue", {"name": ["in", names]})
+		return names
+
+	def process_failed_queue(self, batch_size):
+		"""Run a sweep that may release `batch_size` rows whatever else is Queued on the site"""
+		backlog = reconcile_queue_stats()[0]["Queued"]
+		with (
+			patch.object(fiscal_queue, "RETRY_BATCH_SIZE", backlog + batch_size),
+			patch.object(fiscal_queue, "start_dispatcher") as start_dispatcher,
+		):
+			process_failed_queue()
+		return start_dispatcher
+
+	def test_retry_sweep_releases_oldest_due_rows(self):
+		names = self.make_failed_rows(
+			"_T-FQD-RETRY",
+			["_T-SINV-RETRY-0", "_T-SINV-RETRY-1", "_T-SINV-RETRY-2", "_T-SINV-RETRY-3"],
+			[20000, 19999, 19998, -1],
+		)
+
+		start_dispatcher = self.process_failed_queue(batch_size=2)
+
+		# Bounded to the batch, oldest due first, retries still ahead are left alone
+		statuses = [frappe.db.get_value("Fiscal Queue", name, ["status", "next_retry_at"]) for name in names]
+		self.assertEqual([status for status, _next_retry_at in statuses], ["Queued", "Queued", "Failed", "Failed"])
+		self.assertIsNone(statuses[0][1])
+		self.assertTrue(statuses[2][1])
+		self.assertGreater(get_datetime(statuses[3][1]), now_datetime())
+		start_dispatcher.assert_called_once()
+
+	def test_retry_sweep_keeps_one_active_row_per_invoice(self):
+		names = self.make_failed_rows("_T-FQD-DUP", ["_T-SINV-DUP-0", "_T-SINV-DUP-0"], [20000, 19999])
+
+		self.process_failed_queue(batch_size=2)
+
+		# The second row would break the unique key, it is skipped instead of aborting the sweep
+		self.assertEqual(
+			[frappe.db.get_value("Fiscal Queue", name, ["status", "next_retry_at"]) for name in names],
+			[("Queued", None), ("Failed", None)],
+		)
+
+	def test_dispatcher_stops_claiming_while_circuit_open(self):
+		names = self.make_rows("_T-FQD-DOWN", 3)
+
+		with StubDevice() as device, use_device(device):
+			breaker = get_fiscal_settings().get_circuit_breaker()
+			for _i in range(breaker.failure_threshold):
+				breaker.record_failure()
+			try:
+				with patch.object(fiscal_queue, "claim_queued_rows", wraps=claim_queued_rows) as claim:
+					run_dispatcher()
+			finally:
+				breaker.record_success()
+
+		# The only device is down after the first claim, the backlog is not walked
+		self.assertEqual(claim.call_count, 1)
+		self.assertEqual(device.get_stats()["signed"], 0)
+		for name in names:
+			self.assertEqual(frappe.db.get_value("Fiscal Queue", name, ["status", "retry_count"]), ("Queued", 0))
+
+	def submit_within_budget(self, budget):
+		"""Run the Sales Invoice submit hook in Budgeted mode on a draft, returns the invoice and its row"""
+		set_settings(fiscalize_invoices_on_submit=1, submit_mode="Budgeted", submit_latency_budget=budget)
+		invoice = make_invoice()
+		self.addCleanup(frappe.delete_doc, "Sales Invoice", invoice.name, force=True)
+
+		with patch.object(sales_invoice, "start_dispatcher") as start_dispatcher:
+			sales_invoice.on_submit(invoice, "on_submit")
+
+		row = frappe.db.get_value(
+			"Fiscal Queue", {"invoice_type": "Sales Invoice", "invoice": invoice.name}, ["name", "status", "retry_count"],
+			as_dict=True
+		)
+		self.addCleanup(frappe.db.delete, "Fiscal Queue", {"name": row.name})
+		return invoice, row, start_dispatcher
+
+	def test_budgeted_submit_signs_within_budget(self):
+		with StubDevice() as device, use_device(device):
+			get_fiscal_settings().get_circuit_breaker().record_success()
+			invoice, row, start_dispatcher = self.submit_within_budget(budget=2)
+
+		# Signed during submit, on the invoice being submitted and in the database
+		self.assertEqual(device.get_stats()["signed"], 1)
+		self.assertTrue(invoice.custom_is_fiscalized)
+		self.assertEqual(
+			frappe.db.get_value("Sales Invoice", invoice.name, "custom_fiscal_invoice_number"),
+			invoice.custom_fiscal_invoice_number,
+		)
+		self.assertEqual(row.status, "Completed")
+		start_dispatcher.assert_not_called()
+
+	def test_budgeted_submit_queues_when_budget_runs_out(self):
+		with StubDevice(latency=2) as device, use_device(device):
+			breaker = get_fiscal_settings().get_circuit_breaker()
+			breaker.record_success()
+			try:
+				invoice, row, start_dispatcher = self.submit_within_budget(budget=0.6)
+			finally:
+				breaker.record_success()
+
+			# The slow device is not waited for, the claimed row becomes the queued attempt
+			self.assertFalse(invoice.custom_is_fiscalized)
+			self.assertEqual((row.status, row.retry_count), ("Queued", 0))
+			start_dispatcher.assert_called_once()
+
+			# The dispatcher then signs it like any queued invoice
+			device.latency = 0
+			run_dispatcher()
+
+		self.assertEqual(frappe.db.get_value("Fiscal Queue", row.name, "status"), "Completed")
+		self.assertTrue(frappe.db.get_value("Sales Invoice", invoice.name, "custom_is_fiscalized"))
+
+	def test_pos_ticket_queued_at_submit_and_written_back(self):
+		with StubDevice() as device, use_device(device):
+			set_settings(fiscalize_pos_invoices=1)
+			get_fiscal_settings().get_circuit_breaker().record_success()
+			# A draft runs the same hook without stock or ledger entries to clean up
+			ticket = create_pos_invoice(rate=100, do_not_submit=1)
+			# The helper makes a POS Profile, committed with the claim below
+			self.addCleanup(frappe.delete_doc, "POS Profile", ticket.pos_profile, force=True)
+			self.addCleanup(frappe.delete_doc, "POS Invoice", ticket.name, force=True)
+
+			with patch.object(fiscal_queue, "start_dispatcher") as start_dispatcher:
+				pos_invoice.on_submit(ticket, "on_submit")
+			start_dispatcher.assert_called_once()
+
+			row = frappe.db.get_value(
+				"Fiscal Queue", {"invoice_type": "POS Invoice", "invoice": ticket.name}, ["name", "status"], as_dict=True
+			)
+			self.addCleanup(frappe.db.delete, "Fiscal Queue", {"name": row.name})
+			self.assertEqual(row.status, "Queued")
+
+			run_dispatcher()
+
+		self.assertEqual(frappe.db.get_value("Fiscal Queue", row.name, "status"), "Completed")
+		fiscalized, number = frappe.db.get_value(
+			"POS Invoice", ticket.name, ["custom_is_fiscalized", "custom_fiscal_invoice_number"]
+		)
+		self.assertTrue(fiscalized)
+		self.assertTrue(number)
+
+	def test_dispatcher_signs_in_queue_order(self):
+		with StubDevice(serial=True) as device, use_device(device):
+			get_fiscal_settings().get_circuit_breaker().record_success()
+			# Drafts carry everything the payload needs, and unlike submitted invoices leave no ledger entries
+			queued = []
+			for _i in range(3):
+				invoice = make_invoice()
+				self.addCleanup(frappe.delete_doc, "Sales Invoice", invoice.name, force=True)
+				queued.append(make_queue_row(invoice.name).name)
+			self.addCleanup(frappe.db.delete, "Fiscal Queue", {"name": ["in", queued]})
+			run_dispatcher()
+
+		rows = frappe.get_all(
+			"Fiscal Queue",
+			filters={"name": ["in", queued]},
+			fields=["invoice", "status", "response"],
+			order_by="creation asc",
+		)
+		self.assertEqual([row.status for row in rows], ["Completed"] * 3)
+		# One request in flight on a serial device: numbers follow the queue order
+		numbers = [json.loads(row.response)["cu_invoice_number"] for row in rows]
+		self.assertEqual(numbers, sorted(numbers))
+		for row in rows:
+			self.assertTrue(frappe.db.get_value("Sales Invoice", row.invoice, "custom_is_fiscalized"))
+
+
+def _ignore(indexes):
+	return "ignore index ({})".format(", ".join(f"`{index}`" for index in sorted(indexes)))
@@ -0,0 +1,52 @@
+# Copyright (c) 2026, Ronoh and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, now_datetime
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.archive import archive_chunk
+
+
+class TestFiscalQueueArchive(FrappeTestCase):
+	def setUp(self):
+		# archive_chunk commits, so the rows are removed and that committed once the test is done
+		self.addCleanup(frappe.db.commit)
+
+	def make_row(self, name, status, days_ago):
+		completion_time = add_days(now_datetime(), -days_ago)
+		frappe.db.bulk_insert(
+			"Fiscal Queue",
+			["name", "invoice_type", "invoice", "status", "response", "completion_time", "creation", "modified"],
+			[(
+				name, "Sales Invoice", f"{name}-SINV", status,
+				'{"cu_invoice_number":"CU-%s","verify_url":"https://verify/%s"}' % (name, name),
+				completion_time, completion_time, completion_time,
+			)],
+		)
+		self.addCleanup(frappe.db.delete, "Fiscal Queue", {"name": name})
+		self.addCleanup(frappe.db.delete, "Fiscal Queue Archive", {"name": name})
+
+	def test_old_completed_rows_are_moved(self):
+		# Older than anything else on the site, so the chunk picks these first
+		self.make_row("_T-FQA-OLD", "Completed", 20000)
+		self.make_row("_T-FQA-RECENT", "Completed", 1)
+		self.make_row("_T-FQA-FAILED", "Failed", 20000)
+
+		self.assertEqual(archive_chunk(add_days(now_datetime(), -10000)), 1)
+
+		archived = frappe.db.get_value(
+			"Fiscal Queue Archive", "_T-FQA-OLD", ["invoice", "cu_invoice_number", "verify_url"], as_dict=True
+		)
+		self.assertEqual(archived.invoice, "_T-FQA-OLD-SINV")
+		self.assertEqual(archived.cu_invoice_number, "CU-_T-FQA-OLD")
+		self.assertEqual(archived.verify_url, "https://verify/_T-FQA-OLD")
+		self.assertFalse(frappe.db.exists("Fiscal Queue", "_T-FQA-OLD"))
+
+		# Recent and unfinished rows stay in the live queue
+		for name in ("_T-FQA-RECENT", "_T-FQA-FAILED"):
+			self.assertTrue(frappe.db.exists("Fiscal Queue", name))
+			self.assertFalse(frappe.db.exists("Fiscal Queue Archive", name))
+
+		# Nothing is left to move
+		self.assertEqual(archive_chunk(add_days(now_datetime(), -10000)), 0)
@@ -1,9 +1,82 @@
 # Copyright (c) 2024, Ronoh and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.payload import build_items_list
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import invalidate_fiscal_settings
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.vat import clear_vat_index, get_fiscal_codes, resolve_vat
+
+VAT_ACCOUNT = "_Test Account VAT - _TC"
+
 
 class TestFiscalVATRate(FrappeTestCase):
-	pass
+	def test_fiscal_codes_by_rate(self):
+		settings = frappe._dict(
+			vat_rates=[
+				frappe._dict(tax_rate="16%", fiscal_code="A"),
+				frappe._dict(tax_rate="8", fiscal_code="B"),
+				frappe._dict(tax_rate="0", fiscal_code=""),
+			]
+		)
+		self.assertEqual(get_fiscal_codes(settings), {16.0: "A", 8.0: "B"})
+
+	def use_vat_account(self):
+		"""Point the settings at the test VAT account for this test, rolled back afterwards"""
+		self.addCleanup(clear_vat_index)
+		self.addCleanup(invalidate_fiscal_settings)
+		self.addCleanup(frappe.db.rollback)
+		frappe.db.after_commit.reset()
+		frappe.db.set_single_value("Fiscal Device Settings", "vat_account", VAT_ACCOUNT)
+		invalidate_fiscal_settings()
+		clear_vat_index()
+
+	def make_template(self, rate):
+		return frappe.get_doc({
+			"doctype": "Item Tax Template",
+			"title": f"_Test Fiscal VAT {rate}",
+			"company": "_Test Company",
+			"taxes": [{"tax_type": VAT_ACCOUNT, "tax_rate": rate}],
+		}).insert()
+
+	def test_vat_index_resolves_invoice_items(self):
+		self.use_vat_account()
+		template = self.make_template(8)
+		frappe.db.after_commit.run()
+
+		self.assertEqual(
+			resolve_vat([template.name, None, "_Test Missing Template"]),
+			[(8.0, ""), (16, ""), (16, "")],
+		)
+
+	def test_vat_index_cleared_after_template_change_commits(self):
+		self.use_vat_account()
+		template = self.make_template(8)
+		frappe.db.after_commit.run()
+		self.assertEqual(resolve_vat([template.name])[0][0], 8)
+
+		template.taxes[0].tax_rate = 0
+		template.save()
+		# Other workers cannot see the new rate before the commit, the index is kept until then
+		self.assertEqual(resolve_vat([template.name])[0][0], 8)
+
+		frappe.db.after_commit.run()
+		self.assertEqual(resolve_vat([template.name])[0][0], 0)
+
+	def test_only_lines_off_the_default_rate_carry_hs_codes(self):
+		self.use_vat_account()
+		exempt = self.make_template(0)
+		frappe.db.after_commit.run()
+
+		columns = frappe._dict(
+			item_code=["_T-STD", "_T-EXEMPT"],
+			item_name=["Bread", "Milk"],
+			qty=[1, 2],
+			amount=[50, 120],
+			item_tax_template=[None, exempt.name],
+		)
+		self.assertEqual(
+			build_items_list(columns, hs_codes={"_T-STD": "1905.90.00", "_T-EXEMPT": "0401.20.00"}),
+			[" Bread 1.00 50.00 50.00", " 0401.20.00Milk 2.00 60.00 120.00"],
+		)
@@ -0,0 +1,92 @@
+import json
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import add_days, cint, now_datetime
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.queue_stats import track
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings
+
+# Rows moved per transaction, small enough that locks on the live queue are held briefly
+CHUNK_SIZE = 500
+# Stop after this many seconds, the next daily run picks up the rest
+MAX_RUNTIME = 600
+# Pause between chunks so signing and claims can get at the table
+CHUNK_PAUSE = 0.2
+
+def archive_completed_queue():
+    """
+    Move Completed Fiscal Queue rows older than the configured age into Fiscal Queue Archive,
+    keeping only the fields needed for lookups
+    """
+    days = cint(get_fiscal_settings().archive_completed_after_days)
+    if days <= 0:
+        return
+
+    cutoff = add_days(now_datetime(), -days)
+    deadline = time.monotonic() + MAX_RUNTIME
+    archived = 0
+
+    while time.monotonic() < deadline:
+        moved = archive_chunk(cutoff)
+        archived += moved
+        if moved < CHUNK_SIZE:
+            break
+        time.sleep(CHUNK_PAUSE)
+
+    if archived:
+        frappe.logger().info(f"Archived {archived} completed Fiscal Queue rows older than {cutoff}")
+
+def archive_chunk(cutoff, limit=CHUNK_SIZE):
+    """Archive and delete one chunk of Completed rows in a single transaction"""
+    rows = frappe.get_all(
+        "Fiscal Queue",
+        filters={"status": "Completed", "completion_time": ["<", cutoff]},
+        fields=["name", "invoice_type", "invoice", "response", "completion_time"],
+        order_by="completion_time asc",
+        limit=limit
+    )
+    if not rows:
+        return 0
+
+    now = now_datetime()
+    values = []
+    for row in rows:
+        response = _parse_response(row.response)
+        values.append((
+            row.name,
+            row.invoice_type or "Sales Invoice",
+            row.invoice,
+            response.get("cu_invoice_number"),
+            response.get("verify_url"),
+            row.completion_time,
+            now,
+            now,
+            "Administrator",
+            "Administrator"
+        ))
+
+    try:
+        frappe.db.bulk_insert(
+            "Fiscal Queue Archive",
+            ["name", "invoice_type", "invoice", "cu_invoice_number", "verify_url", "completion_time",
+                "creation", "modified", "owner", "modified_by"],
+            values,
+            ignore_duplicates=True
+        )
+        frappe.db.delete("Fiscal Queue", {"name": ["in", [row.name for row in rows]]})
+        track([row.name for row in rows], "Completed", None)
+        frappe.db.commit()
+    except Exception:
+        frappe.db.rollback()
+        frappe.log_error(title=_("Failed to Archive Fiscal Queue"))
+        raise
+
+    return len(rows)
+
+def _parse_response(response):
+    try:
+        return frappe._dict(json.loads(response or "{}"))
+    except ValueError:
+        return frappe._dict()
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import time
+from datetime import timedelta
+
+import frappe
+from frappe import _
+from frappe.utils import cint
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_client import CONNECT_TIMEOUT, READ_TIMEOUT
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.metrics import observe
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.replay import get_replayed_response, payload_digest
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.signer import SignAttempts
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.trace import finish_trace, start_trace
+
+# Largest response header block accepted from a device
+MAX_HEADER_LINES = 100
+# Largest response body accepted from a device, a signing answer is a few hundred bytes of JSON
+MAX_BODY_SIZE = 64 * 1024
+
+
+class DeviceTransportError(Exception):
+    """The device could not be reached or answered with something that is not HTTP"""
+
+
+class AsyncResponse:
+    """The parts of a requests.Response that the signing code reads"""
+
+    def __init__(self, status_code, body, elapsed):
+        self.status_code = status_code
+        self.content = body
+        self.elapsed = elapsed
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncDeviceClient:
+    """
+    Keep-alive HTTP/1.1 client for one fiscal device on an asyncio event loop.
+    At most `max_in_flight` requests are open at a time, each on its own connection,
+    idle connections are reused by the next request.
+    """
+
+    def __init__(self, device_ip, port, bearer_token, max_in_flight=1):
+        self.host = device_ip
+        self.port = cint(port)
+        self.bearer_token = bearer_token or ""
+        self.window = asyncio.Semaphore(max(cint(max_in_flight), 1))
+        self._idle = []
+
+    async def sign(self, payload, is_inclusive=True, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        """POST a payload to the device signing endpoint and return the response"""
+        endpoint = "invoice+1" if is_inclusive else "invoice+2"
+        body = json.dumps(payload).encode()
+        request = (
+            f"POST /api/sign?{endpoint} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Authorization: {self.bearer_token}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n"
+            "\r\n"
+        ).encode() + body
+
+        async with self.window:
+            started = time.perf_counter()
+            reader, writer = await self._connect(connect_timeout)
+            try:
+                writer.write(request)
+                await asyncio.wait_for(writer.drain(), read_timeout)
+                status, headers, content = await asyncio.wait_for(_read_response(reader), read_timeout)
+            except BaseException:
+                # Timed out, cancelled or broken: the connection state is unknown, never reuse it
+                writer.close()
+                raise
+
+            if headers.get("connection", "").lower() == "close":
+                writer.close()
+            else:
+                self._idle.append((reader, writer))
+
+            return AsyncResponse(status, content, timedelta(seconds=time.perf_counter() - started))
+
+    async def _connect(self, connect_timeout):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(self.host, self.port), connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise DeviceTransportError(f"Could not connect to {self.host}:{self.port}: {e!r}") from e
+
+    async def close(self):
+        for _reader, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+
+async def _read_response(reader):
+    """
+    Read one HTTP/1.1 response: status line, headers, then a Content-Length, chunked or read-to-close body.
+    Control units answer a single POST with a small JSON body, and this subset is all they speak.
+    Reading it off asyncio streams keeps the app on the standard library instead of adding an
+    async HTTP client that bench would have to install on every site for one endpoint.
+    Returns (status, headers, body). A response cut short raises asyncio.IncompleteReadError,
+    a body over MAX_BODY_SIZE raises DeviceTransportError.
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise DeviceTransportError("Device closed the connection without answering")
+
+    parts = status_line.decode("latin-1").split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+        raise DeviceTransportError(f"Invalid status line from device: {status_line!r}")
+
+    headers = {}
+    for _i in range(MAX_HEADER_LINES):
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _sep, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise DeviceTransportError("Too many response headers from device")
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        content = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+            if not size:
+                await reader.readline()
+                break
+            _check_body_size(len(content) + size)
+            content += await reader.readexactly(size)
+            await reader.readline()
+    elif "content-length" in headers:
+        length = headers["content-length"]
+        if not length.isdigit():
+            raise DeviceTransportError(f"Invalid Content-Length from device: {length!r}")
+        _check_body_size(int(length))
+        content = await reader.readexactly(int(length))
+    else:
+        content = b""
+        while not reader.at_eof():
+            content += await reader.read(MAX_BODY_SIZE)
+            _check_body_size(len(content))
+        headers["connection"] = "close"
+
+    return int(parts[1]), headers, content
+
+def _check_body_size(size):
+    if size > MAX_BODY_SIZE:
+        raise DeviceTransportError(f"Response from device exceeds {MAX_BODY_SIZE} bytes")
+
+
+class AsyncDevicePool:
+    """One AsyncDeviceClient per device for the lifetime of an event loop"""
+
+    def __init__(self):
+        self.clients = {}
+
+    def get_client(self, device):
+        client = self.clients.get(device.name)
+        if client is None:
+            client = self.clients[device.name] = AsyncDeviceClient(
+                device.device_ip, device.port, device.bearer_token, device.get_max_in_flight()
+            )
+        return client
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+async def sign_invoice_async(pool, device, invoice_data, is_inclusive=True, retries=3, timeout=None):
+    """
+    Same contract as FiscalSigner.sign_invoice: the device response dict,
+    or an exception, CircuitOpenError when the device is unavailable
+    """
+    if not device.is_enabled():
+        frappe.throw(_("Fiscal Device is not enabled"))
+
+    if not device.device_ip or not device.port:
+        frappe.throw(_("Device IP and Port must be configured"))
+
+    digest = payload_digest(invoice_data)
+    replayed = get_replayed_response(invoice_data, digest)
+    if replayed is not None:
+        return replayed
+
+    trace = start_trace(device, invoice_data)
+    try:
+        response = await _sign(pool, device, invoice_data, digest, is_inclusive, retries, timeout, trace)
+    except Exception as e:
+        finish_trace(trace, error=e)
+        raise
+    finish_trace(trace, response=response)
+    return response
+
+async def _sign(pool, device, invoice_data, digest, is_inclusive, retries, timeout, trace):
+    client = pool.get_client(device)
+    attempts = SignAttempts(device, invoice_data, digest, retries, timeout, trace)
+
+    started = time.perf_counter()
+    try:
+        for timeouts in attempts:
+            try:
+                response = await client.sign(invoice_data, is_inclusive=is_inclusive, **timeouts)
+            except (DeviceTransportError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                # Connect timeouts surface as DeviceTransportError, a TimeoutError here was the read
+                attempts.transport_error(e, timeouts, timed_out=isinstance(e, asyncio.TimeoutError))
+                continue
+
+            response_data = attempts.answer(response)
+            if response_data is not None:
+                return response_data
+
+        attempts.exhausted()
+    finally:
+        observe("sign", (time.perf_counter() - started) * 1000, device.name)
+
+async def sign_many_async(requests, retries=3, timeout=None):
+    """
+    Sign (device, payload) pairs concurrently, each device within its own in-flight window.
+    Returns a list in the same order holding each response or the exception it raised.
+    """
+    async with AsyncDevicePool() as pool:
+        return await asyncio.gather(
+            *(sign_invoice_async(pool, device, payload, retries=retries, timeout=timeout) for device, payload in requests),
+            return_exceptions=True
+        )
+
+def sign_many(requests, retries=3, timeout=None):
+    """Synchronous entry point for sign_many_async, for code that is not running an event loop"""
+    return asyncio.run(sign_many_async(requests, retries=retries, timeout=timeout))
+
+def sign_invoice(device, invoice_data, is_inclusive=True, retries=3, timeout=None):
+    """Synchronous single-invoice wrapper with the contract of FiscalSigner.sign_invoice"""
+    async def run():
+        async with AsyncDevicePool() as pool:
+            return await sign_invoice_async(pool, device, invoice_data, is_inclusive, retries, timeout)
+
+    return asyncio.run(run())
@@ -0,0 +1,232 @@
+import json
+import os
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt, getdate, now_datetime
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.doctype.fiscal_queue.fiscal_queue import ACTIVE_STATUSES
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.circuit_breaker import CircuitOpenError
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_pool import route_invoice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.fiscal_queue import _fail, _prepare, _requeue, claim_invoice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.invoice_loader import load_invoices
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.write_back import write_fiscal_result
+
+# Invoices read and committed per round trip, the candidate set is never held in memory
+BATCH_SIZE = 100
+# Default pace against the device, in invoices per second
+DEFAULT_RATE = 2
+# Seconds between progress lines
+PROGRESS_EVERY = 10
+
+CHECKPOINT_FOLDER = "fiscal_backfill"
+
+
+class Backfill:
+    """
+    Fiscalize submitted invoices that were never signed, oldest first, at a fixed rate.
+    Progress is checkpointed to a JSON file under the site's private folder after every
+    batch, so an interrupted run resumes after the last invoice it committed.
+    """
+
+    def __init__(self, from_date=None, to_date=None, company=None, naming_series=None,
+            rate=None, batch_size=None, name=None, echo=print):
+        self.filters = {
+            "from_date": str(getdate(from_date)) if from_date else None,
+            "to_date": str(getdate(to_date)) if to_date else None,
+            "company": company,
+            "naming_series": naming_series,
+        }
+        self.rate = DEFAULT_RATE if rate is None else flt(rate)
+        self.batch_size = cint(batch_size) or BATCH_SIZE
+        self.name = name or frappe.scrub("-".join(str(value) for value in self.filters.values() if value) or "all")
+        self.echo = echo
+        self.state = None
+
+    @property
+    def checkpoint_path(self):
+        return frappe.get_site_path("private", CHECKPOINT_FOLDER, f"{self.name}.json")
+
+    def load_checkpoint(self, restart=False):
+        """Resume from the checkpoint for the same filters, or start over"""
+        state = None
+        if not restart and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                state = json.load(f)
+            if state.get("filters") != self.filters:
+                frappe.throw(_("Checkpoint {0} was written for other filters, restart it or choose another name")
+                    .format(self.checkpoint_path))
+
+        self.state = state or {
+            "filters": self.filters,
+            "last_posting_date": None,
+            "last_name": None,
+            "completed": 0,
+            "failed": 0,
+            "skipped": 0,
+            "started": str(now_datetime()),
+        }
+        return self.state
+
+    def save_checkpoint(self):
+        os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+        self.state["updated"] = str(now_datetime())
+        # Write aside and rename, an interrupt never leaves a truncated checkpoint behind
+        temp_path = f"{self.checkpoint_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def get_conditions(self, after=True):
+        conditions = [
+            "docstatus = 1",
+            "is_return = 0",
+            "ifnull(custom_is_fiscalized, 0) = 0",
+        ]
+        if get_fiscal_settings().fiscalize_pos_invoices:
+            # Their POS Invoices are signed instead
+            conditions.append("is_consolidated = 0")
+        values = dict(self.filters)
+        if self.filters["from_date"]:
+            conditions.append("posting_date >= %(from_date)s")
+        if self.filters["to_date"]:
+            conditions.append("posting_date <= %(to_date)s")
+        if self.filters["company"]:
+            conditions.append("company = %(company)s")
+        if self.filters["naming_series"]:
+            conditions.append("naming_series = %(naming_series)s")
+
+        if after and self.state["last_name"]:
+            # Keyset on (posting_date, name), each batch seeks past the last one instead of using an offset
+            conditions.append(
+                "(posting_date > %(last_posting_date)s or (posting_date = %(last_posting_date)s and name > %(last_name)s))"
+            )
+            values.update(last_posting_date=self.state["last_posting_date"], last_name=self.state["last_name"])
+
+        return " and ".join(conditions), values
+
+    def count_remaining(self):
+        conditions, values = self.get_conditions()
+        return frappe.db.sql(f"select count(*) from `tabSales Invoice` where {conditions}", values)[0][0]
+
+    def next_batch(self):
+        conditions, values = self.get_conditions()
+        return frappe.db.sql(f"""
+            select name, posting_date
+            from `tabSales Invoice`
+            where {conditions}
+            order by posting_date asc, name asc
+            limit {self.batch_size}
+        """, values, as_dict=True)
+
+    def run(self, restart=False):
+        fiscal_settings = get_fiscal_settings()
+        if not fiscal_settings.enable_device:
+            frappe.throw(_("Fiscal Device is not enabled in settings"))
+
+        self.load_checkpoint(restart=restart)
+        total = self.count_remaining()
+        self.echo(f"{total} invoices to fiscalize, checkpoint {self.checkpoint_path}")
+
+        interval = 1 / self.rate if self.rate > 0 else 0
+        started = time.monotonic()
+        next_send = started
+        last_progress = started
+        done = 0
+
+        try:
+            while True:
+                batch = self.next_batch()
+                if not batch:
+                    break
+
+                invoices = load_invoices([row.name for row in batch])
+                active = set(frappe.get_all(
+                    "Fiscal Queue",
+                    filters={
+                        "invoice_type": "Sales Invoice",
+                        "invoice": ["in", [row.name for row in batch]],
+                        "status": ["in", ACTIVE_STATUSES]
+                    },
+                    pluck="invoice"
+                ))
+
+                for row in batch:
+                    if row.name in active:
+                        # Already queued, the dispatcher owns that attempt
+                        self.state["skipped"] += 1
+                    else:
+                        if interval:
+                            time.sleep(max(next_send - time.monotonic(), 0))
+                            # A slow signing round does not earn a burst afterwards
+                            next_send = max(next_send, time.monotonic()) + interval
+                        self.state[self.fiscalize(row.name, invoices.get(row.name), fiscal_settings)] += 1
+
+                    self.state["last_posting_date"] = str(row.posting_date)
+                    self.state["last_name"] = row.name
+                    done += 1
+
+                self.save_checkpoint()
+
+                if time.monotonic() - last_progress >= PROGRESS_EVERY:
+                    last_progress = time.monotonic()
+                    self.echo(self.get_progress(done, total, started))
+
+        except KeyboardInterrupt:
+            self.save_checkpoint()
+            raise
+
+        except CircuitOpenError:
+            self.save_checkpoint()
+            self.echo(_("Fiscal device is unavailable, run the command again to resume"))
+            return self.state
+
+        self.echo(self.get_progress(done, total, started))
+        return self.state
+
+    def fiscalize(self, invoice_name, invoice, fiscal_settings):
+        """Sign one invoice through its own queue row and commit, returns the counter to bump"""
+        queue_doc, claimed = claim_invoice(invoice_name, "Processing")
+        if not claimed:
+            # Queued by a submit or the scheduler since the batch was read
+            return "skipped"
+        frappe.db.commit()
+
+        device = route_invoice(invoice) if invoice else fiscal_settings
+        invoice_data = _prepare(queue_doc, device, invoice)
+        if invoice_data is None:
+            status = frappe.db.get_value("Fiscal Queue", queue_doc.name, "status")
+            return "failed" if status == "Failed" else "skipped"
+
+        try:
+            response = device.sign_invoice(invoice_data)
+        except CircuitOpenError:
+            # Leave the row for the dispatcher and stop the run without using up a retry
+            _requeue(queue_doc.name)
+            raise
+        except Exception as e:
+            # The retry sweeper picks the row up again, the run moves on
+            _fail(queue_doc.name, invoice_name, 0, e)
+            return "failed"
+
+        write_fiscal_result(invoice_name, queue_doc.name, response)
+        frappe.db.commit()
+        return "completed"
+
+    def get_progress(self, done, total, started):
+        elapsed = time.monotonic() - started
+        throughput = done / elapsed if elapsed else 0
+        remaining = max(total - done, 0)
+        eta = remaining / throughput if throughput else 0
+        return (
+            f"{done}/{total} processed ({self.state['completed']} completed, {self.state['failed']} failed, "
+            f"{self.state['skipped']} skipped) {throughput:.2f}/s, ETA {_format_duration(eta)}"
+        )
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s"
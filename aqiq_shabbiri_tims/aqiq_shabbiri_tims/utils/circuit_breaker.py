@@ -0,0 +1,61 @@
+import time
+
+import frappe
+
+
+class CircuitOpenError(frappe.ValidationError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker shared by all workers of a site through Redis.
+    Closed: requests flow and consecutive failures are counted.
+    Open: after `failure_threshold` failures requests fail fast for `cooldown` seconds.
+    Half-Open: after the cool-down a single probe request is let through;
+    its success closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=5, cooldown=30):
+        self.name = name
+        self.failure_threshold = max(int(failure_threshold or 5), 1)
+        self.cooldown = max(int(cooldown or 30), 1)
+
+    def _key(self, suffix):
+        return frappe.cache().make_key(f"fiscal_circuit|{self.name}|{suffix}")
+
+    def _opened_at(self):
+        opened_at = frappe.cache().get(self._key("opened_at"))
+        return float(opened_at) if opened_at else None
+
+    def get_state(self):
+        opened_at = self._opened_at()
+        if opened_at is None:
+            return "Closed"
+        if time.time() - opened_at < self.cooldown:
+            return "Open"
+        return "Half-Open"
+
+    def is_open(self):
+        """Whether requests would be rejected right now, without taking the half-open probe"""
+        return self.get_state() == "Open"
+
+    def allow_request(self):
+        state = self.get_state()
+        if state == "Closed":
+            return True
+        if state == "Open":
+            return False
+        # Only one worker gets to probe the device per cool-down period
+        return bool(frappe.cache().set(self._key("probe"), 1, nx=True, ex=self.cooldown))
+
+    def record_success(self):
+        if frappe.cache().get(self._key("failures")) or self._opened_at() is not None:
+            frappe.cache().delete(self._key("failures"), self._key("opened_at"), self._key("probe"))
+
+    def record_failure(self):
+        cache = frappe.cache()
+        failures = cache.incr(self._key("failures"))
+        if failures >= self.failure_threshold or self._opened_at() is not None:
+            cache.set(self._key("opened_at"), time.time())
+            cache.delete(self._key("probe"))
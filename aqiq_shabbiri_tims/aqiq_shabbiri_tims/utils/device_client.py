@@ -0,0 +1,97 @@
+import os
+import threading
+
+import frappe
+import requests
+from frappe.utils import cint
+from requests.adapters import HTTPAdapter
+
+# Seconds to establish the TCP connection vs. seconds to wait for the device to sign.
+# The control unit answers on the LAN, so a slow connect means it is unreachable.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# The control unit signs serially; a few idle sockets cover concurrent workers in one process.
+# A device allowing more requests in flight gets a pool as large, the pool blocks when it is full
+POOL_MAXSIZE = 4
+
+_clients = {}
+_lock = threading.Lock()
+
+
+class DeviceRejectedError(frappe.ValidationError):
+    """The device answered and refused the invoice, sending the same payload again gets the same answer"""
+
+
+class DeviceUnavailableError(frappe.ValidationError):
+    """The device gave no usable answer within the attempts and deadline of a call"""
+
+
+class FiscalDeviceClient:
+    """Keep-alive HTTP client for a single fiscal device endpoint"""
+
+    def __init__(self, device_ip, port, bearer_token, max_in_flight=1):
+        self.base_url = f"http://{device_ip}:{cint(port)}"
+        self.fingerprint = _fingerprint(device_ip, port, bearer_token, max_in_flight)
+
+        pool_maxsize = max(POOL_MAXSIZE, cint(max_in_flight))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'Authorization': bearer_token or ''
+        })
+
+    def sign(self, payload, is_inclusive=True, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        """POST a payload to the device signing endpoint and return the raw response"""
+        endpoint = "invoice+1" if is_inclusive else "invoice+2"
+        return self.session.post(
+            url=f"{self.base_url}/api/sign?{endpoint}",
+            json=payload,
+            timeout=(connect_timeout, read_timeout)
+        )
+
+    def close(self):
+        self.session.close()
+
+
+def _fingerprint(device_ip, port, bearer_token, max_in_flight):
+    return (device_ip, cint(port), bearer_token or "", cint(max_in_flight), os.getpid())
+
+
+def get_client(device_ip, port, bearer_token, key=None, max_in_flight=1):
+    """
+    Get the pooled client for a device, one per worker process, site and key.
+    The client is rebuilt when the device IP, port, bearer token or in-flight limit change.
+    Args:
+        device_ip (str): Device IP address
+        port (int): Device port
+        bearer_token (str): Authorization header value
+        key (str): Owner of the client, defaults to the endpoint
+        max_in_flight (int): Requests the dispatcher keeps open on the device, the pool holds as many connections
+    """
+    key = (frappe.local.site, key or f"{device_ip}:{cint(port)}")
+    fingerprint = _fingerprint(device_ip, port, bearer_token, max_in_flight)
+
+    client = _clients.get(key)
+    if client and client.fingerprint == fingerprint:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client and client.fingerprint == fingerprint:
+            return client
+        # Sessions inherited across a fork share sockets with the parent, so drop them unclosed
+        if client and client.fingerprint[-1] == os.getpid():
+            client.close()
+        client = _clients[key] = FiscalDeviceClient(device_ip, port, bearer_token, max_in_flight)
+        return client
+
+
+def clear_clients():
+    """Close all pooled sessions held by this process"""
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
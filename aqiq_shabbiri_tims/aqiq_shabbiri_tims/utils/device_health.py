@@ -0,0 +1,47 @@
+import socket
+import time
+
+import frappe
+from frappe.utils import cint, now_datetime
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_devices, get_fiscal_settings
+
+HEARTBEAT_KEY = "fiscal_device_heartbeat"
+HEARTBEAT_TIMEOUT = 2
+# A heartbeat older than this is not trusted, the scheduler refreshes it every minute
+HEARTBEAT_TTL = 5 * 60
+
+def check_device_health():
+    """Record whether each device in the pool accepts TCP connections, without sending a signing request"""
+    settings = get_fiscal_settings()
+    if not settings.enable_device:
+        return None
+
+    for device in get_fiscal_devices():
+        check_device(device)
+
+    return check_device(settings)
+
+def check_device(device):
+    """TCP check of a single device, the result is cached per device endpoint"""
+    if not device.device_ip or not device.port:
+        return {}
+
+    started = time.perf_counter()
+    result = {
+        "device": device.get_device_key(),
+        "checked_at": str(now_datetime())
+    }
+    try:
+        with socket.create_connection((device.device_ip, cint(device.port)), timeout=HEARTBEAT_TIMEOUT):
+            pass
+        result.update(reachable=True, latency_ms=round((time.perf_counter() - started) * 1000, 2))
+    except OSError as e:
+        result.update(reachable=False, error=str(e))
+
+    frappe.cache().set_value(f"{HEARTBEAT_KEY}|{result['device']}", result, expires_in_sec=HEARTBEAT_TTL)
+    return result
+
+def get_heartbeat(device_key):
+    """Last heartbeat result of a device endpoint, None when it expired or never ran"""
+    return frappe.cache().get_value(f"{HEARTBEAT_KEY}|{device_key}")
@@ -0,0 +1,75 @@
+import random
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_devices, get_fiscal_settings
+
+# A rule matches when all of its set fields equal the invoice's, the highest total weight wins
+ROUTING_WEIGHTS = {
+    "pos_profile": 4,
+    "branch": 2,
+    "company": 1,
+}
+
+def get_device_pool():
+    """The default device in Fiscal Device Settings followed by the enabled Fiscal Devices"""
+    return (get_fiscal_settings(),) + get_fiscal_devices()
+
+def get_device(name):
+    """Pool device by name, the default device is named Fiscal Device Settings. None when disabled or removed"""
+    for device in get_device_pool():
+        if device.name == name:
+            return device
+    return None
+
+def route_invoice(invoice, devices=None):
+    """
+    Device that signs the invoice: the one with the most specific matching routing rule,
+    or the default device. While the routed device's circuit is open an available
+    device of the same failover group takes its place.
+    """
+    if devices is None:
+        devices = get_fiscal_devices()
+
+    device = match_device(invoice, devices)
+    if device is None:
+        return get_fiscal_settings()
+
+    if device.get_circuit_breaker().is_open():
+        return get_failover_device(device, devices) or device
+
+    return device
+
+def match_device(invoice, devices):
+    """Pool device with the most specific rule matching the invoice, None when no rule matches"""
+    matched, best_score = None, 0
+    for device in devices:
+        for rule in device.routing_rules:
+            score = _score(rule, invoice)
+            if score > best_score:
+                matched, best_score = device, score
+    return matched
+
+def get_failover_device(device, devices):
+    """An enabled device of the same failover group whose circuit is closed"""
+    if not device.failover_group:
+        return None
+
+    siblings = [
+        sibling for sibling in devices
+        if sibling.name != device.name
+        and sibling.failover_group == device.failover_group
+        and sibling.is_enabled()
+        and not sibling.get_circuit_breaker().is_open()
+    ]
+    # Spread the failed device's traffic over all of its siblings
+    return random.choice(siblings) if siblings else None
+
+def _score(rule, invoice):
+    score = 0
+    for fieldname, weight in ROUTING_WEIGHTS.items():
+        value = rule.get(fieldname)
+        if not value:
+            continue
+        if value != invoice.get(fieldname):
+            return 0
+        score += weight
+    return score
@@ -1,111 +1,526 @@
+import contextvars
+import random
+import signal
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import frappe
 from frappe import _
-from frappe.utils.background_jobs import enqueue
+from frappe.utils import cint
+from frappe.utils.background_jobs import enqueue, get_queues_timeout
 from datetime import datetime, timedelta
 
-def enqueue_fiscalization(invoice_name, retry_count=0):
-    """Enqueue invoice fiscalization"""
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.doctype.fiscal_queue.fiscal_queue import ACTIVE_STATUSES
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.async_client import sign_many
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.circuit_breaker import CircuitOpenError
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_client import DeviceRejectedError
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_pool import get_device_pool, route_invoice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.invoice_loader import load_invoice, load_invoices
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.metrics import observe_all
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.queue_stats import get_queue_stats, track
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.replay import get_cached_payload
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_devices, get_fiscal_settings
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.trace import is_sampled
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.write_back import write_fiscal_result, write_fiscal_results
+
+# Dedicated RQ queue for the dispatcher, configured under "workers" in common_site_config.json
+FISCAL_QUEUE = "fiscal"
+DISPATCHER_JOB_ID = "fiscal_queue_dispatcher"
+DISPATCHER_LOCK = "fiscal_queue_dispatcher_lock"
+
+# The dispatcher drains in bounded slices so a warm worker shutdown never waits long on it,
+# the next enqueue or the scheduler starts a fresh slice
+DISPATCHER_RUNTIME = 240
+DISPATCHER_TIMEOUT = 600
+LOCK_TTL = 60
+
+# Rows left in Processing longer than this belong to a dead worker and are queued again
+ORPHAN_AFTER = timedelta(minutes=10)
+
+MAX_RETRIES = 3
+# Seconds before the first retry, doubling per attempt up to RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 300
+RETRY_MAX_DELAY = 6 * 60 * 60
+# Retries released to the queue per sweep
+RETRY_BATCH_SIZE = 20
+
+def enqueue_fiscalization(invoice_name, retry_count=0, invoice_type="Sales Invoice"):
+    """Enqueue invoice fiscalization, an invoice that is already queued or being signed keeps that attempt"""
     try:
-        # Check if already in queue
-        if frappe.db.exists("Fiscal Queue", {"invoice": invoice_name, "status": ["in", ["Queued", "Processing"]]}):
-            return
-            
-        # Create queue entry
-        queue_doc = frappe.get_doc({
-            "doctype": "Fiscal Queue",
-            "invoice": invoice_name,
-            "status": "Queued",
-            "retry_count": retry_count,
-            "creation": datetime.now()
-        }).insert(ignore_permissions=True)
-        
-        # Enqueue the job with correct path and parameters
-        enqueue(
-            method="aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.fiscal_queue.process_fiscalization",
-            queue="default",
-            timeout=300,
-            job_name=f"fiscal_invoice_{invoice_name}",
-            kwargs={
-                "queue_doc": queue_doc.name,
-                "invoice_name": invoice_name,
-                "retry_count": retry_count
-            },
-            is_async=True
-        )
-        
+        _queue_doc, claimed = claim_invoice(invoice_name, "Queued", retry_count, invoice_type)
+        if claimed:
+            start_dispatcher()
+
     except Exception as e:
         frappe.log_error(
             title=_("Failed to Enqueue Fiscalization"),
             message=str(e)
         )
 
+def claim_invoice(invoice_name, status="Queued", retry_count=0, invoice_type="Sales Invoice"):
+    """
+    Open the one active Fiscal Queue row of an invoice, shared by every entry point.
+    The unique (`invoice_type`, `active_invoice`) key makes the insert itself the check, so of two
+    concurrent callers exactly one wins, however close together they run. A POS Invoice and a
+    Sales Invoice that share a name are different invoices.
+    Returns:
+        (Fiscal Queue doc, True) when this caller started the attempt, or
+        (name of the active row, False) when another attempt is already Queued or Processing.
+        The name is None when that attempt finished before it could be read.
+    """
+    filters = {"invoice_type": invoice_type, "invoice": invoice_name, "status": ["in", ACTIVE_STATUSES]}
+    active = frappe.db.get_value("Fiscal Queue", filters, "name")
+    if active:
+        return active, False
+
+    try:
+        return frappe.get_doc({
+            "doctype": "Fiscal Queue",
+            "invoice_type": invoice_type,
+            "invoice": invoice_name,
+            "status": status,
+            "retry_count": retry_count
+        }).insert(ignore_permissions=True), True
+    except frappe.UniqueValidationError:
+        # A concurrent caller opened the row between the lookup and the insert, attach to it
+        frappe.clear_last_message()
+        return frappe.db.get_value("Fiscal Queue", filters, "name"), False
+
+def get_dispatcher_queue():
+    """Use the dedicated fiscal queue when a worker is configured for it"""
+    return FISCAL_QUEUE if FISCAL_QUEUE in get_queues_timeout() else "long"
+
+def start_dispatcher():
+    """Make sure a dispatcher job is queued or running, scheduled every minute as a safety net"""
+    enqueue(
+        method="aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.fiscal_queue.run_dispatcher",
+        queue=get_dispatcher_queue(),
+        timeout=DISPATCHER_TIMEOUT,
+        job_id=DISPATCHER_JOB_ID,
+        deduplicate=True,
+        # The queue row and invoice are only visible to the worker once the caller commits
+        enqueue_after_commit=True
+    )
+
+def run_dispatcher():
+    """
+    Drain Queued Fiscal Queue rows in FIFO order across the device pool.
+    A Redis lock keeps a single consumer per site. Each row is routed to its device,
+    and each device has at most its `max_in_flight` signing requests open, so the
+    pool signs in parallel. Device I/O runs on worker threads while all database
+    work stays on this thread.
+    """
+    token = frappe.generate_hash(length=10)
+    if not _acquire_lock(token):
+        return
+
+    stop = threading.Event()
+    previous_handler = _install_shutdown_handler(stop)
+    try:
+        recover_orphaned_rows()
+
+        fiscal_settings = get_fiscal_settings()
+        if not fiscal_settings.enable_device:
+            return
+
+        devices = get_fiscal_devices()
+        pool = get_device_pool()
+        capacity = sum(device.get_max_in_flight() for device in pool)
+        deadline = time.monotonic() + DISPATCHER_RUNTIME
+        in_flight = {}
+        # Signing requests open per device
+        busy = defaultdict(int)
+        # Claimed rows whose device has no free slot yet, in claim order
+        waiting = []
+        # Rows handed back this slice because their device and its failover group are down
+        passed = set()
+        # Devices found with an open circuit this slice, routing already tried their failover group
+        down = set()
+        # Devices whose half-open probe this dispatcher has in flight
+        probing = set()
+
+        def hand_back(row, device):
+            _requeue(row.name, commit=False)
+            passed.add(row.name)
+            down.add(device.name)
+
+        with ThreadPoolExecutor(max_workers=capacity, thread_name_prefix="fiscal") as executor:
+            while True:
+                _refresh_lock(token)
+                accepting = not stop.is_set() and time.monotonic() < deadline
+                free = capacity - len(in_flight) - len(waiting)
+
+                rows = []
+                # Once every device is down no claimed row could be signed, the scheduler restarts
+                # the dispatcher each minute to try again
+                if accepting and free > 0 and len(down) < len(pool):
+                    rows = claim_queued_rows(free, exclude=passed)
+                    invoices = load_row_invoices(rows)
+                    for row in rows:
+                        invoice = invoices.get(row.name)
+                        device = route_invoice(invoice, devices) if invoice else fiscal_settings
+                        # Resolved here, signing threads must not read settings through the shared connection
+                        breaker = device.get_circuit_breaker(fiscal_settings)
+                        if breaker.is_open():
+                            hand_back(row, device)
+                            continue
+                        payload = _prepare(row, device, invoice)
+                        if payload is not None:
+                            waiting.append((row, device, breaker, payload))
+                    # Rows handed back in one commit
+                    frappe.db.commit()
+
+                if not accepting and waiting:
+                    for row, _device, _breaker, _payload in waiting:
+                        _requeue(row.name, commit=False)
+                    waiting.clear()
+                    frappe.db.commit()
+
+                for entry in list(waiting):
+                    row, device, breaker, payload = entry
+                    if busy[device.name] >= device.get_max_in_flight() or device.name in probing:
+                        continue
+                    state = breaker.get_state()
+                    if state == "Open":
+                        # A probe failed or another worker opened the circuit since the row was claimed
+                        waiting.remove(entry)
+                        hand_back(row, device)
+                        frappe.db.commit()
+                        continue
+                    if state == "Half-Open":
+                        # One row probes the device, the others wait for its outcome
+                        probing.add(device.name)
+                    waiting.remove(entry)
+                    busy[device.name] += 1
+                    future = executor.submit(
+                        contextvars.copy_context().run, device.sign_invoice, payload,
+                        breaker=breaker, sampled=is_sampled(), enabled=device.is_enabled(fiscal_settings)
+                    )
+                    in_flight[future] = (row, device)
+
+                if rows:
+                    continue
+
+                if not in_flight:
+                    break
+
+                done, _pending = wait(in_flight, timeout=LOCK_TTL / 2, return_when=FIRST_COMPLETED)
+                for future in done:
+                    row, device = in_flight.pop(future)
+                    busy[device.name] -= 1
+                    probing.discard(device.name)
+                    try:
+                        write_fiscal_result(row.invoice, row.name, future.result(), doctype=get_invoice_type(row))
+                        frappe.db.commit()
+                    except CircuitOpenError:
+                        # Another process holds the probe or the circuit opened, not again this slice
+                        hand_back(row, device)
+                        frappe.db.commit()
+                    except Exception as e:
+                        _fail(row.name, row.invoice, row.retry_count, e)
+    finally:
+        if previous_handler is not None:
+            signal.signal(signal.SIGTERM, previous_handler)
+        _release_lock(token)
+
+def claim_queued_rows(limit, exclude=None):
+    """
+    Move up to `limit` of the oldest Queued rows to Processing and return them.
+    Rows locked by a concurrent claim are skipped, so several workers can claim side by side.
+    """
+    exclude_condition = "and name not in %(exclude)s" if exclude else ""
+    rows = frappe.db.sql(f"""
+        select name, invoice_type, invoice, retry_count, creation
+        from `tabFiscal Queue`
+        where status = 'Queued' {exclude_condition}
+        order by creation asc
+        limit %(limit)s
+        for update skip locked
+    """, {"limit": cint(limit), "exclude": tuple(exclude or ())}, as_dict=True)
+
+    if rows:
+        names = [row.name for row in rows]
+        frappe.db.set_value("Fiscal Queue", {"name": ["in", names]}, "status", "Processing")
+        track(names, "Queued", "Processing")
+    frappe.db.commit()
+
+    now = datetime.now()
+    observe_all("queue_wait", [(now - row.creation).total_seconds() * 1000 for row in rows])
+    return rows
+
+def get_invoice_type(row):
+    # Rows queued before POS Invoice support have no type
+    return row.get("invoice_type") or "Sales Invoice"
+
+def load_row_invoices(rows):
+    """Invoices of claimed rows keyed by queue row name, one load per invoice doctype"""
+    names_by_type = defaultdict(list)
+    for row in rows:
+        names_by_type[get_invoice_type(row)].append(row.invoice)
+
+    invoices = {}
+    for doctype, names in names_by_type.items():
+        for name, invoice in load_invoices(names, doctype).items():
+            invoices[(doctype, name)] = invoice
+
+    return {row.name: invoices.get((get_invoice_type(row), row.invoice)) for row in rows}
+
+def process_fiscal_batch(limit=20, commit_every=10):
+    """
+    Claim up to `limit` Queued rows and sign them concurrently on one event loop,
+    each routed device within its own in-flight window, committing results in groups
+    of `commit_every`. Returns per-batch timings in milliseconds so the batch size can be tuned.
+    """
+    started = time.perf_counter()
+    stats = frappe._dict(claimed=0, completed=0, failed=0, skipped=0,
+        claim_ms=0.0, load_ms=0.0, format_ms=0.0, sign_ms=0.0, write_ms=0.0, total_ms=0.0)
+
+    fiscal_settings = get_fiscal_settings()
+    if not fiscal_settings.enable_device:
+        return stats
+    devices = get_fiscal_devices()
+
+    mark = time.perf_counter()
+    rows = claim_queued_rows(limit)
+    stats.claimed = len(rows)
+    stats.claim_ms = _elapsed_ms(mark)
+
+    mark = time.perf_counter()
+    invoices = load_row_invoices(rows)
+    stats.load_ms = _elapsed_ms(mark)
+
+    mark = time.perf_counter()
+    prepared = []
+    for row in rows:
+        invoice = invoices.get(row.name)
+        device = route_invoice(invoice, devices) if invoice else fiscal_settings
+        if device.get_circuit_breaker().is_open():
+            _requeue(row.name, commit=False)
+            stats.skipped += 1
+            continue
+
+        invoice_data = _prepare(row, device, invoice)
+        if invoice_data is None:
+            stats.skipped += 1
+            continue
+        prepared.append((row, device, invoice_data))
+    stats.format_ms = _elapsed_ms(mark)
+
+    mark = time.perf_counter()
+    results = sign_many([(device, invoice_data) for _row, device, invoice_data in prepared])
+    stats.sign_ms = _elapsed_ms(mark)
+
+    # Results per invoice doctype, each written with its own UPDATE
+    completed = defaultdict(list)
+    for index, ((row, _device, _invoice_data), result) in enumerate(zip(prepared, results), 1):
+        if isinstance(result, CircuitOpenError):
+            # The device is down, hand the row back without using up a retry
+            _requeue(row.name, commit=False)
+            stats.skipped += 1
+        elif isinstance(result, Exception):
+            _fail(row.name, row.invoice, row.retry_count, result, commit=False)
+            stats.failed += 1
+        else:
+            completed[get_invoice_type(row)].append((row.invoice, row.name, result))
+            stats.completed += 1
+
+        if index % commit_every == 0 or index == len(prepared):
+            write_mark = time.perf_counter()
+            for doctype, results_of_type in completed.items():
+                write_fiscal_results(results_of_type, doctype=doctype)
+            frappe.db.commit()
+            stats.write_ms += _elapsed_ms(write_mark)
+            completed.clear()
+
+    # Requeued rows must not stay Processing when nothing was signed
+    frappe.db.commit()
+    stats.total_ms = _elapsed_ms(started)
+
+    frappe.logger().info(f"Fiscal batch: {frappe.as_json(stats, indent=None)}")
+    return stats
+
+def _elapsed_ms(since):
+    return round((time.perf_counter() - since) * 1000, 2)
+
+def recover_orphaned_rows():
+    """Queue rows again whose worker died while they were Processing, journaled rows wait for the forwarder"""
+    orphaned = frappe.db.sql_list("""
+        select queue.name
+        from `tabFiscal Queue` queue
+        where queue.status = 'Processing' and queue.modified < %s
+            and not exists (
+                select 1 from `tabFiscal Journal` journal
+                where journal.queue = queue.name and journal.status = 'Pending'
+            )
+    """, datetime.now() - ORPHAN_AFTER)
+    if not orphaned:
+        return
+
+    frappe.db.set_value("Fiscal Queue", {"name": ["in", orphaned], "status": "Processing"}, "status", "Queued")
+    track(orphaned, "Processing", "Queued")
+    frappe.db.commit()
+
 def process_fiscalization(queue_doc, invoice_name, retry_count=0):
-    """Process fiscalization in background"""
+    """Process a single fiscalization, kept for jobs enqueued before the dispatcher"""
     try:
-        if not frappe.db.exists("Sales Invoice", invoice_name):
-            raise Exception("Invoice not found")
-            
         queue = frappe.get_doc("Fiscal Queue", queue_doc)
         if queue.status == "Completed":
             return
-            
+
+        previous_status = queue.status
         queue.db_set('status', 'Processing')
+        track(queue_doc, previous_status, "Processing")
         frappe.db.commit()
-        
-        invoice = frappe.get_doc("Sales Invoice", invoice_name)
-        fiscal_settings = frappe.get_doc("Fiscal Device Settings")
-        
-        # Format and send invoice data
-        invoice_data = fiscal_settings.format_invoice_data(
-            invoice, 
-            invoice.items,
-            is_inclusive=(invoice.get("taxes") or [{}])[0].get("included_in_print_rate", True)
+
+        invoice_type = get_invoice_type(queue)
+        invoice = load_invoice(invoice_name, invoice_type)
+        device = route_invoice(invoice) if invoice else get_fiscal_settings()
+        invoice_data = _prepare(
+            frappe._dict(name=queue_doc, invoice_type=invoice_type, invoice=invoice_name), device, invoice
         )
-        
-        response = fiscal_settings.sign_invoice(invoice_data)
-        
-        # Update invoice
-        invoice.db_set('custom_fiscal_invoice_number', response.get('cu_invoice_number'))
-        invoice.db_set('custom_fiscal_verification_url', response.get('verify_url'))
-        invoice.db_set('custom_is_fiscalized', 1)
-        
-        # Update queue status
-        queue.db_set('status', 'Completed')
-        queue.db_set('response', frappe.as_json(response))
-        queue.db_set('completion_time', datetime.now())
-        
+        if invoice_data is None:
+            return
+
+        response = device.sign_invoice(invoice_data)
+        write_fiscal_result(invoice_name, queue_doc, response, doctype=invoice_type)
         frappe.db.commit()
-        
+
     except Exception as e:
         frappe.db.rollback()
-        
-        if retry_count < 3:
-            delay = 300 * (2 ** retry_count)
-            queue.db_set('status', 'Failed')
-            queue.db_set('error', str(e))
-            frappe.db.commit()
-            enqueue_fiscalization(invoice_name, retry_count + 1)
-        else:
-            queue.db_set('status', 'Failed')
-            queue.db_set('error', str(e))
+        _fail(queue_doc, invoice_name, retry_count, e)
+
+def _prepare(row, device, invoice=None):
+    """Format the payload for a queue row with its device, None when there is nothing to send"""
+    try:
+        invoice = invoice or load_invoice(row.invoice, get_invoice_type(row))
+        if invoice is None:
+            raise Exception("Invoice not found")
+
+        if invoice.custom_is_fiscalized:
+            frappe.db.set_value("Fiscal Queue", row.name, {"status": "Completed", "completion_time": datetime.now()})
+            track(row.name, "Processing", "Completed")
             frappe.db.commit()
-            frappe.log_error(
-                title=_("Fiscalization Failed After Retries"),
-                message=f"Invoice: {invoice_name}\nError: {str(e)}"
-            )
+            return None
+
+        return get_cached_payload(
+            invoice,
+            device,
+            lambda: device.format_invoice_data(invoice, invoice.items, is_inclusive=invoice.is_inclusive)
+        )
+    except Exception as e:
+        _fail(row.name, row.invoice, row.get("retry_count") or 0, e)
+        return None
+
+def _fail(queue_name, invoice_name, retry_count, error, commit=True):
+    """
+    Mark the Processing queue row failed and schedule its next attempt while retries remain.
+    Device rejections are final, the same payload would be refused again.
+    """
+    retryable = retry_count < MAX_RETRIES and not isinstance(error, DeviceRejectedError)
+    frappe.db.set_value("Fiscal Queue", queue_name, {
+        'status': 'Failed',
+        'error': str(error),
+        'retry_count': retry_count + 1,
+        'next_retry_at': get_next_retry_at(retry_count) if retryable else None
+    })
+    track(queue_name, "Processing", "Failed")
+
+    if commit:
+        frappe.db.commit()
+
+    if not retryable:
+        frappe.log_error(
+            title=_("Fiscalization Failed After Retries"),
+            message=f"Invoice: {invoice_name}\nError: {str(error)}"
+        )
+
+def _requeue(queue_name, commit=True):
+    """Return a claimed row to the queue without counting an attempt"""
+    frappe.db.set_value("Fiscal Queue", queue_name, "status", "Queued")
+    track(queue_name, "Processing", "Queued")
+    if commit:
+        frappe.db.commit()
+
+def _acquire_lock(token, name=DISPATCHER_LOCK):
+    return frappe.cache().set(frappe.cache().make_key(name), token, nx=True, ex=LOCK_TTL)
+
+def _refresh_lock(token, name=DISPATCHER_LOCK):
+    key = frappe.cache().make_key(name)
+    if frappe.safe_decode(frappe.cache().get(key)) == token:
+        frappe.cache().expire(key, LOCK_TTL)
+
+def _release_lock(token, name=DISPATCHER_LOCK):
+    key = frappe.cache().make_key(name)
+    if frappe.safe_decode(frappe.cache().get(key)) == token:
+        frappe.cache().delete(key)
+
+def _install_shutdown_handler(stop):
+    """Stop claiming new rows on SIGTERM and let in-flight requests finish"""
+    if threading.current_thread() is not threading.main_thread():
+        return None
+    return signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+def get_next_retry_at(retry_count):
+    """Exponential backoff from RETRY_BASE_DELAY with equal jitter, so retries after an outage spread out"""
+    delay = min(RETRY_BASE_DELAY * (2 ** retry_count), RETRY_MAX_DELAY)
+    return datetime.now() + timedelta(seconds=delay / 2 + random.uniform(0, delay / 2))
 
 def process_failed_queue():
-    """Process failed fiscalizations"""
-    failed_queue = frappe.get_all(
+    """
+    Release Failed rows whose next_retry_at is due back to Queued, oldest due first.
+    At most RETRY_BATCH_SIZE rows are waiting in the queue after each run,
+    so a backlog of retries drains at the device's pace instead of all at once.
+    """
+    backlog = get_queue_stats()[0]["Queued"]
+    limit = RETRY_BATCH_SIZE - backlog
+    if limit <= 0:
+        return
+
+    due = frappe.get_all(
         "Fiscal Queue",
-        filters={
-            "status": "Failed",
-            "retry_count": ["<", 3],
-            "modified": ["<", datetime.now() - timedelta(minutes=30)]
-        },
-        pluck="name"
+        filters={"status": "Failed", "next_retry_at": ["<=", datetime.now()]},
+        fields=["name", "invoice_type", "invoice"],
+        order_by="next_retry_at asc",
+        limit=limit
     )
-    
-    for queue_name in failed_queue:
-        queue = frappe.get_doc("Fiscal Queue", queue_name)
-        enqueue_fiscalization(queue.invoice, queue.retry_count + 1) 
\ No newline at end of file
+    if not due:
+        return
+
+    # Invoices queued again through another path keep that attempt
+    active = set(frappe.get_all(
+        "Fiscal Queue",
+        filters={"invoice": ["in", [row.invoice for row in due]], "status": ["in", ACTIVE_STATUSES]},
+        fields=["invoice_type", "invoice"],
+        as_list=True
+    ))
+
+    released = []
+    for row in due:
+        invoice = (row.invoice_type, row.invoice)
+        if invoice not in active and _release(row.name):
+            released.append(row.name)
+            active.add(invoice)
+        else:
+            frappe.db.set_value("Fiscal Queue", row.name, "next_retry_at", None)
+
+    if released:
+        track(released, "Failed", "Queued")
+    frappe.db.commit()
+
+    if released:
+        start_dispatcher()
+
+def _release(queue_name):
+    """
+    Queue a failed row again, one row per statement so that an invoice claimed since the active
+    row check only skips its own row. False when the invoice already has an active row.
+    """
+    try:
+        frappe.db.set_value("Fiscal Queue", queue_name, {"status": "Queued", "next_retry_at": None})
+    except Exception as e:
+        if not frappe.db.is_unique_key_violation(e):
+            raise
+        return False
+    return True
@@ -0,0 +1,100 @@
+import frappe
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.metrics import timed
+
+# Header fields read by format_invoice_data, the fiscalization checks, device routing and the payload cache
+HEADER_FIELDS = (
+    "name",
+    "modified",
+    "docstatus",
+    "is_return",
+    "posting_date",
+    "grand_total",
+    "net_total",
+    "total_taxes_and_charges",
+    "discount_amount",
+    "tax_id",
+    "custom_tax_exemption_id",
+    "currency",
+    "return_against",
+    "custom_is_fiscalized",
+    "company",
+    "pos_profile",
+)
+# Read when the column exists, e.g. a Branch accounting dimension, for device routing
+OPTIONAL_HEADER_FIELDS = ("branch",)
+ITEM_FIELDS = ("item_code", "item_name", "qty", "amount", "item_tax_template")
+
+ITEM_DOCTYPES = {
+    "Sales Invoice": "Sales Invoice Item",
+    "POS Invoice": "POS Invoice Item",
+}
+
+
+class InvoiceRecord:
+    """Header fields of an invoice being fiscalized, with its items as columns for build_items_list"""
+
+    __slots__ = HEADER_FIELDS + OPTIONAL_HEADER_FIELDS + ("doctype", "is_inclusive", "items")
+
+    def __init__(self, doctype, row):
+        self.doctype = doctype
+        for fieldname in HEADER_FIELDS:
+            setattr(self, fieldname, row[fieldname])
+        for fieldname in OPTIONAL_HEADER_FIELDS:
+            setattr(self, fieldname, row.get(fieldname))
+        # Same default as reading included_in_print_rate off the first tax row
+        self.is_inclusive = True if row["is_inclusive"] is None else bool(row["is_inclusive"])
+        self.items = frappe._dict({fieldname: [] for fieldname in ITEM_FIELDS})
+
+    def get(self, fieldname, default=None):
+        return getattr(self, fieldname, default)
+
+
+def load_invoices(names, doctype="Sales Invoice"):
+    """
+    Load only what fiscalization needs for many invoices, with one header and one items query.
+    Returns a dict of InvoiceRecord by name, missing invoices are left out.
+    """
+    names = list(dict.fromkeys(name for name in names if name))
+    if not names:
+        return {}
+
+    with timed("load"):
+        return _load_invoices(names, doctype)
+
+
+def _load_invoices(names, doctype):
+    fieldnames = HEADER_FIELDS + tuple(f for f in OPTIONAL_HEADER_FIELDS if frappe.db.has_column(doctype, f))
+    header_fields = ", ".join(f"invoice.`{fieldname}`" for fieldname in fieldnames)
+    headers = frappe.db.sql(f"""
+        select {header_fields},
+            (select taxes.included_in_print_rate from `tabSales Taxes and Charges` taxes
+                where taxes.parent = invoice.name and taxes.parenttype = %(doctype)s
+                order by taxes.idx limit 1) as is_inclusive
+        from `tab{doctype}` invoice
+        where invoice.name in %(names)s
+    """, {"names": names, "doctype": doctype}, as_dict=True)
+
+    records = {row.name: InvoiceRecord(doctype, row) for row in headers}
+    if not records:
+        return records
+
+    item_fields = ", ".join(f"`{fieldname}`" for fieldname in ITEM_FIELDS)
+    items = frappe.db.sql(f"""
+        select parent, {item_fields}
+        from `tab{ITEM_DOCTYPES[doctype]}`
+        where parent in %(names)s and parenttype = %(doctype)s
+        order by parent, idx
+    """, {"names": list(records), "doctype": doctype}, as_list=True)
+
+    for row in items:
+        columns = records[row[0]].items
+        for fieldname, value in zip(ITEM_FIELDS, row[1:]):
+            columns[fieldname].append(value)
+
+    return records
+
+
+def load_invoice(name, doctype="Sales Invoice"):
+    """Lean record for a single invoice, None if it does not exist"""
+    return load_invoices([name], doctype).get(name)
@@ -0,0 +1,237 @@
+import json
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import now_datetime
+from frappe.utils.background_jobs import enqueue
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.backfill import _format_duration
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.circuit_breaker import CircuitOpenError
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_client import DeviceRejectedError, DeviceUnavailableError
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_pool import get_device, route_invoice
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.fiscal_queue import (
+    LOCK_TTL,
+    _acquire_lock,
+    _fail,
+    _refresh_lock,
+    _release_lock,
+    claim_invoice,
+    get_dispatcher_queue
+)
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.replay import get_cached_payload
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.write_back import dump_response, write_fiscal_result
+
+FORWARDER_JOB_ID = "fiscal_journal_forwarder"
+FORWARDER_LOCK = "fiscal_journal_forwarder_lock"
+FORWARDER_TIMEOUT = 60 * 60
+PROGRESS_KEY = "fiscal_journal_progress"
+
+# Entries read per query, only one chunk of payloads is held in memory
+CHUNK_SIZE = 100
+# Seconds between progress updates
+PROGRESS_EVERY = 10
+
+def journal_invoice(doc, invoice_type="Sales Invoice"):
+    """
+    Append the invoice's payload to the Fiscal Journal during submit without contacting the device.
+    The invoice's Fiscal Queue row stays Processing until the forwarder settles the entry,
+    so no other entry point signs it in the meantime.
+    """
+    queue_doc, claimed = claim_invoice(doc.name, "Processing", invoice_type=invoice_type)
+    if not claimed:
+        return None
+
+    device = route_invoice(doc)
+    payload = get_cached_payload(doc, device, lambda: device.format_invoice_data(
+        doc, doc.items,
+        is_inclusive=(doc.get("taxes") or [{}])[0].get("included_in_print_rate", True)
+    ))
+
+    entry = frappe.get_doc({
+        "doctype": "Fiscal Journal",
+        "invoice_type": invoice_type,
+        "invoice": doc.name,
+        "queue": queue_doc.name,
+        "device": device.name,
+        "status": "Pending",
+        "payload": json.dumps(payload, separators=(",", ":"))
+    }).insert(ignore_permissions=True)
+
+    start_forwarder()
+    return entry
+
+def start_forwarder():
+    """Make sure a forwarder job is queued or running, scheduled every minute as a safety net"""
+    enqueue(
+        method="aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.journal.forward_journal",
+        queue=get_dispatcher_queue(),
+        timeout=FORWARDER_TIMEOUT,
+        job_id=FORWARDER_JOB_ID,
+        deduplicate=True,
+        enqueue_after_commit=True
+    )
+
+def resume_forwarding():
+    """Scheduled every minute, picks up entries left Pending while a device was down"""
+    if frappe.db.exists("Fiscal Journal", {"status": "Pending"}):
+        start_forwarder()
+
+def forward_journal():
+    Forwarder(echo=frappe.logger().info).run()
+
+
+class Forwarder:
+    """
+    Replay Pending journal entries to their devices in journal order, as fast as each device answers.
+    A device that turns out to be down (unreachable, open circuit or out of time) keeps its remaining
+    entries Pending for the next run, so every device still receives its invoices in submit order.
+    Entries of a device that was disabled or removed since, and entries failing for any other reason,
+    are handed to the Fiscal Queue, which retries them and routes them to an enabled device.
+    """
+
+    def __init__(self, chunk_size=None, echo=print):
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.echo = echo
+        self.state = {"forwarded": 0, "rejected": 0, "failed": 0, "waiting": 0}
+
+    def run(self):
+        token = frappe.generate_hash(length=10)
+        if not _acquire_lock(token, FORWARDER_LOCK):
+            self.echo(_("The Fiscal Journal is already being forwarded"))
+            return None
+
+        try:
+            return self.forward(token)
+        finally:
+            _release_lock(token, FORWARDER_LOCK)
+
+    def forward(self, token):
+        total = frappe.db.count("Fiscal Journal", {"status": "Pending"})
+        self.echo(f"{total} journal entries to forward")
+
+        started = time.monotonic()
+        last_progress = started
+        last_name = 0
+        # Devices found down during this run
+        down = set()
+
+        while True:
+            # Keyset on the autoincrement name, which is the journal order
+            entries = frappe.db.sql("""
+                select name, invoice_type, invoice, queue, device, payload
+                from `tabFiscal Journal`
+                where status = 'Pending' and name > %(last_name)s
+                order by name
+                limit %(limit)s
+            """, {"last_name": last_name, "limit": self.chunk_size}, as_dict=True)
+            if not entries:
+                break
+
+            for entry in entries:
+                last_name = entry.name
+                if entry.device not in down:
+                    device = get_device(entry.device)
+                    if device is None:
+                        self.fail_entry(entry, _("Fiscal Device {0} is disabled or no longer exists").format(entry.device))
+                    elif self.forward_entry(entry, device) == "down":
+                        down.add(entry.device)
+                if entry.device in down:
+                    self.state["waiting"] += 1
+
+                if time.monotonic() - last_progress >= PROGRESS_EVERY:
+                    last_progress = time.monotonic()
+                    self.report(total, started)
+                # A single slow entry can outlast the lock
+                _refresh_lock(token, FORWARDER_LOCK)
+
+        self.report(total, started)
+        if down:
+            self.echo(_("Devices unavailable, their entries wait for the next run: {0}").format(", ".join(sorted(down))))
+        return self.state
+
+    def forward_entry(self, entry, device):
+        """Send one entry and record the outcome, returns "forwarded", "rejected", "failed" or "down" """
+        try:
+            response = device.sign_invoice(json.loads(entry.payload))
+        except DeviceRejectedError as e:
+            frappe.db.rollback()
+            frappe.clear_last_message()
+            # The device refused this invoice, sending it again would not change that
+            frappe.db.set_value("Fiscal Journal", entry.name, {
+                "status": "Rejected",
+                "error": str(e),
+                "forwarded_at": now_datetime()
+            }, update_modified=False)
+            _fail(entry.queue, entry.invoice, 0, e)
+            self.state["rejected"] += 1
+            return "rejected"
+        except (CircuitOpenError, DeviceUnavailableError):
+            # Unreachable, open circuit or out of time: keep the entry and its successors in order
+            frappe.db.rollback()
+            frappe.clear_last_message()
+            return "down"
+        except Exception as e:
+            # Not a device outage, e.g. the device was disabled or the payload is unreadable:
+            # waiting would not help, the Fiscal Queue retries the invoice
+            frappe.db.rollback()
+            frappe.clear_last_message()
+            self.fail_entry(entry, str(e))
+            return "failed"
+
+        frappe.db.set_value("Fiscal Journal", entry.name, {
+            "status": "Forwarded",
+            "response": dump_response(response),
+            "forwarded_at": now_datetime()
+        }, update_modified=False)
+        write_fiscal_result(entry.invoice, entry.queue, response, doctype=entry.invoice_type)
+        frappe.db.commit()
+        self.state["forwarded"] += 1
+        return "forwarded"
+
+    def fail_entry(self, entry, error):
+        """
+        Close an entry that cannot be forwarded to its device. Its queue row fails with the error
+        and a retry, and the retry is routed afresh to an enabled device.
+        """
+        frappe.db.set_value("Fiscal Journal", entry.name, {
+            "status": "Failed",
+            "error": error
+        }, update_modified=False)
+        _fail(entry.queue, entry.invoice, 0, error)
+        self.state["failed"] += 1
+
+    def report(self, total, started):
+        done = self.state["forwarded"] + self.state["rejected"] + self.state["failed"]
+        elapsed = time.monotonic() - started
+        throughput = done / elapsed if elapsed else 0
+        remaining = max(total - done - self.state["waiting"], 0)
+        progress = {
+            "total": total,
+            "forwarded": self.state["forwarded"],
+            "rejected": self.state["rejected"],
+            "failed": self.state["failed"],
+            "waiting": self.state["waiting"],
+            "per_second": round(throughput, 2),
+            "eta_seconds": round(remaining / throughput) if throughput else None,
+            "updated": str(now_datetime()),
+        }
+        frappe.cache().set(frappe.cache().make_key(PROGRESS_KEY), json.dumps(progress), ex=LOCK_TTL * 10)
+        self.echo(
+            f"{done}/{total} forwarded ({self.state['rejected']} rejected, {self.state['failed']} failed, "
+            f"{self.state['waiting']} waiting on a device) "
+            f"{throughput:.2f}/s, ETA {_format_duration(progress['eta_seconds'] or 0)}"
+        )
+
+
+@frappe.whitelist()
+def get_journal_progress():
+    """Pending entries and the progress of the current or last forwarder run"""
+    frappe.only_for("System Manager")
+
+    progress = frappe.cache().get(frappe.cache().make_key(PROGRESS_KEY))
+    return {
+        "pending": frappe.db.count("Fiscal Journal", {"status": "Pending"}),
+        "running": bool(frappe.cache().get(frappe.cache().make_key(FORWARDER_LOCK))),
+        "last_run": json.loads(progress) if progress else None,
+    }
@@ -0,0 +1,250 @@
+import time
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import flt, now_datetime
+from werkzeug.wrappers import Response
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.doctype.fiscal_queue.fiscal_queue import ACTIVE_STATUSES
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_health import get_heartbeat
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_pool import get_device_pool
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.queue_stats import get_queue_stats
+
+METRICS_KEY = "fiscal_metrics"
+
+# Stages of a fiscalization, in the order an invoice goes through them
+STAGES = (
+    "queue_wait",   # Queued row created until a dispatcher claims it
+    "load",         # Reading one or a batch of invoices
+    "format",       # Building a signing payload, replayed payloads are not timed
+    "http",         # Device round trip of one attempt, connect through response headers
+    "sign",         # Whole sign_invoice call including retries
+    "write_back",   # Writing results to invoices and queue rows, one or a batch
+)
+
+# Upper bounds of the histogram buckets in milliseconds, the last bucket is unbounded
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+def _key(*parts):
+    return frappe.cache().make_key("|".join((METRICS_KEY,) + parts))
+
+def _members(name):
+    # Pipelines send commands as they are, RedisWrapper would prefix the set key a second time
+    pipeline = frappe.cache().pipeline(transaction=False)
+    pipeline.smembers(_key(name))
+    return sorted(frappe.safe_decode(value) for value in pipeline.execute()[0])
+
+def _bucket(ms):
+    for index, bound in enumerate(BUCKETS_MS):
+        if ms <= bound:
+            return index
+    return len(BUCKETS_MS)
+
+def observe(stage, ms, device=None):
+    """Add one timing to the stage histogram shared by all workers"""
+    observe_all(stage, (ms,), device)
+
+def observe_all(stage, timings, device=None):
+    """Add several timings of a stage in a single Redis round trip"""
+    if not timings:
+        return
+
+    device = device or "all"
+    key = _key("stage", stage, device)
+    try:
+        pipeline = frappe.cache().pipeline(transaction=False)
+        for ms in timings:
+            pipeline.hincrby(key, f"b{_bucket(ms)}", 1)
+        pipeline.hincrby(key, "count", len(timings))
+        pipeline.hincrbyfloat(key, "sum", flt(sum(timings), 3))
+        pipeline.sadd(_key("series"), f"{stage}|{device}")
+        pipeline.execute()
+    except Exception:
+        # Metrics must never break fiscalization
+        frappe.logger().warning("Failed to record fiscal metrics", exc_info=True)
+
+@contextmanager
+def timed(stage, device=None):
+    """Time the enclosed block into `stage`"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, (time.perf_counter() - started) * 1000, device)
+
+def count_request(device, error=False, rejected=False):
+    """Count a device attempt, `error` for transport failures and `rejected` for non-200 answers"""
+    key = _key("device", device)
+    try:
+        pipeline = frappe.cache().pipeline(transaction=False)
+        pipeline.hincrby(key, "requests", 1)
+        if error:
+            pipeline.hincrby(key, "errors", 1)
+        if rejected:
+            pipeline.hincrby(key, "rejected", 1)
+        pipeline.sadd(_key("devices"), device)
+        pipeline.execute()
+    except Exception:
+        frappe.logger().warning("Failed to record fiscal metrics", exc_info=True)
+
+def get_histograms():
+    """{(stage, device): {"buckets": [...], "count": n, "sum": ms}} for every recorded series"""
+    series = _members("series")
+
+    pipeline = frappe.cache().pipeline(transaction=False)
+    for name in series:
+        pipeline.hgetall(_key("stage", *name.split("|", 1)))
+
+    histograms = {}
+    for name, values in zip(series, pipeline.execute()):
+        values = {frappe.safe_decode(field): value for field, value in values.items()}
+        histograms[tuple(name.split("|", 1))] = {
+            "buckets": [int(values.get(f"b{index}", 0)) for index in range(len(BUCKETS_MS) + 1)],
+            "count": int(values.get("count", 0)),
+            "sum": float(values.get("sum", 0)),
+        }
+    return histograms
+
+def get_device_counters():
+    devices = _members("devices")
+
+    pipeline = frappe.cache().pipeline(transaction=False)
+    for device in devices:
+        pipeline.hgetall(_key("device", device))
+
+    counters = {}
+    for device, values in zip(devices, pipeline.execute()):
+        values = {frappe.safe_decode(field): int(value) for field, value in values.items()}
+        counters[device] = {
+            "requests": values.get("requests", 0),
+            "errors": values.get("errors", 0),
+            "rejected": values.get("rejected", 0),
+        }
+    return counters
+
+def get_connect_latency():
+    """TCP connect time per device from the scheduled heartbeat, requests hides it inside the round trip"""
+    latency = {}
+    for device in get_device_pool():
+        heartbeat = get_heartbeat(device.get_device_key())
+        if heartbeat:
+            latency[device.name] = {
+                "reachable": bool(heartbeat.get("reachable")),
+                "connect_ms": heartbeat.get("latency_ms"),
+            }
+    return latency
+
+def get_queue_depth():
+    """Rows per active status and seconds the oldest Queued row has been waiting, from the Redis counters"""
+    counts, oldest = get_queue_stats()
+    depth = {status: counts[status] for status in ACTIVE_STATUSES + ("Failed",)}
+    lag = (now_datetime() - oldest).total_seconds() if oldest else 0
+    return depth, max(lag, 0)
+
+def percentile(histogram, quantile):
+    """Estimate a percentile in milliseconds by interpolating inside its bucket"""
+    target = histogram["count"] * quantile
+    if not target:
+        return 0.0
+
+    seen = 0
+    for index, count in enumerate(histogram["buckets"]):
+        if count and seen + count >= target:
+            lower = BUCKETS_MS[index - 1] if index else 0
+            # The unbounded bucket reports its lower bound
+            upper = BUCKETS_MS[index] if index < len(BUCKETS_MS) else lower
+            return round(lower + (upper - lower) * (target - seen) / count, 2)
+        seen += count
+    return float(BUCKETS_MS[-1])
+
+@frappe.whitelist()
+def get_metrics_summary():
+    """Per-stage p50/p95/p99, per-device error rates and queue depth/lag"""
+    frappe.only_for("System Manager")
+
+    stages = {}
+    for (stage, device), histogram in get_histograms().items():
+        stages.setdefault(stage, {})[device] = {
+            "count": histogram["count"],
+            "avg": round(histogram["sum"] / histogram["count"], 2) if histogram["count"] else 0,
+            "p50": percentile(histogram, 0.5),
+            "p95": percentile(histogram, 0.95),
+            "p99": percentile(histogram, 0.99),
+        }
+
+    devices = {}
+    for device, counters in get_device_counters().items():
+        requests = counters["requests"]
+        devices[device] = dict(
+            counters,
+            error_rate=round(counters["errors"] / requests, 4) if requests else 0,
+            rejection_rate=round(counters["rejected"] / requests, 4) if requests else 0,
+        )
+
+    for device, heartbeat in get_connect_latency().items():
+        devices.setdefault(device, {}).update(heartbeat)
+
+    depth, lag = get_queue_depth()
+    return {
+        "stages": stages,
+        "devices": devices,
+        "queue": {"depth": depth, "lag_seconds": round(lag, 1)},
+    }
+
+@frappe.whitelist()
+def prometheus_metrics():
+    """Prometheus text exposition of the fiscalization metrics"""
+    frappe.only_for("System Manager")
+
+    lines = [
+        "# HELP fiscal_stage_duration_milliseconds Duration of each fiscalization stage",
+        "# TYPE fiscal_stage_duration_milliseconds histogram",
+    ]
+    for (stage, device), histogram in get_histograms().items():
+        labels = f'stage="{stage}",device="{_escape(device)}"'
+        cumulative = 0
+        for index, count in enumerate(histogram["buckets"]):
+            cumulative += count
+            bound = BUCKETS_MS[index] if index < len(BUCKETS_MS) else "+Inf"
+            lines.append(f'fiscal_stage_duration_milliseconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"fiscal_stage_duration_milliseconds_sum{{{labels}}} {histogram['sum']}")
+        lines.append(f"fiscal_stage_duration_milliseconds_count{{{labels}}} {histogram['count']}")
+
+    lines.append("# TYPE fiscal_device_requests_total counter")
+    lines.append("# TYPE fiscal_device_errors_total counter")
+    lines.append("# TYPE fiscal_device_rejected_total counter")
+    for device, counters in get_device_counters().items():
+        labels = f'device="{_escape(device)}"'
+        lines.append(f"fiscal_device_requests_total{{{labels}}} {counters['requests']}")
+        lines.append(f"fiscal_device_errors_total{{{labels}}} {counters['errors']}")
+        lines.append(f"fiscal_device_rejected_total{{{labels}}} {counters['rejected']}")
+
+    lines.append("# HELP fiscal_device_connect_milliseconds TCP connect time of the last heartbeat")
+    lines.append("# TYPE fiscal_device_connect_milliseconds gauge")
+    lines.append("# TYPE fiscal_device_up gauge")
+    for device, heartbeat in get_connect_latency().items():
+        labels = f'device="{_escape(device)}"'
+        if heartbeat["reachable"]:
+            lines.append(f"fiscal_device_connect_milliseconds{{{labels}}} {heartbeat['connect_ms']}")
+        lines.append(f"fiscal_device_up{{{labels}}} {int(heartbeat['reachable'])}")
+
+    depth, lag = get_queue_depth()
+    lines.append("# TYPE fiscal_queue_depth gauge")
+    for status, count in depth.items():
+        lines.append(f'fiscal_queue_depth{{status="{status}"}} {count}')
+    lines.append("# TYPE fiscal_queue_lag_seconds gauge")
+    lines.append(f"fiscal_queue_lag_seconds {round(lag, 1)}")
+
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+@frappe.whitelist(methods=["POST"])
+def reset_metrics():
+    """Start the histograms and device counters over"""
+    frappe.only_for("System Manager")
+
+    keys = [_key("stage", *name.split("|", 1)) for name in _members("series")]
+    keys += [_key("device", device) for device in _members("devices")]
+    frappe.cache().delete(*keys, _key("series"), _key("devices"))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
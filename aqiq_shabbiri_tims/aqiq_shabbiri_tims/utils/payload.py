@@ -0,0 +1,90 @@
+import frappe
+from frappe.utils import rounded
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.vat import is_default_rate, resolve_vat
+
+# The device truncates item lines at 512 symbols
+MAX_ITEM_LENGTH = 512
+
+def get_rounding_method():
+    """The site's rounding method, resolved once per payload instead of once per amount"""
+    return frappe.get_system_settings("rounding_method") or "Banker's Rounding (legacy)"
+
+def get_hs_codes(item_codes):
+    """HS code of every distinct item code from a single Item query"""
+    codes = {code for code in item_codes if code}
+    if not codes or not frappe.get_meta("Item").has_field("custom_hscode"):
+        return {}
+
+    return dict(frappe.get_all(
+        "Item",
+        filters={"name": ["in", list(codes)], "custom_hscode": ["is", "set"]},
+        fields=["name", "custom_hscode"],
+        as_list=True
+    ))
+
+def columns_from_items(items):
+    """Split invoice item rows into the columns build_items_list expects"""
+    columns = frappe._dict(item_code=[], item_name=[], qty=[], amount=[], item_tax_template=[], hscode=[])
+    for item in items:
+        columns.item_code.append(item.get("item_code"))
+        columns.item_name.append(item.get("item_name"))
+        columns.qty.append(item.get("qty"))
+        columns.amount.append(item.get("amount"))
+        columns.item_tax_template.append(item.get("item_tax_template"))
+        columns.hscode.append(item.get("custom_hs_code"))
+    return columns
+
+def build_items_list(columns, hs_codes=None, vat=None):
+    """
+    Format all item lines in one pass.
+    Args:
+        columns: dict of equal length lists `item_code`, `item_name`, `qty`, `amount`
+            and optionally `item_tax_template` and `hscode` (a per-line HS code that wins over the Item's)
+        hs_codes: HS code per item code, looked up in one query when not given
+        vat: (rate, fiscal_code) per line, resolved from the cached VAT index when not given
+    Lines taxed at another rate than the default, e.g. zero-rated or exempt items, carry the Item's
+    HS code, which is how the control unit tells their VAT class. Default rate lines carry none.
+    Amounts are rounded with frappe's `rounded` and the site's rounding method, the
+    same as `flt(value, 2)`, so lines match the per-item formatting byte for byte.
+    Wholesale invoices repeat the same quantities and prices, so each distinct
+    value is rounded and formatted only once.
+    """
+    count = len(columns["item_code"])
+    if vat is None:
+        vat = resolve_vat(columns.get("item_tax_template") or [None] * count)
+    if hs_codes is None:
+        hs_codes = get_hs_codes(
+            item_code for item_code, (rate, _code) in zip(columns["item_code"], vat) if not is_default_rate(rate)
+        )
+
+    method = get_rounding_method()
+    formatted = {}
+
+    def fmt(value):
+        if not value:
+            # 0.0 and -0.0 share a dict key but not a format
+            return "%.2f" % rounded(value, 2, method)
+        text = formatted.get(value)
+        if text is None:
+            text = formatted[value] = "%.2f" % rounded(value, 2, method)
+        return text
+
+    line_hscodes = columns.get("hscode") or [None] * count
+    items_list = []
+    append = items_list.append
+
+    for item_code, item_name, qty, amount, hscode, (rate, _code) in zip(
+        columns["item_code"], columns["item_name"], columns["qty"], columns["amount"], line_hscodes, vat
+    ):
+        qty = float(qty or 0)
+        amount = float(amount or 0)
+        if not hscode and not is_default_rate(rate):
+            hscode = hs_codes.get(item_code)
+        hscode = hscode or ""
+
+        # Note the space at the start, unit price is unitNetto
+        line = f" {hscode}{item_name} {fmt(qty)} {fmt(amount / qty if qty else 0.0)} {fmt(amount)}"
+        append(line[:MAX_ITEM_LENGTH])
+
+    return items_list
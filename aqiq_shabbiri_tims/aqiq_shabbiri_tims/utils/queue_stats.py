@@ -0,0 +1,109 @@
+from datetime import datetime
+
+import frappe
+from frappe.utils import get_datetime, now_datetime
+
+STATS_KEY = "fiscal_queue_stats"
+STATUSES = ("Queued", "Processing", "Completed", "Failed")
+
+# Queued rows written to the sorted set per command during a reconcile
+RECONCILE_CHUNK_SIZE = 1000
+
+def _key(name):
+    return frappe.cache().make_key(f"{STATS_KEY}|{name}")
+
+def track(names, old_status, new_status, creation=None):
+    """
+    Count Fiscal Queue rows moving from `old_status` to `new_status`, None for a row that
+    is inserted or deleted. Redis is updated once the transaction commits, so transitions
+    that are rolled back are never counted.
+    Args:
+        names: Queue row name or list of names
+        creation (dict): {name: creation} of rows entering Queued, looked up when missing
+    """
+    names = [names] if isinstance(names, str) else list(names)
+    if not names or old_status == new_status:
+        return
+
+    if new_status == "Queued":
+        creation = dict(creation or {})
+        missing = [name for name in names if name not in creation]
+        if missing:
+            creation.update(frappe.get_all(
+                "Fiscal Queue", filters={"name": ["in", missing]}, fields=["name", "creation"], as_list=True
+            ))
+
+    frappe.db.after_commit.add(lambda: _apply(names, old_status, new_status, creation))
+
+def _apply(names, old_status, new_status, creation):
+    try:
+        pipeline = frappe.cache().pipeline(transaction=False)
+        if old_status:
+            pipeline.hincrby(_key("counts"), old_status, -len(names))
+        if new_status:
+            pipeline.hincrby(_key("counts"), new_status, len(names))
+        if old_status == "Queued":
+            pipeline.zrem(_key("queued"), *names)
+        if new_status == "Queued":
+            scores = {name: get_datetime(creation[name]).timestamp() for name in names if creation.get(name)}
+            if scores:
+                pipeline.zadd(_key("queued"), scores)
+        pipeline.execute()
+    except Exception:
+        # Counters must never break fiscalization, the reconcile job corrects them
+        frappe.logger().warning("Failed to update fiscal queue counters", exc_info=True)
+
+def get_queue_stats():
+    """
+    (rows per status, creation of the oldest Queued row or None) from Redis.
+    The counters are rebuilt from the table when Redis has none, e.g. after a restart.
+    """
+    pipeline = frappe.cache().pipeline(transaction=False)
+    pipeline.hgetall(_key("counts"))
+    pipeline.zrange(_key("queued"), 0, 0, withscores=True)
+    counts, oldest = pipeline.execute()
+
+    if not counts:
+        return reconcile_queue_stats()
+
+    counts = {frappe.safe_decode(status): int(count) for status, count in counts.items()}
+    return (
+        {status: max(counts.get(status, 0), 0) for status in STATUSES},
+        datetime.fromtimestamp(oldest[0][1]) if oldest else None,
+    )
+
+def reconcile_queue_stats():
+    """Rebuild the counters and the Queued set from the table, scheduled hourly to correct drift"""
+    counts = dict.fromkeys(STATUSES, 0)
+    counts.update(frappe.db.sql("select status, count(*) from `tabFiscal Queue` group by status"))
+    queued = frappe.db.sql("select name, creation from `tabFiscal Queue` where status = 'Queued'")
+
+    # One MULTI so readers never see the counters half rebuilt
+    pipeline = frappe.cache().pipeline(transaction=True)
+    pipeline.hgetall(_key("counts"))
+    pipeline.delete(_key("counts"), _key("queued"))
+    pipeline.hset(_key("counts"), mapping=counts)
+    for start in range(0, len(queued), RECONCILE_CHUNK_SIZE):
+        pipeline.zadd(_key("queued"), {
+            name: get_datetime(creation).timestamp() for name, creation in queued[start:start + RECONCILE_CHUNK_SIZE]
+        })
+    previous = pipeline.execute()[0]
+
+    previous = {frappe.safe_decode(status): int(count) for status, count in previous.items()}
+    drift = {status: count - previous.get(status, 0) for status, count in counts.items() if count != previous.get(status, 0)}
+    if previous and drift:
+        frappe.logger().info(f"Fiscal queue counters corrected by {drift}")
+
+    return counts, min((creation for _name, creation in queued), default=None)
+
+@frappe.whitelist()
+def get_queue_summary():
+    """Rows per status and how long the oldest Queued row has been waiting, without querying the table"""
+    frappe.only_for("System Manager")
+
+    counts, oldest = get_queue_stats()
+    return {
+        "counts": counts,
+        "oldest_queued": oldest,
+        "lag_seconds": round(max((now_datetime() - oldest).total_seconds(), 0), 1) if oldest else 0,
+    }
@@ -0,0 +1,62 @@
+import hashlib
+import json
+
+import frappe
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.metrics import timed
+
+# Long enough to cover every retry of an invoice, see RETRY_MAX_DELAY in fiscal_queue
+REPLAY_TTL = 3 * 24 * 60 * 60
+
+def payload_digest(payload):
+    """Stable hash of a signing payload"""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+def _key(invoice_name, suffix):
+    return frappe.cache().make_key(f"fiscal_replay|{invoice_name}|{suffix}")
+
+def _get(key):
+    value = frappe.cache().get(key)
+    return json.loads(value) if value else None
+
+def _exists(key):
+    # RedisWrapper.exists would prefix the key a second time
+    pipeline = frappe.cache().pipeline(transaction=False)
+    pipeline.exists(key)
+    return bool(pipeline.execute()[0])
+
+def _set(key, value):
+    frappe.cache().set(key, json.dumps(value, separators=(",", ":")), ex=REPLAY_TTL)
+
+def get_cached_payload(invoice, device, build):
+    """
+    Payload formatted by an earlier attempt for this version of `invoice` on `device`, or `build()` stored
+    for later ones. Every retry then sends the same payload and hits the replay store. The cache is not
+    rolled back with the database, so the key carries the invoice's `modified`: a submit rolled back,
+    edited and submitted again formats a new payload. It also carries the device's PIN, so an invoice
+    routed to another device or a changed PIN formats a new one.
+    """
+    key = _key(invoice.name, f"payload|{invoice.modified}|{device.name}|{device.control_unit_pin}")
+    payload = _get(key)
+    if payload is None:
+        with timed("format"):
+            payload = build()
+        _set(key, payload)
+    return payload
+
+def record_request(payload, digest):
+    """Note that a payload is about to be sent, before the device sees it"""
+    _set(_key(payload.get("invoice_number"), f"request|{digest}"), {"sent_at": frappe.utils.now()})
+
+def record_response(payload, digest, response):
+    """Store the device response as soon as it arrives"""
+    _set(_key(payload.get("invoice_number"), f"response|{digest}"), response)
+
+def get_replayed_response(payload, digest):
+    """Response the device already returned for this exact payload, None if it never answered"""
+    response = _get(_key(payload.get("invoice_number"), f"response|{digest}"))
+    if response is None and _exists(_key(payload.get("invoice_number"), f"request|{digest}")):
+        frappe.logger().warning(
+            f"Fiscal payload for {payload.get('invoice_number')} was sent before without a recorded response"
+        )
+    return response
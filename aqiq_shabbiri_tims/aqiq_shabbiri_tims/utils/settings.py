@@ -0,0 +1,54 @@
+import frappe
+
+SETTINGS_VERSION_KEY = "fiscal_device_settings_version"
+
+# site -> (version, frozen Fiscal Device Settings document)
+_snapshots = {}
+# site -> (version, tuple of frozen enabled Fiscal Device documents)
+_device_snapshots = {}
+
+def get_fiscal_settings():
+    """
+    Read-only snapshot of Fiscal Device Settings, cached per process and site.
+    The only steady-state cost is one Redis GET of the version key, which
+    FiscalDeviceSettings.on_update bumps so every worker reloads on its next call.
+    """
+    site = frappe.local.site
+    version = _get_version()
+
+    cached = _snapshots.get(site)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    settings = frappe.get_doc("Fiscal Device Settings")
+    settings.freeze()
+    _snapshots[site] = (version, settings)
+    return settings
+
+def get_fiscal_devices():
+    """Read-only snapshots of the enabled Fiscal Device pool, invalidated with the settings"""
+    site = frappe.local.site
+    version = _get_version()
+
+    cached = _device_snapshots.get(site)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    devices = []
+    for name in frappe.get_all("Fiscal Device", filters={"enabled": 1}, order_by="name asc", pluck="name"):
+        device = frappe.get_doc("Fiscal Device", name)
+        device.freeze()
+        devices.append(device)
+
+    devices = tuple(devices)
+    _device_snapshots[site] = (version, devices)
+    return devices
+
+def invalidate_fiscal_settings():
+    """Make every process reload its settings and device snapshots"""
+    frappe.cache().set(frappe.cache().make_key(SETTINGS_VERSION_KEY), frappe.generate_hash(length=10))
+    _snapshots.pop(frappe.local.site, None)
+    _device_snapshots.pop(frappe.local.site, None)
+
+def _get_version():
+    return frappe.cache().get(frappe.cache().make_key(SETTINGS_VERSION_KEY))
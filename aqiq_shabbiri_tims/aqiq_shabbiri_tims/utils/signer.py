@@ -0,0 +1,277 @@
+import frappe
+import requests
+from frappe import _
+from frappe.utils import cint, flt, getdate
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_client import (
+    DeviceRejectedError,
+    DeviceUnavailableError,
+    get_client
+)
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_health import check_device, get_heartbeat
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.metrics import count_request, observe, timed
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.payload import build_items_list, columns_from_items
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.replay import (
+    get_replayed_response,
+    payload_digest,
+    record_request,
+    record_response
+)
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.timeouts import CallBudget
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.trace import add_attempt, finish_trace, start_trace
+
+
+class FiscalSigner:
+    """
+    Signing behaviour shared by Fiscal Device Settings, the default device,
+    and the Fiscal Device pool. Each device has its own pooled client and circuit breaker.
+    """
+
+    def __setattr__(self, name, value):
+        # Snapshots from get_fiscal_settings and get_fiscal_devices are shared across requests in a worker
+        if not name.startswith("_") and self.__dict__.get("_frozen"):
+            raise AttributeError(f"{self.doctype} snapshot is read-only, cannot set {name}")
+        super().__setattr__(name, value)
+
+    def freeze(self):
+        """Make the document read-only so it can be shared as a settings snapshot"""
+        self._frozen = True
+
+    def is_enabled(self, settings=None):
+        return bool(cint(self.enable_device))
+
+    def get_client(self):
+        """Get the pooled HTTP client for the configured device"""
+        return get_client(
+            self.device_ip, self.port, self.bearer_token, key=self.name, max_in_flight=self.get_max_in_flight()
+        )
+
+    def get_device_key(self):
+        return f"{self.device_ip}:{cint(self.port)}"
+
+    def get_max_in_flight(self):
+        return max(cint(self.max_in_flight), 1)
+
+    def get_circuit_breaker(self, settings=None):
+        """Circuit breaker shared by all workers signing with this device"""
+        # Thresholds are set once in Fiscal Device Settings for every device
+        settings = settings or get_fiscal_settings()
+        return CircuitBreaker(
+            self.get_device_key(),
+            failure_threshold=settings.circuit_failure_threshold,
+            cooldown=settings.circuit_cooldown
+        )
+
+    def get_connection_status(self):
+        """Device status from the cached heartbeat and circuit breaker, no signing round trip"""
+        if not self.device_ip or not self.port:
+            return {
+                'status': 'Not Configured',
+                'color': 'red',
+                'message': _('Device IP and Port not configured')
+            }
+
+        if self.get_circuit_breaker().is_open():
+            return {
+                'status': 'Circuit Open',
+                'color': 'orange',
+                'message': _('Device is failing, signing requests are paused')
+            }
+
+        heartbeat = get_heartbeat(self.get_device_key()) or check_device(self)
+
+        if heartbeat.get('reachable'):
+            return {
+                'status': 'Connected',
+                'color': 'green',
+                'message': _('Device is connected and ready')
+            }
+        else:
+            return {
+                'status': 'Disconnected',
+                'color': 'red',
+                'message': heartbeat.get('error') or _('Connection failed')
+            }
+
+    def sign_invoice(self, invoice_data, is_inclusive=True, retries=3, timeout=None, breaker=None, sampled=None,
+        enabled=None):
+        """
+        Sign an invoice with the fiscal device
+        Args:
+            invoice_data (dict): Invoice data to be signed
+            is_inclusive (bool): Whether prices are VAT inclusive
+            retries (int): Most attempts, transport errors only
+            timeout (float): Seconds the whole call may take across attempts, defaults to SIGN_DEADLINE
+            breaker (CircuitBreaker): The device's breaker,
+            sampled (bool): whether to trace the call, and
+            enabled (bool): whether the device may sign, all resolved from the settings when None.
+                Callers signing on worker threads pass them so the thread never reads the database.
+        """
+        if not (self.is_enabled() if enabled is None else enabled):
+            frappe.throw(_("Fiscal Device is not enabled"))
+
+        if not self.device_ip or not self.port:
+            frappe.throw(_("Device IP and Port must be configured"))
+
+        # A retry after the device already signed this payload reuses its response
+        digest = payload_digest(invoice_data)
+        replayed = get_replayed_response(invoice_data, digest)
+        if replayed is not None:
+            return replayed
+
+        # Sampling is decided before anything is serialized, unsampled calls pay nothing
+        trace = start_trace(self, invoice_data, sampled)
+        try:
+            response = self._sign(invoice_data, digest, is_inclusive, retries, timeout, trace, breaker)
+        except Exception as e:
+            finish_trace(trace, error=e)
+            raise
+        finish_trace(trace, response=response)
+        return response
+
+    def _sign(self, invoice_data, digest, is_inclusive, retries, timeout, trace, breaker=None):
+        client = self.get_client()
+        attempts = SignAttempts(self, invoice_data, digest, retries, timeout, trace, breaker)
+
+        with timed("sign", self.name):
+            for timeouts in attempts:
+                try:
+                    response = client.sign(invoice_data, is_inclusive=is_inclusive, **timeouts)
+                except requests.exceptions.RequestException as e:
+                    attempts.transport_error(e, timeouts, timed_out=isinstance(e, requests.exceptions.ReadTimeout))
+                    continue
+
+                response_data = attempts.answer(response)
+                if response_data is not None:
+                    return response_data
+
+            attempts.exhausted()
+
+    def format_invoice_data(self, invoice, items, is_inclusive=True):
+        """
+        Format invoice data for fiscal device
+        Args:
+            invoice: Sales Invoice document
+            items: List of invoice items, or their columns as built by columns_from_items
+            is_inclusive: Whether prices are VAT inclusive
+        """
+        invoice_date = getdate(invoice.posting_date).strftime("%d_%m_%Y")
+
+        # Calculate totals with exactly 2 decimal places
+        grand_total = "{:.2f}".format(flt(invoice.grand_total, 2))
+        net_total = "{:.2f}".format(flt(invoice.net_total, 2))
+        tax_total = "{:.2f}".format(flt(invoice.total_taxes_and_charges, 2))
+        discount_total = "{:.2f}".format(flt(invoice.discount_amount, 2))
+
+        # Format items list according to documentation, accepts rows or prepared columns
+        columns = items if isinstance(items, dict) else columns_from_items(items)
+        items_list = build_items_list(columns)
+
+        # Construct payload according to documentation
+        payload = {
+            "invoice_date": invoice_date,
+            "invoice_number": invoice.name,
+            "invoice_pin": self.control_unit_pin,
+            "customer_pin": invoice.tax_id or "",
+            "customer_exid": invoice.custom_tax_exemption_id or "",
+            "grand_total": grand_total,
+            "net_subtotal": net_total if is_inclusive else "",  # Only for inclusive VAT
+            "tax_total": tax_total,
+            "net_discount_total": discount_total,
+            "sel_currency": invoice.currency,
+            "rel_doc_number": invoice.return_against or "",
+            "items_list": items_list
+        }
+
+        return payload
+
+
+class SignAttempts:
+    """
+    Retry policy and bookkeeping of one signing call, shared by the blocking and the asyncio clients,
+    which only differ in how they send a request. Iterating yields the timeouts of each attempt.
+    Device rejections (an answer with a `description`) are raised at once as DeviceRejectedError.
+    Transport errors and answers without a description are retried while attempts remain
+    and the call's deadline can still fit one.
+    """
+
+    def __init__(self, device, invoice_data, digest, retries, timeout, trace=None, breaker=None):
+        self.device = device
+        self.invoice_data = invoice_data
+        self.digest = digest
+        self.retries = retries
+        self.trace = trace
+        self.breaker = breaker or device.get_circuit_breaker()
+        self.error = None
+
+        if not self.breaker.allow_request():
+            frappe.throw(
+                _("Fiscal device is unavailable, retrying after the cool-down period"),
+                exc=CircuitOpenError
+            )
+
+        self.budget = CallBudget(device.get_device_key(), deadline=timeout)
+        record_request(invoice_data, digest)
+
+    def __iter__(self):
+        for attempt in range(self.retries):
+            timeouts = self.budget.next_attempt()
+            if timeouts is None:
+                return
+            if attempt:
+                frappe.logger().info(f"Retrying fiscalization (attempt {attempt + 1}/{self.retries})")
+            yield timeouts
+
+    def transport_error(self, error, timeouts, timed_out=False):
+        """The device did not answer, raises CircuitOpenError once the breaker opens"""
+        frappe.logger().error(f"Fiscal Device Request Error: {error!r}")
+        self.breaker.record_failure()
+        count_request(self.device.name, error=True)
+        if self.trace is not None:
+            add_attempt(self.trace, error=error)
+        if timed_out:
+            self.budget.back_off(timeouts)
+        if self.breaker.is_open():
+            frappe.throw(_("Fiscal device is unavailable: {0}").format(repr(error)), exc=CircuitOpenError)
+        self.error = repr(error)
+
+    def answer(self, response):
+        """The response data of a signed invoice, None when the attempt may be retried"""
+        # Any HTTP answer means the device is up, rejections are not health failures
+        self.breaker.record_success()
+        elapsed_ms = response.elapsed.total_seconds() * 1000
+        self.budget.record(elapsed_ms)
+        observe("http", elapsed_ms, self.device.name)
+        count_request(self.device.name, rejected=response.status_code != 200)
+        if self.trace is not None:
+            add_attempt(self.trace, response=response)
+
+        if response.status_code == 200:
+            response_data = response.json()
+            record_response(self.invoice_data, self.digest, response_data)
+            return response_data
+
+        description = _get_description(response)
+        if description:
+            frappe.logger().error(f"Fiscal Device Error: {description}")
+            frappe.throw(_("Device rejected the invoice: {0}").format(description), exc=DeviceRejectedError)
+
+        # No description, e.g. a proxy error page, may well pass on the next attempt
+        frappe.logger().error(f"Fiscal Device Error: HTTP {response.status_code}")
+        self.error = _("HTTP {0}").format(response.status_code)
+        return None
+
+    def exhausted(self):
+        frappe.throw(_("Failed to sign invoice after {0} attempt(s) within {1}s. Last error: {2}").format(
+            self.budget.attempts, flt(self.budget.seconds, 1), self.error or _("no time left for an attempt")
+        ), exc=DeviceUnavailableError)
+
+
+def _get_description(response):
+    """The device's `description` of a non-200 answer, None when the body is not the device's JSON"""
+    try:
+        return response.json().get("description")
+    except (ValueError, AttributeError):
+        return None
@@ -0,0 +1,124 @@
+import json
+import time
+
+import frappe
+from frappe.utils import flt
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_client import CONNECT_TIMEOUT, READ_TIMEOUT
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_health import get_heartbeat
+
+LATENCY_KEY = "fiscal_latency"
+
+# Overall seconds a sign_invoice call may take across all of its attempts
+SIGN_DEADLINE = 30
+
+# Smoothing of the round trip estimate and of its deviation, as for TCP retransmission timers
+ALPHA = 1 / 8
+BETA = 1 / 4
+# Deviations added to the smoothed round trip for the read timeout, roughly its p99
+DEVIATIONS = 4
+
+# Bounds of the adaptive timeouts in seconds. A read timeout that cuts off a device that is
+# merely slow would make it sign the retry twice, so the floor stays generous.
+MIN_READ_TIMEOUT = 5
+MIN_CONNECT_TIMEOUT = 1
+# A LAN device that answered the heartbeat connects well within this, CONNECT_TIMEOUT is kept
+# for devices without a recent heartbeat
+MAX_CONNECT_TIMEOUT = 3
+# Connect timeout as a multiple of the heartbeat's TCP connect time
+CONNECT_MULTIPLIER = 20
+
+# Attempts shorter than this are not worth starting
+MIN_ATTEMPT = 0.5
+
+def _key(device_key):
+    return frappe.cache().make_key(f"{LATENCY_KEY}|{device_key}")
+
+def get_estimate(device_key):
+    """{"srtt": ms, "rttvar": ms, "samples": n} for a device endpoint, None before its first answer"""
+    try:
+        value = frappe.cache().get(_key(device_key))
+    except Exception:
+        return None
+    return json.loads(value) if value else None
+
+def record_latency(device_key, ms, estimate=None):
+    """Fold one device round trip into the endpoint's smoothed estimate, returns the new estimate"""
+    if estimate is None:
+        estimate = {"srtt": ms, "rttvar": ms / 2, "samples": 0}
+    else:
+        estimate = dict(estimate)
+        estimate["rttvar"] = (1 - BETA) * estimate["rttvar"] + BETA * abs(estimate["srtt"] - ms)
+        estimate["srtt"] = (1 - ALPHA) * estimate["srtt"] + ALPHA * ms
+    estimate["samples"] += 1
+
+    try:
+        frappe.cache().set(_key(device_key), json.dumps({k: round(v, 2) for k, v in estimate.items()}))
+    except Exception:
+        # Workers start from the fixed timeouts again, nothing else depends on it
+        frappe.logger().warning("Failed to record fiscal device latency", exc_info=True)
+    return estimate
+
+def get_read_timeout(estimate):
+    if not estimate:
+        return READ_TIMEOUT
+    seconds = (estimate["srtt"] + DEVIATIONS * estimate["rttvar"]) / 1000
+    return min(max(seconds, MIN_READ_TIMEOUT), READ_TIMEOUT)
+
+def get_connect_timeout(device_key):
+    heartbeat = get_heartbeat(device_key)
+    if not heartbeat or not heartbeat.get("reachable"):
+        return CONNECT_TIMEOUT
+    seconds = flt(heartbeat.get("latency_ms")) * CONNECT_MULTIPLIER / 1000
+    return min(max(seconds, MIN_CONNECT_TIMEOUT), MAX_CONNECT_TIMEOUT)
+
+
+class CallBudget:
+    """
+    Deadline of one signing call and the timeouts of each of its attempts.
+    Read timeouts follow the device's smoothed latency, and an attempt is only
+    started while the time left can hold a typical round trip.
+    """
+
+    def __init__(self, device_key, deadline=None):
+        self.device_key = device_key
+        self.seconds = flt(deadline) or SIGN_DEADLINE
+        self.deadline = time.monotonic() + self.seconds
+        self.estimate = get_estimate(device_key)
+        self.connect_timeout = get_connect_timeout(device_key)
+        self.read_timeout = get_read_timeout(self.estimate)
+        self.attempts = 0
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def expected(self):
+        """Seconds a typical attempt takes, the smoothed round trip plus one deviation"""
+        if not self.estimate:
+            return MIN_ATTEMPT
+        return max((self.estimate["srtt"] + self.estimate["rttvar"]) / 1000, MIN_ATTEMPT)
+
+    def next_attempt(self):
+        """{"connect_timeout": s, "read_timeout": s} for the next attempt, None when it no longer fits"""
+        remaining = self.remaining()
+        if remaining < (self.expected() if self.attempts else MIN_ATTEMPT):
+            return None
+
+        self.attempts += 1
+        connect_timeout = min(self.connect_timeout, remaining / 2)
+        return {
+            "connect_timeout": connect_timeout,
+            "read_timeout": min(self.read_timeout, remaining - connect_timeout),
+        }
+
+    def record(self, elapsed_ms):
+        self.estimate = record_latency(self.device_key, elapsed_ms, self.estimate)
+
+    def back_off(self, timeouts):
+        """
+        After a read timeout, as TCP does on a retransmission timeout: the timeout counts as
+        a round trip of at least that long, and the next attempt waits twice as long.
+        Without this a device that slows past the estimate is cut off on every attempt.
+        """
+        self.record(timeouts["read_timeout"] * 1000)
+        self.read_timeout = min(max(self.read_timeout * 2, get_read_timeout(self.estimate)), READ_TIMEOUT)
@@ -0,0 +1,81 @@
+import json
+import random
+import time
+
+import frappe
+from frappe.utils import flt, now
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings
+
+TRACE_KEY = "fiscal_traces"
+# Traces kept in the ring buffer, older ones are dropped
+TRACE_LIMIT = 200
+# Device response bodies are cut to this many characters
+MAX_BODY_LENGTH = 2000
+
+def is_sampled():
+    """Whether to trace this call: Debug Mode is on and the call falls within the sample rate"""
+    settings = get_fiscal_settings()
+    if not settings.debug_mode:
+        return False
+    return random.random() * 100 < flt(settings.trace_sample_rate)
+
+def start_trace(device, payload, sampled=None):
+    """A trace for a signing call, or None when it is not sampled. `sampled` is decided by is_sampled when None"""
+    if not (is_sampled() if sampled is None else sampled):
+        return None
+
+    return {
+        "device": device.name,
+        "invoice_number": payload.get("invoice_number"),
+        "started_at": now(),
+        "payload": payload,
+        "attempts": [],
+        "_started": time.perf_counter(),
+    }
+
+def add_attempt(trace, response=None, error=None):
+    """Note one device attempt, the response status and body or the transport error"""
+    attempt = {"elapsed_ms": round((time.perf_counter() - trace["_started"]) * 1000, 2)}
+    if response is not None:
+        attempt.update(status=response.status_code, body=response.text[:MAX_BODY_LENGTH])
+    if error is not None:
+        attempt.update(error=str(error))
+    trace["attempts"].append(attempt)
+
+def finish_trace(trace, response=None, error=None):
+    """Push a sampled trace into the Redis ring buffer"""
+    if trace is None:
+        return
+
+    started = trace.pop("_started")
+    trace["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    if response is not None:
+        trace["response"] = response
+    if error is not None:
+        trace["error"] = str(error)
+
+    key = frappe.cache().make_key(TRACE_KEY)
+    try:
+        pipeline = frappe.cache().pipeline(transaction=False)
+        pipeline.lpush(key, json.dumps(trace, default=str, separators=(",", ":")))
+        pipeline.ltrim(key, 0, TRACE_LIMIT - 1)
+        pipeline.execute()
+    except Exception:
+        # Tracing must never break fiscalization
+        frappe.logger().warning("Failed to record fiscal trace", exc_info=True)
+
+@frappe.whitelist()
+def get_traces(limit=50):
+    """Most recent traces first"""
+    frappe.only_for("System Manager")
+
+    limit = min(max(int(limit), 1), TRACE_LIMIT)
+    pipeline = frappe.cache().pipeline(transaction=False)
+    pipeline.lrange(frappe.cache().make_key(TRACE_KEY), 0, limit - 1)
+    return [json.loads(value) for value in pipeline.execute()[0]]
+
+@frappe.whitelist(methods=["POST"])
+def clear_traces():
+    frappe.only_for("System Manager")
+    frappe.cache().delete(frappe.cache().make_key(TRACE_KEY))
@@ -0,0 +1,58 @@
+import frappe
+from frappe.utils import flt
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.settings import get_fiscal_settings
+
+VAT_INDEX_KEY = "fiscal_vat_index"
+DEFAULT_VAT_RATE = 16
+# Used until a VAT Account is set in Fiscal Device Settings
+DEFAULT_VAT_ACCOUNT = "VAT - SHKL"
+
+def get_vat_index():
+    """Cached mapping of Item Tax Template to (rate, fiscal_code)"""
+    return frappe.cache().get_value(VAT_INDEX_KEY, generator=build_vat_index)
+
+def build_vat_index():
+    """Build the Item Tax Template index from the VAT account rows and the Fiscal VAT Rate table"""
+    settings = get_fiscal_settings()
+    codes = get_fiscal_codes(settings)
+
+    rows = frappe.get_all(
+        "Item Tax Template Detail",
+        filters={"parenttype": "Item Tax Template", "tax_type": settings.vat_account or DEFAULT_VAT_ACCOUNT},
+        fields=["parent", "tax_rate"]
+    )
+
+    index = {"": (DEFAULT_VAT_RATE, codes.get(flt(DEFAULT_VAT_RATE), ""))}
+    for row in rows:
+        rate = flt(row.tax_rate)
+        index[row.parent] = (rate, codes.get(rate, ""))
+    return index
+
+def get_fiscal_codes(settings):
+    """Fiscal code per VAT rate from the Fiscal VAT Rate table"""
+    return {
+        flt(str(row.tax_rate or "").rstrip("%")): row.fiscal_code
+        for row in settings.get("vat_rates") or []
+        if row.fiscal_code
+    }
+
+def resolve_vat(templates):
+    """
+    (rate, fiscal_code) for the Item Tax Template of every item of an invoice from one cached index lookup.
+    Items without a template, or whose template has no VAT row, get the default rate.
+    """
+    index = get_vat_index()
+    default = index[""]
+    return [index.get(template or "", default) for template in templates]
+
+def is_default_rate(rate):
+    return flt(rate) == flt(DEFAULT_VAT_RATE)
+
+def on_item_tax_template_change(doc, method=None):
+    """Hooked on Item Tax Template changes, a worker rebuilding earlier would keep the old rows"""
+    frappe.db.after_commit.add(clear_vat_index)
+
+def clear_vat_index():
+    """Drop the VAT index, the next lookup rebuilds it"""
+    frappe.cache().delete_value(VAT_INDEX_KEY)
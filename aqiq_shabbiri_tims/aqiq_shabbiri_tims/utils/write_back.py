@@ -0,0 +1,94 @@
+import json
+
+import frappe
+from frappe.utils import now_datetime
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.metrics import timed
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.queue_stats import track
+
+# Rows per UPDATE statement in write_fiscal_results
+CHUNK_SIZE = 200
+
+def dump_response(response):
+    """Serialize a device response without whitespace for the queue's Response field"""
+    return json.dumps(response, separators=(",", ":"))
+
+def write_fiscal_result(invoice_name, queue_name, response, doc=None, from_status="Processing", doctype="Sales Invoice"):
+    """
+    Store a signing result with one UPDATE on the invoice and one on the Fiscal Queue row.
+    Nothing is committed, the caller's transaction covers both statements.
+    Args:
+        invoice_name (str): Invoice name
+        queue_name (str): Fiscal Queue row to complete, None when there is no row to update
+        response (dict): Device response
+        doc: In-memory invoice document to update as well, e.g. during on_submit
+        from_status (str): Status of the queue row before it completes
+        doctype (str): Sales Invoice or POS Invoice
+    """
+    write_fiscal_results([(invoice_name, queue_name, response)], from_status, doctype)
+
+    if doc is not None:
+        for fieldname, value in get_invoice_values(response).items():
+            doc.set(fieldname, value)
+
+def write_fiscal_results(results, from_status="Processing", doctype="Sales Invoice"):
+    """
+    Store many signing results, two UPDATE statements per chunk of CHUNK_SIZE rows.
+    Args:
+        results: list of (invoice_name, queue_name, response)
+        from_status (str): Status of the queue rows before they complete
+        doctype (str): Doctype of all the invoices, Sales Invoice or POS Invoice
+    """
+    if not results:
+        return
+
+    with timed("write_back"):
+        for start in range(0, len(results), CHUNK_SIZE):
+            chunk = results[start:start + CHUNK_SIZE]
+            _update_invoices(chunk, doctype)
+            _update_queue_rows([row for row in chunk if row[1]], from_status)
+
+def get_invoice_values(response):
+    return {
+        "custom_fiscal_invoice_number": response.get("cu_invoice_number"),
+        "custom_fiscal_verification_url": response.get("verify_url"),
+        "custom_is_fiscalized": 1
+    }
+
+def _case(values):
+    """`case name when %s then %s ... end` and its parameters"""
+    sql = "case name " + " ".join(["when %s then %s"] * len(values)) + " end"
+    return sql, [param for pair in values for param in pair]
+
+def _update_invoices(chunk, doctype):
+    # modified is left alone so open forms and the submitting request do not see a conflict
+    number_sql, number_params = _case([(invoice, response.get("cu_invoice_number")) for invoice, _queue, response in chunk])
+    url_sql, url_params = _case([(invoice, response.get("verify_url")) for invoice, _queue, response in chunk])
+    names = [invoice for invoice, _queue, _response in chunk]
+
+    frappe.db.sql(f"""
+        update `tab{doctype}`
+        set custom_fiscal_invoice_number = {number_sql},
+            custom_fiscal_verification_url = {url_sql},
+            custom_is_fiscalized = 1
+        where name in ({", ".join(["%s"] * len(names))})
+    """, number_params + url_params + names)
+
+def _update_queue_rows(chunk, from_status):
+    if not chunk:
+        return
+
+    response_sql, response_params = _case([(queue, dump_response(response)) for _invoice, queue, response in chunk])
+    names = [queue for _invoice, queue, _response in chunk]
+    now = now_datetime()
+
+    frappe.db.sql(f"""
+        update `tabFiscal Queue`
+        set status = 'Completed',
+            response = {response_sql},
+            completion_time = %s,
+            modified = %s,
+            modified_by = %s
+        where name in ({", ".join(["%s"] * len(names))})
+    """, response_params + [now, now, frappe.session.user] + names)
+    track(names, from_status, "Completed")
@@ -0,0 +1,56 @@
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("fiscalize-invoices")
+@click.option("--from-date", help="Earliest posting date to fiscalize")
+@click.option("--to-date", help="Latest posting date to fiscalize")
+@click.option("--company", help="Only invoices of this company")
+@click.option("--naming-series", help="Only invoices of this naming series")
+@click.option("--rate", type=float, help="Invoices sent to the device per second, 0 for no limit (default 2)")
+@click.option("--batch-size", type=int, help="Invoices read and checkpointed per batch (default 100)")
+@click.option("--checkpoint", help="Checkpoint name, defaults to one derived from the filters")
+@click.option("--restart", is_flag=True, default=False, help="Ignore an existing checkpoint and start over")
+@pass_context
+def fiscalize_invoices(context, from_date=None, to_date=None, company=None, naming_series=None,
+        rate=None, batch_size=None, checkpoint=None, restart=False):
+    """Fiscalize submitted invoices that were never signed, resuming from the last checkpoint"""
+    from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.backfill import Backfill
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+    try:
+        Backfill(
+            from_date=from_date,
+            to_date=to_date,
+            company=company,
+            naming_series=naming_series,
+            rate=rate,
+            batch_size=batch_size,
+            name=checkpoint,
+            echo=click.echo
+        ).run(restart=restart)
+    finally:
+        frappe.destroy()
+
+
+
+@click.command("forward-fiscal-journal")
+@click.option("--chunk-size", type=int, help="Journal entries read per query (default 100)")
+@pass_context
+def forward_fiscal_journal(context, chunk_size=None):
+    """Send Pending Fiscal Journal entries to their devices in submit order"""
+    from aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.journal import Forwarder
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+    try:
+        Forwarder(chunk_size=chunk_size, echo=click.echo).run()
+    finally:
+        frappe.destroy()
+
+
+commands = [fiscalize_invoices, forward_fiscal_journal]
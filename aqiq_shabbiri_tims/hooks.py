@@ -125,6 +125,13 @@ app_license = "mit"
 doc_events = {
     "Sales Invoice": {        
         "on_submit": "aqiq_shabbiri_tims.aqiq_shabbiri_tims.custom.sales_invoice.on_submit"
+    },
+    "POS Invoice": {
+        "on_submit": "aqiq_shabbiri_tims.aqiq_shabbiri_tims.custom.pos_invoice.on_submit"
+    },
+    "Item Tax Template": {
+        "on_update": "aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.vat.on_item_tax_template_change",
+        "on_trash": "aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.vat.on_item_tax_template_change"
     }
 }
 
@@ -240,6 +247,11 @@ fixtures = [
                     "Sales Invoice-custom_is_fiscalized",
                     "Sales Invoice-custom_tims",
                     "Sales Invoice-custom_tax_exemption_id",
+                    "POS Invoice-custom_fiscal_device_details",
+                    "POS Invoice-custom_fiscal_invoice_number",
+                    "POS Invoice-custom_fiscal_verification_url",
+                    "POS Invoice-custom_is_fiscalized",
+                    "POS Invoice-custom_tax_exemption_id",
                     "Item-custom_hscode"
                 ]
             ]
@@ -257,13 +269,22 @@ fixtures = [
     }
 ]
 
-# Scheduled task to retry failed fiscalizations
-# scheduler_events = {
-#     "cron": {
-#         "*/1 * * * *": [  # Every 1 minute
-#             "aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.fiscal_queue.process_failed_queue"
-#         ]
-#     }
-# }
+# Scheduled tasks for the fiscal queue
+scheduler_events = {
+    "cron": {
+        "*/1 * * * *": [  # Every 1 minute
+            "aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.fiscal_queue.start_dispatcher",
+            "aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.fiscal_queue.process_failed_queue",
+            "aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.device_health.check_device_health",
+            "aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.journal.resume_forwarding"
+        ]
+    },
+    "hourly": [
+        "aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.queue_stats.reconcile_queue_stats"
+    ],
+    "daily_long": [
+        "aqiq_shabbiri_tims.aqiq_shabbiri_tims.utils.archive.archive_completed_queue"
+    ]
+}
 
 
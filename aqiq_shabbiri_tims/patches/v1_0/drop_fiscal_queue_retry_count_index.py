@@ -0,0 +1,7 @@
+import frappe
+
+
+def execute():
+	"""Retries are picked by next_retry_at, nothing reads Failed rows by retry_count and modified any more"""
+	if frappe.db.has_index("tabFiscal Queue", "status_retry_count_modified_index"):
+		frappe.db.sql_ddl("alter table `tabFiscal Queue` drop index `status_retry_count_modified_index`")
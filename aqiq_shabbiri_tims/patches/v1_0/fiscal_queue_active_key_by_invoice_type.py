@@ -0,0 +1,13 @@
+import frappe
+
+
+def execute():
+	"""
+	Rows from before POS Invoice support are Sales Invoices. The active row key now includes the
+	invoice type, the key on the invoice alone would keep a POS Invoice and a Sales Invoice of the
+	same name from being fiscalized side by side.
+	"""
+	frappe.db.sql("update `tabFiscal Queue` set invoice_type = 'Sales Invoice' where ifnull(invoice_type, '') = ''")
+
+	if frappe.db.has_index("tabFiscal Queue", "unique_active_invoice"):
+		frappe.db.sql_ddl("alter table `tabFiscal Queue` drop index `unique_active_invoice`")
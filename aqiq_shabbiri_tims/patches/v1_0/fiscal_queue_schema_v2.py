@@ -0,0 +1,46 @@
+import frappe
+
+from aqiq_shabbiri_tims.aqiq_shabbiri_tims.doctype.fiscal_queue.fiscal_queue import ACTIVE_STATUSES
+
+
+def execute():
+	"""
+	Collapse duplicate active Fiscal Queue rows so the unique active key can be added.
+	The indexes and the key itself are added by on_doctype_update during model sync,
+	once columns such as next_retry_at exist.
+	"""
+	if not frappe.db.table_exists("Fiscal Queue"):
+		return
+
+	# Active rows for invoices that were fiscalized by another path have nothing left to do
+	frappe.db.sql(
+		"""
+		update `tabFiscal Queue` queue
+		join `tabSales Invoice` invoice on invoice.name = queue.invoice
+		set queue.status = 'Completed'
+		where queue.status in %(statuses)s and invoice.custom_is_fiscalized = 1
+		""",
+		{"statuses": ACTIVE_STATUSES},
+	)
+
+	duplicated = frappe.db.sql_list(
+		"""
+		select invoice from `tabFiscal Queue`
+		where status in %(statuses)s
+		group by invoice having count(*) > 1
+		""",
+		{"statuses": ACTIVE_STATUSES},
+	)
+
+	for invoice in duplicated:
+		# Keep the row furthest along, then the oldest one
+		rows = frappe.db.sql_list(
+			"""
+			select name from `tabFiscal Queue`
+			where invoice = %(invoice)s and status in %(statuses)s
+			order by status = 'Processing' desc, creation asc
+			""",
+			{"invoice": invoice, "statuses": ACTIVE_STATUSES},
+		)
+		frappe.db.delete("Fiscal Queue", {"name": ["in", rows[1:]]})
+
@@ -0,0 +1,17 @@
+import frappe
+
+
+def execute():
+	"""Give Failed rows that the old 30 minute sweep would still have retried a due next_retry_at"""
+	frappe.db.sql(
+		"""
+		update `tabFiscal Queue` queue
+		join `tabSales Invoice` invoice on invoice.name = queue.invoice
+		join (
+			select invoice, max(creation) as creation
+			from `tabFiscal Queue` group by invoice
+		) latest on latest.invoice = queue.invoice and latest.creation = queue.creation
+		set queue.next_retry_at = now()
+		where queue.status = 'Failed' and queue.retry_count < 3 and invoice.custom_is_fiscalized = 0
+		"""
+	)